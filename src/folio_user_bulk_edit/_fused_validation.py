@@ -0,0 +1,266 @@
+import typing
+from dataclasses import dataclass, replace
+
+import pandera.polars as pla
+import polars as pl
+from pandera.constants import CHECK_OUTPUT_KEY
+from pandera.errors import SchemaErrorReason
+
+# Validates data against a pandera polars schema the same way pandera does,
+# but every check is compiled into one lazy query that is collected once
+# instead of collecting each check (and its failure cases) on its own.
+# Only the checks that fail have their failure cases collected.
+# Checks are run through pandera's private check attributes, which is why
+# pyproject.toml caps pandera at the versions this was tested against.
+
+
+@dataclass(frozen=True)
+class _Rule:
+    # The Column or DataFrameSchema a check belongs to
+    schema: typing.Any
+    check: typing.Any
+    check_index: int | None
+    reason_code: SchemaErrorReason
+    # A boolean for every row or the result of a check of the whole frame
+    output: pl.LazyFrame | bool
+    # Where the failure cases of row outputs come from, all columns if None
+    column: str | None = None
+    message: str = ""
+    # The failure case of a check of the whole frame
+    failure_case: typing.Any = None
+
+
+def _error_string(e: Exception) -> str:
+    # The same as pandera describes errors raised by checks
+    message = f'"{e.args[0]}"' if len(e.args) > 0 else ""
+    return f"{e.__class__.__name__}({message})"
+
+
+def _error(
+    rule: _Rule,
+    message: str,
+    failure_cases: typing.Any,
+    check_output: pl.DataFrame | None = None,
+) -> pla.errors.SchemaError:
+    return pla.errors.SchemaError(  # type: ignore[no-untyped-call]
+        rule.schema,
+        None,
+        message,
+        failure_cases=failure_cases,
+        check=rule.check,
+        check_index=rule.check_index,
+        check_output=check_output,
+        reason_code=rule.reason_code,
+    )
+
+
+def _check_output(
+    check: pla.Check,
+    data: pl.LazyFrame,
+    key: str | None,
+) -> pl.LazyFrame | bool:
+    # pandera's own backend calls _check_fn with _check_kwargs like this
+    if check.element_wise:
+        out = data.select(
+            pl.col(key or "*").map_elements(check._check_fn, return_dtype=pl.Boolean),  # noqa: SLF001
+        )
+    else:
+        out = check._check_fn(pla.PolarsData(data, key), **check._check_kwargs)  # noqa: SLF001
+    if isinstance(out, bool):
+        return out
+
+    passed = pl.all_horizontal(pl.all())
+    if check.ignore_na:
+        passed = passed | passed.is_null()
+    return out.select(passed.alias(CHECK_OUTPUT_KEY))
+
+
+def _checks(
+    schema: typing.Any,
+    checks: list[pla.Check],
+    data: pl.LazyFrame,
+    key: str | None,
+) -> typing.Iterator[_Rule]:
+    for i, check in enumerate(checks):
+        try:
+            output = _check_output(check, data, key)
+        except Exception as e:  # noqa: BLE001
+            # pandera reports checks that raise instead of failing them
+            error = _error_string(e)
+            yield _Rule(
+                schema,
+                check,
+                i,
+                SchemaErrorReason.CHECK_ERROR,
+                output=False,
+                message=error,
+                failure_case=error,
+            )
+            continue
+
+        yield _Rule(
+            schema,
+            check,
+            i,
+            SchemaErrorReason.DATAFRAME_CHECK,
+            output,
+            key,
+            message=f"{schema.__class__.__name__} '{schema.name}' failed "
+            f"validator number {i}: {check}",
+            failure_case=False,
+        )
+
+
+def _column(
+    column: typing.Any,
+    dtype: pl.DataType,
+    data: pl.LazyFrame,
+) -> typing.Iterator[_Rule]:
+    name = column.name
+    if not column.nullable:
+        not_null = pl.col(name).is_not_null()
+        if dtype.is_float():
+            not_null = not_null & pl.col(name).is_not_nan()
+        yield _Rule(
+            column,
+            "not_nullable",
+            None,
+            SchemaErrorReason.SERIES_CONTAINS_NULLS,
+            data.select(not_null.alias(CHECK_OUTPUT_KEY)),
+            name,
+            f"non-nullable column '{name}' contains null values",
+        )
+    if column.unique:
+        yield _Rule(
+            column,
+            "field_uniqueness",
+            None,
+            SchemaErrorReason.SERIES_CONTAINS_DUPLICATES,
+            data.select(pl.col(name).is_duplicated().not_().alias(CHECK_OUTPUT_KEY)),
+            name,
+            f"column '{name}' not unique",
+        )
+    if column.dtype is not None:
+        yield _Rule(
+            column,
+            f"dtype('{column.dtype}')",
+            None,
+            SchemaErrorReason.WRONG_DATATYPE,
+            column.dtype.check(dtype),
+            message=(
+                f"expected column '{name}' to have type {column.dtype}, got {dtype}"
+            ),
+            failure_case=str(dtype),
+        )
+
+    yield from _checks(column, column.checks, data, name)
+
+
+def _rules(schema: pla.DataFrameSchema, data: pl.LazyFrame) -> typing.Iterator[_Rule]:
+    dtypes = data.collect_schema()
+    if schema.strict:
+        for c in dtypes:
+            if c not in schema.columns:
+                yield _Rule(
+                    schema,
+                    "column_in_schema",
+                    None,
+                    SchemaErrorReason.COLUMN_NOT_IN_SCHEMA,
+                    output=False,
+                    message=f"column '{c}' not in {schema.__class__.__name__}",
+                    failure_case=c,
+                )
+    for c, column in schema.columns.items():
+        if column.required and c not in dtypes:
+            yield _Rule(
+                schema,
+                "column_in_dataframe",
+                None,
+                SchemaErrorReason.COLUMN_NOT_IN_DATAFRAME,
+                output=False,
+                message=f"column '{c}' not in dataframe",
+                failure_case=c,
+            )
+
+    for c, column in schema.columns.items():
+        if c in dtypes:
+            yield from _column(column, dtypes[c], data)
+
+    yield from _checks(schema, schema.checks, data, None)
+
+
+def _collect(rules: list[_Rule]) -> dict[int, pl.Series | Exception]:
+    # Every row level output is collected in one query,
+    # when it fails each is collected on its own to find the checks that raise.
+    lazy = {
+        i: r.output for i, r in enumerate(rules) if isinstance(r.output, pl.LazyFrame)
+    }
+    if len(lazy) == 0:
+        return {}
+    try:
+        outputs = pl.concat(
+            [o.select(pl.col(CHECK_OUTPUT_KEY).alias(str(i))) for i, o in lazy.items()],
+            how="horizontal",
+        ).collect()
+        return {i: outputs[str(i)] for i in lazy}
+    except pl.exceptions.PolarsError:
+        pass
+
+    results: dict[int, pl.Series | Exception] = {}
+    for i, o in lazy.items():
+        try:
+            results[i] = o.collect().to_series()
+        except pl.exceptions.PolarsError as e:
+            results[i] = e
+    return results
+
+
+def _failure(
+    rule: _Rule,
+    data: pl.DataFrame,
+    output: pl.Series | Exception | None,
+) -> pla.errors.SchemaError | None:
+    if isinstance(output, Exception):
+        error = _error_string(output)
+        return _error(
+            replace(rule, reason_code=SchemaErrorReason.CHECK_ERROR),
+            error,
+            error,
+        )
+    if output is None:
+        return None if rule.output else _error(rule, rule.message, rule.failure_case)
+    if output.all():
+        return None
+
+    failure_cases = pl.concat(
+        [data, output.alias(CHECK_OUTPUT_KEY).to_frame()],
+        how="horizontal",
+    ).filter(pl.col(CHECK_OUTPUT_KEY).not_())
+    if rule.column is not None:
+        failure_cases = failure_cases.select(rule.column)
+    return _error(
+        rule,
+        f"{rule.message} failure case examples: "
+        f"{failure_cases.head().rows(named=True)}",
+        failure_cases,
+        output.alias(CHECK_OUTPUT_KEY).to_frame(),
+    )
+
+
+def validate(
+    schema: pla.DataFrameSchema,
+    data: pl.DataFrame,
+) -> list[pla.errors.SchemaError]:
+    """Validates data against schema in one query.
+
+    The errors are the same as the ones pandera collects when validating lazily.
+    Checks of the whole frame that collect on their own, like the _SubSchema
+    null checks, still run their query while the rules are built.
+    """
+    rules = list(_rules(schema, data.lazy()))
+    outputs = _collect(rules)
+    return [
+        e
+        for i, r in enumerate(rules)
+        if (e := _failure(r, data, outputs.get(i))) is not None
+    ]
@@ -0,0 +1,162 @@
+import queue
+import threading
+from collections.abc import Callable, Generator, Iterable
+
+
+class _Done:
+    def __init__(self, err: Exception | None = None) -> None:
+        self.err = err
+
+
+class _Stage[T, U]:
+    def __init__(
+        self,
+        source: Iterable[T],
+        func: Callable[[T], U],
+        maxsize: int,
+    ) -> None:
+        self._source = source
+        self._func = func
+        self._buffer: queue.Queue[U | _Done] = queue.Queue(maxsize)
+        self._stopped = threading.Event()
+
+    def _put(self, item: U | _Done) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._buffer.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _produce(self) -> None:
+        it = iter(self._source)
+        try:
+            for s in it:
+                if not self._put(self._func(s)):
+                    return
+        except Exception as e:  # noqa: BLE001
+            self._put(_Done(e))
+            return
+        finally:
+            close = getattr(it, "close", None)
+            if close is not None:
+                close()
+
+        self._put(_Done())
+
+    def results(self) -> Generator[U]:
+        producer = threading.Thread(target=self._produce, daemon=True)
+        producer.start()
+        try:
+            while not isinstance(item := self._buffer.get(), _Done):
+                yield item
+            if item.err is not None:
+                raise item.err
+        finally:
+            self._stopped.set()
+            producer.join()
+
+
+def stage[T, U](
+    source: Iterable[T],
+    func: Callable[[T], U],
+    maxsize: int = 1,
+) -> Generator[U]:
+    # Lazily maps func over source on a background thread.
+    # At most maxsize results are buffered ahead of the consumer, once the
+    # buffer is full the thread stops pulling from source until there is room.
+    # Exceptions from the background thread are raised to the consumer.
+    # Close the returned generator to stop the background thread early.
+    return _Stage(source, func, maxsize).results()
+
+
+def prefetch[T](source: Iterable[T], maxsize: int = 1) -> Generator[T]:
+    # Reads ahead from source on a background thread.
+    return stage(source, lambda s: s, maxsize)
+
+
+class _Merge[T]:
+    def __init__(
+        self,
+        sources: Iterable[Iterable[T]],
+        workers: int,
+        maxsize: int,
+    ) -> None:
+        self._sources = iter(sources)
+        self._sources_lock = threading.Lock()
+        self._workers = workers
+        self._buffer: queue.Queue[T | _Done] = queue.Queue(maxsize)
+        self._stopped = threading.Event()
+
+    def _put(self, item: T | _Done) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._buffer.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _next_source(self) -> Iterable[T] | None:
+        with self._sources_lock:
+            return next(self._sources, None)
+
+    def _drain(self, source: Iterable[T]) -> bool:
+        it = iter(source)
+        try:
+            for s in it:
+                if not self._put(s):
+                    return False
+        finally:
+            close = getattr(it, "close", None)
+            if close is not None:
+                close()
+        return True
+
+    def _produce(self) -> None:
+        try:
+            while (source := self._next_source()) is not None:
+                if not self._drain(source):
+                    return
+        except Exception as e:  # noqa: BLE001
+            self._put(_Done(e))
+            return
+
+        self._put(_Done())
+
+    def results(self) -> Generator[T]:
+        producers = [
+            threading.Thread(target=self._produce, daemon=True)
+            for _ in range(self._workers)
+        ]
+        for p in producers:
+            p.start()
+        try:
+            done = 0
+            while done < len(producers):
+                item = self._buffer.get()
+                if not isinstance(item, _Done):
+                    yield item
+                    continue
+                if item.err is not None:
+                    raise item.err
+                done += 1
+        finally:
+            self._stopped.set()
+            for p in producers:
+                p.join()
+
+
+def merge[T](
+    sources: Iterable[Iterable[T]],
+    workers: int,
+    maxsize: int = 1,
+) -> Generator[T]:
+    # Drains up to workers sources at the same time on background threads.
+    # Sources are started in order as workers become free and their items
+    # are yielded as they're ready, items from one source stay in order.
+    # At most maxsize items are buffered ahead of the consumer.
+    # Exceptions from the background threads are raised to the consumer.
+    # Close the returned generator to stop the background threads early.
+    return _Merge(sources, workers, maxsize).results()
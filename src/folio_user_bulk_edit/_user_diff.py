@@ -0,0 +1,206 @@
+import typing
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+
+from folio_user_bulk_edit.folio import FolioClient
+from folio_user_bulk_edit.schemas import UserImportSchema
+
+# mod-user-import maps the names of contact types to their ids
+CONTACT_TYPES = {
+    "001": "mail",
+    "002": "email",
+    "003": "text",
+    "004": "phone",
+    "005": "mobile",
+}
+
+# Ids are sent to FOLIO in chunks that keep the query string reasonably short
+_QUERY_IDS = 50
+
+
+@dataclass(frozen=True)
+class References:
+    # The names mod-user-import uses in place of ids, by id
+    patron_groups: dict[str, str]
+    departments: dict[str, str]
+    address_types: dict[str, str]
+
+    @staticmethod
+    def fetch(folio: FolioClient) -> "References":
+        def names(endpoint: str, key: str, name: str) -> dict[str, str]:
+            return {
+                r["id"]: r[name] for r in folio.get_data(endpoint, key=key, limit=1000)
+            }
+
+        return References(
+            names("/groups", "usergroups", "group"),
+            names("/departments", "departments", "name"),
+            names("/addresstypes", "addressTypes", "addressType"),
+        )
+
+
+def _cql_string(value: str) -> str:
+    escaped = "".join(f"\\{c}" if c in '"\\*?^' else c for c in value)
+    return f'"{escaped}"'
+
+
+def _system_id(external_system_id: str, source_type: str | None) -> str:
+    # mod-user-import prefixes the externalSystemId with the sourceType
+    return (
+        external_system_id if not source_type else f"{source_type}_{external_system_id}"
+    )
+
+
+def fetch_by(
+    folio: FolioClient,
+    endpoint: str,
+    key: str,
+    index: str,
+    values: Iterable[str],
+) -> Iterator[dict[str, typing.Any]]:
+    # The records where index is any of the values
+    values = list(values)
+    for i in range(0, len(values), _QUERY_IDS):
+        chunk = values[i : i + _QUERY_IDS]
+        query = f"{index}==(" + " or ".join(map(_cql_string, chunk)) + ")"
+        yield from folio.get_data(endpoint, key=key, cql_query=query, limit=len(chunk))
+
+
+def fetch_users(
+    folio: FolioClient,
+    external_system_ids: Iterable[str],
+    source_type: str | None,
+) -> dict[str, dict[str, typing.Any]]:
+    # The users currently in FOLIO by the externalSystemId they were imported as
+    users = {
+        u.get("externalSystemId", ""): u
+        for u in fetch_by(
+            folio,
+            "/users",
+            "users",
+            "externalSystemId",
+            (_system_id(i, source_type) for i in external_system_ids),
+        )
+    }
+
+    prefix = len(_system_id("", source_type))
+    return {k[prefix:]: v | {"externalSystemId": k[prefix:]} for k, v in users.items()}
+
+
+def _names(ids: Iterable[str], names: dict[str, str]) -> Iterator[str | None]:
+    return (names.get(i) for i in ids)
+
+
+def _as_imported(
+    user: dict[str, typing.Any], refs: References
+) -> dict[str, typing.Any]:
+    # A FOLIO user in the same shape as the json sent to mod-user-import.
+    # Ids without a name are left as None so they never match.
+    user = dict(user)
+    if "patronGroup" in user:
+        user["patronGroup"] = refs.patron_groups.get(user["patronGroup"])
+    if "departments" in user:
+        user["departments"] = list(_names(user["departments"], refs.departments))
+
+    personal = dict(user.get("personal", {}))
+    if "preferredContactTypeId" in personal:
+        personal["preferredContactTypeId"] = CONTACT_TYPES.get(
+            personal["preferredContactTypeId"],
+        )
+    if "addresses" in personal:
+        personal["addresses"] = [
+            a | {"addressTypeId": refs.address_types.get(a.get("addressTypeId", ""))}
+            for a in personal["addresses"]
+        ]
+    user["personal"] = personal
+
+    return user
+
+
+# The fields of a FOLIO user that can be imported.
+# mod-user-import keeps the id of users it updates.
+_COLUMNS = UserImportSchema.to_schema().columns
+_FIELDS = frozenset(
+    n
+    for n in _COLUMNS
+    if n != "id" and not n.startswith(("personal_", "requestPreference_"))
+)
+_PERSONAL_FIELDS = frozenset(
+    n.removeprefix("personal_")
+    for n in _COLUMNS
+    if n.startswith("personal_") and not n.startswith("personal_address_")
+)
+
+
+def _is_empty(value: typing.Any) -> bool:
+    if isinstance(value, dict):
+        return all(map(_is_empty, value.values()))
+    if isinstance(value, list):
+        return len(value) == 0
+    return value is None
+
+
+def _has_unimported(new: dict[str, typing.Any], current: dict[str, typing.Any]) -> bool:
+    # Whether FOLIO has a value for a field that isn't being imported
+    new_personal = new.get("personal", {})
+    return any(
+        k not in new and not _is_empty(v) for k, v in current.items() if k in _FIELDS
+    ) or any(
+        k not in new_personal and not _is_empty(v)
+        for k, v in current["personal"].items()
+        if k in _PERSONAL_FIELDS
+    )
+
+
+_DATES = frozenset(["enrollmentDate", "expirationDate", "dateOfBirth"])
+
+
+def _matches(name: str, new: typing.Any, current: typing.Any) -> bool:
+    # Whether every field being imported is already the same in FOLIO.
+    # Anything that can't be compared is treated as a change.
+    if isinstance(new, dict):
+        return isinstance(current, dict) and all(
+            _matches(k, v, current.get(k)) for k, v in new.items()
+        )
+    if name in ("departments", "preferredEmailCommunication"):
+        return isinstance(current, list) and sorted(map(str, new)) == sorted(
+            map(str, current),
+        )
+    if name == "addresses":
+        return isinstance(current, list) and all(
+            any(_matches("", a, c) for c in current) for a in new
+        )
+    if name in _DATES:
+        # FOLIO stores dates as timestamps at midnight
+        return isinstance(current, str) and current[:10] == new
+    if isinstance(new, float) or isinstance(current, float):
+        return (
+            isinstance(new, int | float)
+            and isinstance(current, int | float)
+            and float(new) == float(current)
+        )
+    return bool(new == current)
+
+
+def is_noop(
+    new: dict[str, typing.Any],
+    current: dict[str, typing.Any] | None,
+    refs: References,
+    *,
+    update_all_fields: bool,
+) -> bool:
+    # Whether importing the user wouldn't change anything in FOLIO
+    if current is None or "requestPreference" in new:
+        # request preferences aren't part of the user record
+        return False
+
+    current = _as_imported(current, refs)
+    if update_all_fields and (
+        len(new.get("personal", {}).get("addresses", []))
+        != len(current["personal"].get("addresses", []))
+        or _has_unimported(new, current)
+    ):
+        # fields and addresses not being imported are removed
+        return False
+
+    return _matches("", new, current)
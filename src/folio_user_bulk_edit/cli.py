@@ -11,15 +11,34 @@ from pathlib import Path
 from urllib.parse import ParseResult, urlparse, urlunparse
 
 from folio_user_bulk_edit import _cli_log
-from folio_user_bulk_edit.commands import check, user_import
+from folio_user_bulk_edit.commands import check, user_export, user_import
+from folio_user_bulk_edit.data import SUFFIXES, Sample, stem, suffix
 
 _FOLIO__ENDPOINT = "UBE__FOLIO__ENDPOINT"
 _FOLIO__TENANT = "UBE__FOLIO__TENANT"
 _FOLIO__USERNAME = "UBE__FOLIO__USERNAME"
 _FOLIO__PASSWORD = "UBE__FOLIO__PASSWORD"  # noqa:S105
+_FOLIO__REQUESTSPERSECOND = "UBE__FOLIO__REQUESTSPERSECOND"
+_FOLIO__USERSPERSECOND = "UBE__FOLIO__USERSPERSECOND"
 
 _BATCH__BATCHSIZE = "UBE__BATCHSETTINGS__BATCHSIZE"
 _BATCH__RETRYCOUNT = "UBE__BATCHSETTINGS__RETRYCOUNT"
+_BATCH__RETRYBACKOFF = "UBE__BATCHSETTINGS__RETRYBACKOFF"
+_BATCH__MAXRETRYBACKOFF = "UBE__BATCHSETTINGS__MAXRETRYBACKOFF"
+_BATCH__CIRCUITBREAKERTHRESHOLD = "UBE__BATCHSETTINGS__CIRCUITBREAKERTHRESHOLD"
+_BATCH__CIRCUITBREAKERCOOLDOWN = "UBE__BATCHSETTINGS__CIRCUITBREAKERCOOLDOWN"
+_BATCH__MAXBATCHBYTES = "UBE__BATCHSETTINGS__MAXBATCHBYTES"
+_BATCH__CONCURRENCY = "UBE__BATCHSETTINGS__CONCURRENCY"
+_BATCH__FILECONCURRENCY = "UBE__BATCHSETTINGS__FILECONCURRENCY"
+_BATCH__COMPRESSREQUESTS = "UBE__BATCHSETTINGS__COMPRESSREQUESTS"
+_BATCH__ADAPTIVEBATCHSIZE = "UBE__BATCHSETTINGS__ADAPTIVEBATCHSIZE"
+_BATCH__MINBATCHSIZE = "UBE__BATCHSETTINGS__MINBATCHSIZE"
+_BATCH__MAXBATCHSIZE = "UBE__BATCHSETTINGS__MAXBATCHSIZE"
+_BATCH__TARGETLATENCY = "UBE__BATCHSETTINGS__TARGETLATENCY"
+_BATCH__BISECTREJECTEDBATCHES = "UBE__BATCHSETTINGS__BISECTREJECTEDBATCHES"
+_BATCH__DEFERFAILEDBATCHES = "UBE__BATCHSETTINGS__DEFERFAILEDBATCHES"
+_BATCH__DELTASTATE = "UBE__BATCHSETTINGS__DELTASTATE"
+_BATCH__DIFFAGAINSTFOLIO = "UBE__BATCHSETTINGS__DIFFAGAINSTFOLIO"
 
 _MODUSERIMPORT__DEACTIVATEMISSINGUSERS = "UBE__MODUSERIMPORT__DEACTIVATEMISSINGUSERS"
 _MODUSERIMPORT__UPDATEALLFIELDS = "UBE__MODUSERIMPORT__UPDATEALLFIELDS"
@@ -34,13 +53,67 @@ def _url_param(param: str) -> ParseResult:
     return urlparse(param, scheme="https")
 
 
+def _sample_param(param: str) -> Sample:
+    # Either a number of rows or a percentage of them
+    if param.endswith("%"):
+        percent = float(param.removesuffix("%"))
+        if not 0 < percent <= 100:
+            invalid = f"{param} is not a percentage between 0 and 100"
+            raise ValueError(invalid)
+        return Sample(fraction=percent / 100)
+
+    rows = int(param)
+    if rows < 1:
+        invalid = f"{param} is not a positive number of rows"
+        raise ValueError(invalid)
+    return Sample(rows=rows)
+
+
+def _check_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--engine",
+        choices=["pandera", "polars"],
+        default="pandera",
+        help="Validates the data with pandera or with every check fused into "
+        "a single polars query, which is faster on large files.",
+    )
+    parser.add_argument(
+        "--sample",
+        type=_sample_param,
+        default=None,
+        metavar="N|P%",
+        help="Only checks a random sample of every file, either N rows "
+        "sampled from the whole file or P%% of the rows of every chunk.",
+    )
+    parser.add_argument(
+        "--max-errors",
+        type=int,
+        default=None,
+        metavar="K",
+        help="Stops checking a file once K failure cases have been found.",
+    )
+
+
 @dataclass
 class _ParsedArgs:
     # These have internal defaults, env vars, and cli flags
     batch_size: int
     retry_count: int
+    retry_backoff: float
+    max_retry_backoff: float
+    circuit_breaker_cooldown: float
+    concurrency: int
+    file_concurrency: int
+    min_batch_size: int
+    max_batch_size: int
+    target_latency: float
     default_deactivate_missing_users: bool
     default_update_all_fields: bool
+    default_compress_requests: bool
+    default_adaptive_batch_size: bool
+    default_bisect_rejected_batches: bool
+    default_defer_failed_batches: bool
+    default_diff_against_folio: bool
 
     # These have env vars and cli flags
     folio_endpoint: ParseResult | None = None
@@ -48,6 +121,12 @@ class _ParsedArgs:
     folio_username: str | None = None
     folio_password: str | None = None
     ask_folio_password: bool = False
+    requests_per_second: float | None = None
+    users_per_second: float | None = None
+
+    max_batch_bytes: int | None = None
+    circuit_breaker_threshold: int | None = None
+    delta_state: Path | None = None
 
     source_type: str | None = None
 
@@ -57,6 +136,11 @@ class _ParsedArgs:
     # These boolean flags don't behave like the rest of the fields
     deactivate_missing_users: bool | None = None
     update_all_fields: bool | None = None
+    compress_requests: bool | None = None
+    adaptive_batch_size: bool | None = None
+    bisect_rejected_batches: bool | None = None
+    defer_failed_batches: bool | None = None
+    diff_against_folio: bool | None = None
 
     # see note below on nargs + subparsers
     additional_data: list[Path] | None = None
@@ -65,6 +149,16 @@ class _ParsedArgs:
     # these have just defaults and cli flags
     verbose: int = 0
     log_directory: Path = Path("./logs")
+    resume: Path | None = None
+    failed_users_format: str = "csv"
+    engine: str = "pandera"
+    sample: Sample | None = None
+    max_errors: int | None = None
+
+    # these are set based on the other args
+    journal: Path | None = None
+    failed_users: Path | None = None
+    rejects: Path | None = None
 
     @property
     def folio_url(self) -> str | None:
@@ -82,20 +176,33 @@ class _ParsedArgs:
         if self.additional_data is not None:
             all_data = all_data + self.additional_data
 
-        locations: dict[str, Path] = {}
+        files: list[Path] = []
         for p in all_data:
             if p.is_file():
-                locations[p.stem] = p
+                files.append(p)
                 continue
 
             if not p.is_file() and not p.is_dir():
                 file = f"{p.resolve().absolute()} does not exist or isn't readable"
                 raise ValueError(file)
 
-            locations = locations | {sp.stem: sp for sp in p.glob("**/*.csv")}
+            files.extend(sp for sp in sorted(p.glob("**/*")) if suffix(sp) in SUFFIXES)
+
+        # Files are imported and logged by their name without the suffix
+        locations: dict[str, Path] = {}
+        for f in files:
+            other = locations.setdefault(stem(f), f)
+            if other.resolve() != f.resolve():
+                duplicate = f"{other} and {f} have the same name {stem(f)}"
+                raise ValueError(duplicate)
 
         return locations if len(locations) > 0 else None
 
+    def _check_concurrency(self) -> None:
+        if self.concurrency < 1:
+            concurrency = "--concurrency must be at least 1"
+            raise ValueError(concurrency)
+
     def as_check_options(self) -> check.CheckOptions:
         if (
             self.folio_url is None
@@ -113,6 +220,11 @@ class _ParsedArgs:
             self.folio_username,
             self.folio_password,
             self.data_location,
+            self.engine,
+            self.sample,
+            self.max_errors,
+            requests_per_second=self.requests_per_second,
+            users_per_second=self.users_per_second,
         )
 
     def as_import_options(self) -> user_import.ImportOptions:
@@ -125,6 +237,10 @@ class _ParsedArgs:
         ):
             none = "One or more required options is missing"
             raise ValueError(none)
+        self._check_concurrency()
+        if self.file_concurrency < 1:
+            file_concurrency = "--file-concurrency must be at least 1"
+            raise ValueError(file_concurrency)
 
         return user_import.ImportOptions(
             self.folio_url,
@@ -141,6 +257,62 @@ class _ParsedArgs:
             if self.update_all_fields is None
             else self.update_all_fields,
             self.source_type,
+            requests_per_second=self.requests_per_second,
+            users_per_second=self.users_per_second,
+            max_batch_bytes=self.max_batch_bytes,
+            concurrency=self.concurrency,
+            file_concurrency=self.file_concurrency,
+            compress_requests=self.default_compress_requests
+            if self.compress_requests is None
+            else self.compress_requests,
+            adaptive_batch_size=self.default_adaptive_batch_size
+            if self.adaptive_batch_size is None
+            else self.adaptive_batch_size,
+            min_batch_size=self.min_batch_size,
+            max_batch_size=self.max_batch_size,
+            target_latency=self.target_latency,
+            journal=self.journal,
+            failed_users=self.failed_users,
+            rejects=self.rejects,
+            resume=self.resume,
+            delta_state=self.delta_state,
+            diff_against_folio=self.default_diff_against_folio
+            if self.diff_against_folio is None
+            else self.diff_against_folio,
+            bisect_rejected_batches=self.default_bisect_rejected_batches
+            if self.bisect_rejected_batches is None
+            else self.bisect_rejected_batches,
+            defer_failed_batches=self.default_defer_failed_batches
+            if self.defer_failed_batches is None
+            else self.defer_failed_batches,
+            retry_backoff=self.retry_backoff,
+            max_retry_backoff=self.max_retry_backoff,
+            circuit_breaker_threshold=self.circuit_breaker_threshold,
+            circuit_breaker_cooldown=self.circuit_breaker_cooldown,
+        )
+
+    def as_export_options(self) -> user_export.ExportOptions:
+        if (
+            self.folio_url is None
+            or self.folio_tenant is None
+            or self.folio_username is None
+            or self.folio_password is None
+            or self.data is None
+        ):
+            none = "One or more required options is missing"
+            raise ValueError(none)
+        self._check_concurrency()
+
+        return user_export.ExportOptions(
+            self.folio_url,
+            self.folio_tenant,
+            self.folio_username,
+            self.folio_password,
+            self.data,
+            self.batch_size,
+            self.concurrency,
+            requests_per_second=self.requests_per_second,
+            users_per_second=self.users_per_second,
         )
 
     @staticmethod
@@ -184,6 +356,21 @@ class _ParsedArgs:
             help="Whether to ask for the password of the FOLIO instance service user. "
             f"Can also be specified as {_FOLIO__PASSWORD} environment variable.",
         )
+        folio_parser.add_argument(
+            "--requests-per-second",
+            help="Maximum number of requests to send to FOLIO each second. "
+            "Requests FOLIO rejects with 429 Too Many Requests are always retried "
+            "after waiting for as long as it asks. "
+            f"Can also be specified as {_FOLIO__REQUESTSPERSECOND} environment "
+            "variable.",
+            type=float,
+        )
+        folio_parser.add_argument(
+            "--users-per-second",
+            help="Maximum number of users to send to FOLIO each second. "
+            f"Can also be specified as {_FOLIO__USERSPERSECOND} environment variable.",
+            type=float,
+        )
 
         folio_parser = parser.add_argument_group("Batch Settings")
         folio_parser.add_argument(
@@ -192,14 +379,86 @@ class _ParsedArgs:
             f"Can also be specified as {_BATCH__BATCHSIZE} environment variable.",
             type=int,
         )
+        folio_parser.add_argument(
+            "--max-batch-bytes",
+            help="Maximum estimated size in bytes of a batch sent to FOLIO "
+            "before it is compressed. Batches are cut short when either this "
+            "or the batch size is reached. "
+            f"Can also be specified as {_BATCH__MAXBATCHBYTES} environment variable.",
+            type=int,
+        )
         folio_parser.add_argument(
             "--retry-count",
             help="Maximum number times a failed request can be retried. "
             f"Can also be specified as {_BATCH__RETRYCOUNT} environment variable.",
             type=int,
         )
+        folio_parser.add_argument(
+            "--retry-backoff",
+            help="Maximum number of seconds to wait before the first retry. "
+            "The wait is random and the maximum doubles with every retry. "
+            f"Can also be specified as {_BATCH__RETRYBACKOFF} environment variable.",
+            type=float,
+        )
+        folio_parser.add_argument(
+            "--max-retry-backoff",
+            help="Maximum number of seconds to wait before any retry. "
+            f"Can also be specified as {_BATCH__MAXRETRYBACKOFF} environment variable.",
+            type=float,
+        )
+        folio_parser.add_argument(
+            "--circuit-breaker-threshold",
+            help="Number of batches in a row that fail to reach FOLIO before "
+            "sending any batch is paused for --circuit-breaker-cooldown. "
+            f"Can also be specified as {_BATCH__CIRCUITBREAKERTHRESHOLD} "
+            "environment variable.",
+            type=int,
+        )
+        folio_parser.add_argument(
+            "--circuit-breaker-cooldown",
+            help="Number of seconds to pause sending batches for. "
+            f"Can also be specified as {_BATCH__CIRCUITBREAKERCOOLDOWN} "
+            "environment variable.",
+            type=float,
+        )
+        folio_parser.add_argument(
+            "--concurrency",
+            help="Maximum number of batches to send to FOLIO at the same time. "
+            f"Can also be specified as {_BATCH__CONCURRENCY} environment variable.",
+            type=int,
+        )
+        folio_parser.add_argument(
+            "--file-concurrency",
+            help="Maximum number of files to read and import at the same time. "
+            "The largest files are started first. "
+            f"Can also be specified as {_BATCH__FILECONCURRENCY} environment variable.",
+            type=int,
+        )
+        folio_parser.add_argument(
+            "--min-batch-size",
+            help="Smallest batch size to use with --adaptive-batch-size. "
+            "This is also how much the batch size grows by after a fast batch. "
+            f"Can also be specified as {_BATCH__MINBATCHSIZE} environment variable.",
+            type=int,
+        )
+        folio_parser.add_argument(
+            "--max-batch-size",
+            help="Largest batch size to use with --adaptive-batch-size. "
+            f"Can also be specified as {_BATCH__MAXBATCHSIZE} environment variable.",
+            type=int,
+        )
+        folio_parser.add_argument(
+            "--target-latency",
+            help="Number of seconds a batch can take before "
+            "--adaptive-batch-size shrinks the batch size. "
+            f"Can also be specified as {_BATCH__TARGETLATENCY} environment variable.",
+            type=float,
+        )
 
-        data_desc = "One or more .csvs or directories with .csvs to operate on."
+        data_desc = (
+            "One or more .csv, .csv.gz, .csv.zst, .parquet, .arrow, .ipc, "
+            "or .ndjson files or directories with them to operate on."
+        )
 
         def data(p: argparse.ArgumentParser) -> None:
             p.add_argument(
@@ -218,6 +477,7 @@ class _ParsedArgs:
             help=check_desc,
             description=check_desc,
         )
+        _check_arguments(check_parser)
 
         import_desc = "Imports input files to FOLIO and reports on progress and errors."
         import_parser = commands.add_parser(
@@ -241,6 +501,81 @@ class _ParsedArgs:
             f"Can also be specified as {_MODUSERIMPORT__UPDATEALLFIELDS} "
             "environment variable.",
         )
+        import_parser.add_argument(
+            "--compress-requests",
+            action=argparse.BooleanOptionalAction,
+            help="Indicates whether to gzip the batches sent to FOLIO. "
+            "FOLIO must be configured to accept compressed requests. "
+            f"Can also be specified as {_BATCH__COMPRESSREQUESTS} "
+            "environment variable.",
+        )
+        import_parser.add_argument(
+            "--adaptive-batch-size",
+            action=argparse.BooleanOptionalAction,
+            help="Indicates whether to adjust the batch size while importing "
+            "based on how quickly FOLIO responds. "
+            "The batch size is used as the starting point. "
+            f"Can also be specified as {_BATCH__ADAPTIVEBATCHSIZE} "
+            "environment variable.",
+        )
+        import_parser.add_argument(
+            "--resume",
+            help="A journal from the log directory of an interrupted import. "
+            "Batches that were already imported are skipped "
+            "as long as the data and batch settings haven't changed.",
+            type=Path,
+        )
+        import_parser.add_argument(
+            "--delta-state",
+            help="A file to keep track of the users imported to FOLIO. "
+            "Only new and changed users since the last import "
+            "with the same file are sent to FOLIO, all of them are sent when "
+            "--source-type or --update-all-fields change. "
+            "Can't be used with --deactivate-missing-users. "
+            f"Can also be specified as {_BATCH__DELTASTATE} environment variable.",
+            type=Path,
+        )
+        import_parser.add_argument(
+            "--diff-against-folio",
+            action=argparse.BooleanOptionalAction,
+            help="Indicates whether to fetch the users in each batch from FOLIO "
+            "and only send the users that have changed. "
+            f"Can also be specified as {_BATCH__DIFFAGAINSTFOLIO} "
+            "environment variable.",
+        )
+        import_parser.add_argument(
+            "--bisect-rejected-batches",
+            action=argparse.BooleanOptionalAction,
+            help="Indicates whether to split batches rejected by FOLIO "
+            "and resend the halves until only the offending users fail, "
+            "batches rejected as a whole are only split a few times. "
+            f"Can also be specified as {_BATCH__BISECTREJECTEDBATCHES} "
+            "environment variable.",
+        )
+        import_parser.add_argument(
+            "--failed-users-format",
+            choices=["csv", "parquet", "ndjson"],
+            default="csv",
+            help="Format of the failedUsers file written to the log directory.",
+        )
+        import_parser.add_argument(
+            "--defer-failed-batches",
+            action=argparse.BooleanOptionalAction,
+            help="Indicates whether to set aside batches that fail every retry "
+            "and send them again after the rest of the import. "
+            f"Can also be specified as {_BATCH__DEFERFAILEDBATCHES} "
+            "environment variable.",
+        )
+        export_desc = (
+            "Exports users from FOLIO to data as a .parquet or .csv "
+            "in the same columns used for importing."
+        )
+        commands.add_parser(
+            "export",
+            help=export_desc,
+            description=export_desc,
+        )
+
         folio_parser.add_argument(
             "--source-type",
             help="A prefix for the externalSystemId. "
@@ -272,8 +607,33 @@ def main(args: list[str] | None = None) -> None:
         folio_tenant=os.environ.get(_FOLIO__TENANT),
         folio_username=os.environ.get(_FOLIO__USERNAME),
         folio_password=os.environ.get(_FOLIO__PASSWORD),
+        requests_per_second=float(os.environ[_FOLIO__REQUESTSPERSECOND])
+        if _FOLIO__REQUESTSPERSECOND in os.environ
+        else None,
+        users_per_second=float(os.environ[_FOLIO__USERSPERSECOND])
+        if _FOLIO__USERSPERSECOND in os.environ
+        else None,
         batch_size=int(os.environ.get(_BATCH__BATCHSIZE, "1000")),
         retry_count=int(os.environ.get(_BATCH__RETRYCOUNT, "1")),
+        retry_backoff=float(os.environ.get(_BATCH__RETRYBACKOFF, "0")),
+        max_retry_backoff=float(os.environ.get(_BATCH__MAXRETRYBACKOFF, "60")),
+        circuit_breaker_threshold=int(os.environ[_BATCH__CIRCUITBREAKERTHRESHOLD])
+        if _BATCH__CIRCUITBREAKERTHRESHOLD in os.environ
+        else None,
+        circuit_breaker_cooldown=float(
+            os.environ.get(_BATCH__CIRCUITBREAKERCOOLDOWN, "30"),
+        ),
+        max_batch_bytes=int(os.environ[_BATCH__MAXBATCHBYTES])
+        if _BATCH__MAXBATCHBYTES in os.environ
+        else None,
+        concurrency=int(os.environ.get(_BATCH__CONCURRENCY, "1")),
+        file_concurrency=int(os.environ.get(_BATCH__FILECONCURRENCY, "1")),
+        delta_state=Path(os.environ[_BATCH__DELTASTATE])
+        if _BATCH__DELTASTATE in os.environ
+        else None,
+        min_batch_size=int(os.environ.get(_BATCH__MINBATCHSIZE, "10")),
+        max_batch_size=int(os.environ.get(_BATCH__MAXBATCHSIZE, "5000")),
+        target_latency=float(os.environ.get(_BATCH__TARGETLATENCY, "10")),
         default_deactivate_missing_users=os.environ.get(
             _MODUSERIMPORT__DEACTIVATEMISSINGUSERS,
             "0",
@@ -284,6 +644,31 @@ def main(args: list[str] | None = None) -> None:
             "0",
         )
         == "1",
+        default_compress_requests=os.environ.get(
+            _BATCH__COMPRESSREQUESTS,
+            "0",
+        )
+        == "1",
+        default_adaptive_batch_size=os.environ.get(
+            _BATCH__ADAPTIVEBATCHSIZE,
+            "0",
+        )
+        == "1",
+        default_bisect_rejected_batches=os.environ.get(
+            _BATCH__BISECTREJECTEDBATCHES,
+            "0",
+        )
+        == "1",
+        default_defer_failed_batches=os.environ.get(
+            _BATCH__DEFERFAILEDBATCHES,
+            "0",
+        )
+        == "1",
+        default_diff_against_folio=os.environ.get(
+            _BATCH__DIFFAGAINSTFOLIO,
+            "0",
+        )
+        == "1",
         source_type=os.environ.get(_MODUSERIMPORT__SOURCETYPE),
     )
     parser = _ParsedArgs.parser()
@@ -312,16 +697,25 @@ def main(args: list[str] | None = None) -> None:
             raise
         check.run(c_opts).write_results(sys.stdout)
     elif parsed_args.command == "import":
+        parsed_args.journal = parsed_args.log_directory / f"{now}-journal.tsv"
+        parsed_args.failed_users = (
+            parsed_args.log_directory
+            / f"{now}-failedUsers.{parsed_args.failed_users_format}"
+        )
+        parsed_args.rejects = parsed_args.log_directory / f"{now}-rejects"
         try:
             i_opts = parsed_args.as_import_options()
         except ValueError:
             parser.print_usage()
             raise
-        results = user_import.run(i_opts)
-        results.failed_users.write_csv(
-            parsed_args.log_directory / f"{now}-failedUsers.csv",
-        )
-        results.write_results(sys.stdout)
+        user_import.run(i_opts).write_results(sys.stdout)
+    elif parsed_args.command == "export":
+        try:
+            e_opts = parsed_args.as_export_options()
+        except ValueError:
+            parser.print_usage()
+            raise
+        user_export.run(e_opts).write_results(sys.stdout)
 
 
 if __name__ == "__main__":
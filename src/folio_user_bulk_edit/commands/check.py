@@ -6,7 +6,7 @@ from typing import TextIO
 import pandera.polars as pla
 import polars as pl
 
-from folio_user_bulk_edit.data import InputData, InputDataOptions
+from folio_user_bulk_edit.data import InputData, InputDataOptions, Sample
 from folio_user_bulk_edit.folio import Folio, FolioOptions
 
 
@@ -14,6 +14,10 @@ from folio_user_bulk_edit.folio import Folio, FolioOptions
 class CheckOptions(InputDataOptions, FolioOptions):
     """Options used for checking an import's viability."""
 
+    engine: str = "pandera"
+    sample: Sample | None = None
+    max_errors: int | None = None
+
 
 @dataclass
 class CheckResults:
@@ -43,6 +47,14 @@ class CheckResults:
     """The errors (if there are any) encountered reading the data."""
     read_errors: dict[str, pl.exceptions.PolarsError] | None = None
 
+    @property
+    def complete(self) -> bool:
+        """Was all of the data checked?"""
+        return self.partial_checks is None
+
+    """The files (if there are any) that were only partly checked and how much was."""
+    partial_checks: dict[str, str] | None = None
+
     def write_results(self, stream: TextIO) -> None:
         """Pretty prints the results of the check."""
         report = []
@@ -52,7 +64,9 @@ class CheckResults:
             report.append(f"❌ FOLIO connection: {self.folio_error}")
 
         if self.read_ok and self.schema_ok:
-            report.append("✅ Data is good!")
+            report.append(
+                "✅ Data is good!" if self.complete else "✅ Checked data is good!",
+            )
         else:
             report.append("❌ Data has issues:")
             if self.read_errors:
@@ -62,9 +76,21 @@ class CheckResults:
                 for k, v in self.schema_errors.items():
                     report.append(f"\t{k}: {v}")
 
+        if self.partial_checks:
+            report.append("⚠️ Data was only partly checked:")
+            for k, c in self.partial_checks.items():
+                report.append(f"\t{k}: {c}")
+
         stream.writelines("\n".join(report) + "\n")
 
 
 def run(options: CheckOptions) -> CheckResults:
     """Checks for connectivity and data validity."""
-    return CheckResults(Folio(options).test(), *InputData(options).test())
+    return CheckResults(
+        Folio(options).test(),
+        *InputData(options).test(
+            engine=options.engine,
+            sample=options.sample,
+            max_errors=options.max_errors,
+        ),
+    )
@@ -0,0 +1,225 @@
+"""Command for exporting user data from FOLIO."""
+
+import itertools
+import json
+import tempfile
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+
+import polars as pl
+
+from folio_user_bulk_edit import _user_diff
+from folio_user_bulk_edit.folio import Folio, FolioClient, FolioOptions
+from folio_user_bulk_edit.schemas import UserImportSchema
+
+
+@dataclass(frozen=True)
+class ExportOptions(FolioOptions):
+    """Options used for exporting users from FOLIO."""
+
+    output: Path
+    page_size: int = 1000
+    concurrency: int = 4
+
+
+@dataclass
+class ExportResults:
+    """Results of exporting users from FOLIO."""
+
+    output: Path
+    exported_records: int = 0
+
+    def write_results(self, stream: typing.TextIO) -> None:
+        """Pretty prints the results of the export."""
+        stream.writelines(f"{self.exported_records} users exported to {self.output}\n")
+
+
+_FIRST_COLUMNS = ["username", "externalSystemId"]
+_COLUMNS: dict[str, pl.DataType] = {
+    n: UserImportSchema.to_schema().columns[n].dtype.type
+    for n in [
+        *_FIRST_COLUMNS,
+        *(n for n in UserImportSchema.to_schema().columns if n not in _FIRST_COLUMNS),
+    ]
+}
+
+# The id space is split evenly on the first hex digit of the ids
+_PARTITIONS = [f"{d:x}0000000-0000-0000-0000-000000000000" for d in range(16)]
+
+
+def _partition_query(p: int) -> str:
+    query = f"id>={_PARTITIONS[p]}"
+    if p + 1 < len(_PARTITIONS):
+        query += f" and id<{_PARTITIONS[p + 1]}"
+    return query
+
+
+def _date(timestamp: str | None) -> date | None:
+    return None if timestamp is None else date.fromisoformat(timestamp[:10])
+
+
+def _joined(values: list[str | None] | None) -> str | None:
+    if not values:
+        return None
+    return ",".join(v for v in values if v is not None)
+
+
+def _address(
+    prefix: str,
+    address: dict[str, typing.Any] | None,
+    refs: _user_diff.References,
+) -> dict[str, typing.Any]:
+    if address is None:
+        return {}
+    return {f"{prefix}_{k}": v for k, v in address.items()} | {
+        f"{prefix}_addressTypeId": refs.address_types.get(
+            address.get("addressTypeId", ""),
+        ),
+    }
+
+
+def _flatten(
+    user: dict[str, typing.Any],
+    pref: dict[str, typing.Any] | None,
+    refs: _user_diff.References,
+) -> dict[str, typing.Any]:
+    # A FOLIO user in the same shape as the csvs used for importing
+    row = {k: v for k, v in user.items() if not isinstance(v, dict | list)}
+    row["patronGroup"] = refs.patron_groups.get(user.get("patronGroup", ""))
+    row["departments"] = _joined(
+        [refs.departments.get(d) for d in user.get("departments", [])],
+    )
+    row["preferredEmailCommunication"] = _joined(
+        user.get("preferredEmailCommunication"),
+    )
+    row["tags"] = _joined(user.get("tags", {}).get("tagList"))
+    row["enrollmentDate"] = _date(user.get("enrollmentDate"))
+    row["expirationDate"] = _date(user.get("expirationDate"))
+    if "customFields" in user:
+        row["customFields"] = json.dumps(user["customFields"], ensure_ascii=False)
+
+    personal = user.get("personal", {})
+    row |= {
+        f"personal_{k}": v
+        for k, v in personal.items()
+        if not isinstance(v, dict | list)
+    }
+    row["personal_dateOfBirth"] = _date(personal.get("dateOfBirth"))
+    row["personal_preferredContactTypeId"] = _user_diff.CONTACT_TYPES.get(
+        personal.get("preferredContactTypeId", ""),
+    )
+
+    addresses = personal.get("addresses", [])
+    row |= _address(
+        "personal_address_primary",
+        next((a for a in addresses if a.get("primaryAddress")), None),
+        refs,
+    )
+    row |= _address(
+        "personal_address_secondary",
+        next((a for a in addresses if not a.get("primaryAddress")), None),
+        refs,
+    )
+
+    if pref is not None:
+        row |= {f"requestPreference_{k}": v for k, v in pref.items()}
+        row["requestPreference_defaultDeliveryAddressTypeId"] = refs.address_types.get(
+            pref.get("defaultDeliveryAddressTypeId", "")
+        )
+
+    # FOLIO has fields that can't be imported, like metadata
+    return {k: v for k, v in row.items() if k in _COLUMNS}
+
+
+def _export_partition(
+    folio: FolioClient,
+    options: ExportOptions,
+    refs: _user_diff.References,
+    spool: Path,
+    partition: int,
+) -> int:
+    # Pages through the users in a partition and spools them to disk
+    # so only a page per partition is ever held in memory.
+    exported = 0
+    for page, users in enumerate(
+        itertools.batched(
+            folio.iter_data(
+                "/users",
+                "users",
+                cql_query=_partition_query(partition),
+                limit=options.page_size,
+            ),
+            options.page_size,
+            strict=False,
+        ),
+    ):
+        prefs = {
+            p["userId"]: p
+            for p in _user_diff.fetch_by(
+                folio,
+                "/request-preference-storage/request-preference",
+                "requestPreferences",
+                "userId",
+                (u["id"] for u in users),
+            )
+        }
+        pl.DataFrame(
+            [_flatten(u, prefs.get(u["id"]), refs) for u in users],
+            schema=_COLUMNS,
+        ).write_parquet(
+            spool / f"{partition:02d}-{page:08d}.parquet",
+            compression="uncompressed",
+        )
+        exported += len(users)
+
+    return exported
+
+
+def run(options: ExportOptions) -> ExportResults:
+    """Export users from FOLIO.
+
+    The users are split into partitions by their id,
+    up to options.concurrency partitions are paged through at the same time.
+    Pages are spooled to disk as they arrive and streamed into
+    options.output once every partition is done.
+    Outputs ending in .csv are written as csvs without any empty columns,
+    anything else is written as parquet.
+    """
+    results = ExportResults(options.output)
+    with (
+        tempfile.TemporaryDirectory(dir=options.output.parent) as spool,
+        Folio(options).connect() as folio,
+        ThreadPoolExecutor(max_workers=options.concurrency) as executor,
+    ):
+        refs = _user_diff.References.fetch(folio)
+        results.exported_records = sum(
+            executor.map(
+                lambda p: _export_partition(folio, options, refs, Path(spool), p),
+                range(len(_PARTITIONS)),
+            ),
+        )
+
+        pages = sorted(Path(spool).glob("*.parquet"))
+        users = (
+            pl.scan_parquet(pages)
+            if len(pages) > 0
+            else pl.LazyFrame([], schema=_COLUMNS)
+        )
+        if options.output.suffix == ".csv":
+            # csvs can't say what type an empty column is
+            empty = (
+                users.select(pl.all().is_not_null().any().not_())
+                .collect()
+                .row(
+                    0,
+                    named=True,
+                )
+            )
+            users.drop(k for k, v in empty.items() if v).sink_csv(options.output)
+        else:
+            users.sink_parquet(options.output)
+
+    return results
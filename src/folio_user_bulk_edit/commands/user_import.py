@@ -1,15 +1,34 @@
 """Command for importing user data into FOLIO."""
 
+import csv
+import gzip
+import hashlib
+import json
+import logging
+import random
+import shutil
+import tempfile
+import threading
+import time
 import typing
-from dataclasses import dataclass, field
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, closing
+from dataclasses import dataclass, field, replace
+from pathlib import Path
 
 import httpx
 import polars as pl
 import polars.selectors as cs
+from polars.datatypes import DataTypeClass
 from pyfolioclient import BadRequestError, UnprocessableContentError
 
-from folio_user_bulk_edit.data import InputData, InputDataOptions
-from folio_user_bulk_edit.folio import Folio, FolioOptions
+from folio_user_bulk_edit import _pipeline, _user_diff
+from folio_user_bulk_edit.data import ERROR_MESSAGE, InputData, InputDataOptions
+from folio_user_bulk_edit.folio import Folio, FolioClient, FolioOptions
+
+_log = logging.getLogger(__name__)
 
 
 @dataclass(frozen=True)
@@ -23,6 +42,70 @@ class ImportOptions(InputDataOptions, FolioOptions):
     update_all_fields: bool
     source_type: str | None
 
+    max_batch_bytes: int | None = None
+    concurrency: int = 1
+    file_concurrency: int = 1
+    compress_requests: bool = False
+
+    adaptive_batch_size: bool = False
+    min_batch_size: int = 10
+    max_batch_size: int = 5000
+    target_latency: float = 10.0
+
+    bisect_rejected_batches: bool = False
+
+    retry_backoff: float = 0.0
+    max_retry_backoff: float = 60.0
+    circuit_breaker_threshold: int | None = None
+    circuit_breaker_cooldown: float = 30.0
+    defer_failed_batches: bool = False
+
+    journal: Path | None = None
+    failed_users: Path | None = None
+    rejects: Path | None = None
+    resume: Path | None = None
+
+    delta_state: Path | None = None
+    diff_against_folio: bool = False
+
+    def __post_init__(self) -> None:
+        """Checks for options that can't be used together or are out of range."""
+        if self.delta_state is not None and self.deactivate_missing_users:
+            # Unchanged users aren't sent so FOLIO would deactivate them
+            incompatible = "delta_state can't be used with deactivate_missing_users"
+            raise ValueError(incompatible)
+        if self.diff_against_folio and self.deactivate_missing_users:
+            # The same goes for users that are the same as in FOLIO
+            incompatible = (
+                "diff_against_folio can't be used with deactivate_missing_users"
+            )
+            raise ValueError(incompatible)
+        if self.adaptive_batch_size and not (
+            1 <= self.min_batch_size <= self.max_batch_size
+        ):
+            # An empty batch would never finish reading the file
+            sizes = "min_batch_size must be at least 1 and at most max_batch_size"
+            raise ValueError(sizes)
+
+
+@dataclass
+class FileResults:
+    """Results of importing the users from a single file."""
+
+    created_records: int = 0
+    updated_records: int = 0
+    failed_records: int = 0
+    skipped_records: int = 0
+    unchanged_records: int = 0
+
+    def __iadd__(self, other: "FileResults | ImportResults") -> typing.Self:
+        self.created_records += other.created_records
+        self.updated_records += other.updated_records
+        self.failed_records += other.failed_records
+        self.skipped_records += other.skipped_records
+        self.unchanged_records += other.unchanged_records
+        return self
+
 
 @dataclass
 class ImportResults:
@@ -31,6 +114,10 @@ class ImportResults:
     created_records: int = 0
     updated_records: int = 0
     failed_records: int = 0
+    skipped_records: int = 0
+    unchanged_records: int = 0
+    deferred_records: int = 0
+    backoff_seconds: float = 0.0
     failed_users: pl.DataFrame = field(
         default_factory=lambda: pl.DataFrame(
             [],
@@ -39,9 +126,26 @@ class ImportResults:
                 "externalSystemId": pl.Utf8,
                 "errorMessage": pl.Utf8,
                 "source": pl.Utf8,
+                "row": pl.Int64,
             },
         ),
     )
+    files: dict[str, FileResults] = field(default_factory=dict)
+
+    def __iadd__(self, other: "ImportResults") -> typing.Self:
+        self.created_records += other.created_records
+        self.updated_records += other.updated_records
+        self.failed_records += other.failed_records
+        self.skipped_records += other.skipped_records
+        self.unchanged_records += other.unchanged_records
+        self.deferred_records += other.deferred_records
+        self.backoff_seconds += other.backoff_seconds
+        if not other.failed_users.is_empty():
+            self.failed_users.vstack(other.failed_users, in_place=True)
+        for f, r in other.files.items():
+            file_results = self.files.setdefault(f, FileResults())
+            file_results += r
+        return self
 
     def write_results(self, stream: typing.TextIO) -> None:
         """Pretty prints the results of the check."""
@@ -49,6 +153,25 @@ class ImportResults:
         report.append(f"{self.created_records} users created")
         report.append(f"{self.updated_records} users updated")
         report.append(f"{self.failed_records} users failed to create/update")
+        if self.skipped_records > 0:
+            report.append(f"{self.skipped_records} users skipped when resuming")
+        if self.unchanged_records > 0:
+            report.append(f"{self.unchanged_records} users unchanged and not sent")
+        if self.deferred_records > 0:
+            report.append(
+                f"{self.deferred_records} users deferred to the end of the import",
+            )
+        if self.backoff_seconds > 0:
+            report.append(
+                f"{self.backoff_seconds:.1f}s spent waiting to retry failed batches",
+            )
+        if len(self.files) > 1:
+            report.append("")
+            report.extend(
+                f"{f}: {r.created_records} created, {r.updated_records} updated, "
+                f"{r.failed_records} failed"
+                for f, r in self.files.items()
+            )
         report.append("")
         report.append("Sample of failed users")
         report.append("======================")
@@ -57,22 +180,100 @@ class ImportResults:
         stream.writelines("\n".join(report) + "\n")
 
 
+def _of_file(file: str, results: ImportResults) -> ImportResults:
+    # Results that are all for users from file
+    file_results = FileResults()
+    file_results += results
+    results.files = {file: file_results}
+    return results
+
+
 # https://github.com/pola-rs/polars/issues/12795
-# Polars doesn't want to add this support for now so we're doing it manually
-def _clean_nones(obj: dict[str, typing.Any]) -> dict[str, typing.Any]:
-    for k in list(obj.keys()):
-        if k in ["customFields", "requestPreference"]:
-            _clean_nones(obj[k])
-        if k == "personal":
-            if "addresses" in obj[k]:
-                for a in obj[k]["addresses"]:
-                    _clean_nones(a)
-                obj[k]["addresses"] = [a for a in obj[k]["addresses"] if a != {}]
-            _clean_nones(obj["personal"])
-        if obj[k] is None or obj[k] == {} or obj[k] == []:
-            del obj[k]
-
-    return obj
+# Polars doesn't want to add support for dropping nulls when encoding json.
+# Instead the json is built up field by field inside polars,
+# concat_str(ignore_nulls=True) does the work of dropping the null fields.
+def _json_member(name: str, value: pl.Expr) -> pl.Expr:
+    return pl.concat_str(pl.lit(json.dumps(name, ensure_ascii=False) + ":"), value)
+
+
+# Each expression is only referenced once, polars doesn't deduplicate
+# them and nested structures would be encoded many times over.
+def _json_object(members: list[pl.Expr]) -> pl.Expr:
+    return pl.concat_str(
+        pl.lit("{"),
+        pl.concat_str(members, separator=",", ignore_nulls=True),
+        pl.lit("}"),
+    ).replace("{}", None)
+
+
+def _json_value(value: pl.Expr, dtype: pl.DataType | DataTypeClass) -> pl.Expr:
+    # Empty lists and objects are dropped the same as nulls
+    empty = ["null"]
+    if isinstance(dtype, pl.List):
+        empty.append("[]")
+    if isinstance(dtype, pl.Struct):
+        empty.append("{}")
+    return (
+        pl.struct(value.alias("v"))
+        .struct.json_encode()
+        .str.strip_prefix('{"v":')
+        .str.strip_suffix("}")
+        .replace(empty, None)
+    )
+
+
+def _json_cleaned(
+    value: pl.Expr,
+    dtype: pl.Struct,
+    cleaned_lists: tuple[str, ...] = (),
+) -> pl.Expr:
+    members = []
+    for f in dtype.fields:
+        field_value = value.struct.field(f.name)
+        field_json: pl.Expr
+        if (
+            f.name in cleaned_lists
+            and isinstance(f.dtype, pl.List)
+            and isinstance(f.dtype.inner, pl.Struct)
+        ):
+            field_json = pl.concat_str(
+                pl.lit("["),
+                field_value.list.eval(
+                    _json_cleaned(pl.element(), f.dtype.inner),
+                    parallel=True,
+                )
+                .list.drop_nulls()
+                .list.join(","),
+                pl.lit("]"),
+            ).replace("[]", None)
+        else:
+            field_json = _json_value(field_value, f.dtype)
+        members.append(_json_member(f.name, field_json))
+
+    return _json_object(members)
+
+
+def _json_users(schema: pl.Schema) -> pl.Expr:
+    members = []
+    for name, dtype in schema.items():
+        value = pl.col(name)
+        if name in ["customFields", "requestPreference"] and isinstance(
+            dtype,
+            pl.Struct,
+        ):
+            members.append(_json_member(name, _json_cleaned(value, dtype)))
+        elif name == "personal" and isinstance(dtype, pl.Struct):
+            members.append(
+                _json_member(name, _json_cleaned(value, dtype, ("addresses",))),
+            )
+        else:
+            members.append(_json_member(name, _json_value(value, dtype)))
+
+    return pl.concat_str(
+        pl.lit("{"),
+        pl.concat_str(members, separator=",", ignore_nulls=True),
+        pl.lit("}"),
+    )
 
 
 def _transform_batch(batch: pl.LazyFrame) -> pl.LazyFrame:
@@ -150,70 +351,1005 @@ def _transform_batch(batch: pl.LazyFrame) -> pl.LazyFrame:
     return batch.select(cs.all() - cs_personal - cs_req_pref - cs_addresses)
 
 
-def run(options: ImportOptions) -> ImportResults:
-    """Import users into FOLIO."""
-    import_results = ImportResults()
-    with Folio(options).connect() as folio:
-        for file, total, b in InputData(options).batch(options.batch_size):
-            batch = _transform_batch(b).collect()
-            users = [_clean_nones(u) for u in batch.to_dicts()]
-            req = {
-                "users": users,
-                "totalRecords": total,
-                "deactivateMissingUsers": options.deactivate_missing_users,
-                "updateOnlyPresentFields": not options.update_all_fields,
-            }
-            if options.source_type:
-                req["sourceType"] = options.source_type
-
-            last_err: Exception | None = None
-            tries = 0
-            while tries < 1 + options.retry_count:
-                last_err = None
-                try:
-                    res = folio.post_data("/user-import", payload=req)
-                    if isinstance(res, int):
-                        res_err = f"Expected json but got http code {res}"
-                        raise TypeError(res_err)
-
-                    import_results.created_records += int(res["createdRecords"])
-                    import_results.updated_records += int(res["updatedRecords"])
-                    import_results.failed_records += int(res["failedRecords"])
-                    if any(res.get("failedUsers", [])):
-                        import_results.failed_users.vstack(
-                            pl.DataFrame(res["failedUsers"]).with_columns(
-                                pl.lit(file).alias("source"),
-                            ),
-                            in_place=True,
-                        )
+@dataclass(frozen=True)
+class _PreparedBatch:
+    file: str
+    start: int
+    total: int
+    users: pl.DataFrame
+    payload: bytes
+    content_encoding: str | None
+    digest: str
+    unchanged: pl.DataFrame | None = None
 
-                    break
-                except (
-                    httpx.HTTPError,
-                    ConnectionError,
-                    TimeoutError,
-                    RuntimeError,
-                ) as e:
-                    last_err = e
-                    tries = tries + 1
-                except (BadRequestError, UnprocessableContentError) as e:
-                    last_err = e
+
+def _envelope(options: ImportOptions, total: int) -> tuple[bytes, bytes]:
+    # The parts of the request body before and after the users
+    req: dict[str, typing.Any] = {
+        "totalRecords": total,
+        "deactivateMissingUsers": options.deactivate_missing_users,
+        "updateOnlyPresentFields": not options.update_all_fields,
+    }
+    if options.source_type:
+        req["sourceType"] = options.source_type
+
+    return (
+        b'{"users":[',
+        b"]," + json.dumps(req, ensure_ascii=False, separators=(",", ":"))[1:].encode(),
+    )
+
+
+def _payload(options: ImportOptions, total: int, users: pl.DataFrame) -> bytes:
+    (start, end) = _envelope(options, total)
+    return b"".join(
+        [
+            start,
+            users.select(pl.col("json").str.join(",").cast(pl.Binary)).item(),
+            end,
+        ],
+    )
+
+
+def _prepared_batch(
+    options: ImportOptions,
+    file: str,
+    start: int,
+    users: pl.DataFrame,
+    unchanged: pl.DataFrame | None = None,
+) -> _PreparedBatch:
+    payload = _payload(options, users.height, users)
+    return _PreparedBatch(
+        file,
+        start,
+        users.height,
+        users,
+        gzip.compress(payload, compresslevel=6)
+        if options.compress_requests
+        else payload,
+        "gzip" if options.compress_requests else None,
+        hashlib.blake2b(payload, digest_size=16).hexdigest(),
+        unchanged,
+    )
+
+
+def _with_starts(
+    batches: Iterator[tuple[str, int, pl.LazyFrame]],
+) -> Iterator[tuple[str, int, pl.LazyFrame]]:
+    # Swaps the number of rows in each batch for the row the batch starts at
+    starts: dict[str, int] = {}
+    for file, rows, b in batches:
+        start = starts.get(file, 0)
+        starts[file] = start + rows
+        yield (file, start, b)
+
+
+class _DeltaState:
+    # A fingerprint of every user's json from the last import keyed by
+    # externalSystemId. Users with the same fingerprint as last time aren't
+    # sent to FOLIO. The state is only replaced once the import finishes and
+    # only keeps the users FOLIO accepted, anyone else is sent again next time.
+    # The settings that change how FOLIO imports users are part of the
+    # fingerprint so changing them sends every user again.
+    _schema: typing.ClassVar = {
+        "externalSystemId": pl.Utf8,
+        "fingerprint": pl.UInt64,
+    }
+
+    def __init__(self, options: ImportOptions, path: Path) -> None:
+        self._path = path
+        self._settings = json.dumps(
+            [options.source_type, options.update_all_fields],
+        ).encode()
+        self._previous = (
+            pl.read_parquet(path).cast(self._schema)
+            if path.exists()
+            else pl.DataFrame([], schema=self._schema)
+        )
+        self._current: list[pl.DataFrame] = []
+
+    def _fingerprint(self, json: pl.Series) -> pl.Series:
+        # polars' own hash isn't stable between versions
+        return pl.Series(
+            [
+                None
+                if j is None
+                else int.from_bytes(
+                    hashlib.blake2b(
+                        self._settings + j.encode(), digest_size=8
+                    ).digest(),
+                )
+                for j in json
+            ],
+            dtype=pl.UInt64,
+        )
+
+    def split(self, users: pl.DataFrame) -> tuple[pl.DataFrame, pl.DataFrame]:
+        # The users that are new or changed and the ones that are unchanged
+        users = users.with_columns(
+            pl.col("json").map_batches(self._fingerprint).alias("fingerprint"),
+        )
+        return (
+            users.join(
+                self._previous,
+                on=["externalSystemId", "fingerprint"],
+                how="anti",
+                maintain_order="left",
+            ),
+            users.join(
+                self._previous,
+                on=["externalSystemId", "fingerprint"],
+                how="semi",
+            ).select(self._schema.keys()),
+        )
+
+    def record(self, batch: _PreparedBatch, results: ImportResults) -> None:
+        if batch.unchanged is not None:
+            self._current.append(batch.unchanged)
+        self._current.append(
+            batch.users.join(
+                results.failed_users,
+                on="username",
+                how="anti",
+            )
+            .select(self._schema.keys())
+            .drop_nulls(),
+        )
+
+    def save(self) -> None:
+        tmp = self._path.with_name(self._path.name + ".tmp")
+        pl.concat(
+            [pl.DataFrame([], schema=self._schema), *self._current],
+        ).unique("externalSystemId", keep="last").write_parquet(tmp)
+        tmp.replace(self._path)
+
+
+def _prepare_batch(
+    options: ImportOptions,
+    delta: _DeltaState | None,
+    file: str,
+    start: int,
+    b: pl.LazyFrame,
+) -> _PreparedBatch:
+    # json_decode's dtype isn't known until the data is collected
+    batch = _transform_batch(b).collect()
+    users = batch.select(
+        "username",
+        "externalSystemId",
+        _json_users(batch.schema).alias("json"),
+        (pl.int_range(pl.len(), dtype=pl.Int64) + start).alias("row"),
+    )
+
+    if delta is None:
+        return _prepared_batch(options, file, start, users)
+
+    (changed, unchanged) = delta.split(users)
+    return _prepared_batch(options, file, start, changed, unchanged)
+
+
+def _error_message(err: Exception) -> str:
+    # pyfolioclient replaces 400s with a generic message,
+    # the response body is what says which user is the problem
+    if (
+        isinstance(err, BadRequestError)
+        and isinstance(err.__cause__, httpx.HTTPStatusError)
+        and len(body := err.__cause__.response.text.strip()) > 0
+    ):
+        return f"{err}: {body}"
+    return str(err)
+
+
+class _AdaptiveBatchSize:
+    # Additive increase/multiplicative decrease of the batch size.
+    # Batches that come back within the target latency grow the size by
+    # min_batch_size, slow or failed batches halve it.
+    # Batches are read ahead of being sent so the feedback is always a few
+    # batches behind, the size is only grown by batches that were cut at the
+    # current size and only shrunk relative to the batch that was slow.
+    def __init__(self, options: ImportOptions) -> None:
+        self._options = options
+        self._lock = threading.Lock()
+        self._size = min(
+            options.max_batch_size,
+            max(options.min_batch_size, options.batch_size),
+        )
+
+    def __call__(self) -> int:
+        return self._size
+
+    def observe(self, users: int, latency: float, *, ok: bool) -> None:
+        with self._lock:
+            size = self._size
+            if not ok or latency > self._options.target_latency:
+                size = max(self._options.min_batch_size, min(size, users // 2))
+            elif users >= size:
+                size = min(
+                    self._options.max_batch_size,
+                    size + self._options.min_batch_size,
+                )
+
+            _log.info(
+                "Batch of %d users %s in %.3fs, batch size is now %d",
+                users,
+                "succeeded" if ok else "failed",
+                latency,
+                size,
+            )
+            self._size = size
+
+
+class _CircuitBreaker:
+    # Opens after circuit_breaker_threshold batches in a row fail to reach
+    # FOLIO, no matter which batch or thread they were sent from.
+    # While open every batch waits for the cooldown before being sent.
+    # After the cooldown a single failure is enough to open it again.
+    def __init__(self, options: ImportOptions) -> None:
+        self._threshold = options.circuit_breaker_threshold
+        self._cooldown = options.circuit_breaker_cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+
+    def wait(self) -> float:
+        with self._lock:
+            wait = self._open_until - time.monotonic()
+        if wait <= 0:
+            return 0.0
+
+        time.sleep(wait)
+        return wait
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self._failures = 0
+
+    def failed(self) -> None:
+        if self._threshold is None:
+            return
+
+        with self._lock:
+            self._failures += 1
+            if self._failures < self._threshold:
+                return
+
+            self._failures = self._threshold - 1
+            self._open_until = max(
+                self._open_until,
+                time.monotonic() + self._cooldown,
+            )
+            _log.warning(
+                "Could not reach FOLIO %d times in a row, pausing for %.1fs",
+                self._threshold,
+                self._cooldown,
+            )
+
+
+def _backoff(options: ImportOptions, tries: int) -> float:
+    # Exponential backoff with full jitter so concurrent batches that
+    # failed together don't all retry at the same moment.
+    if options.retry_backoff <= 0:
+        return 0.0
+
+    wait = random.uniform(  # noqa: S311
+        0,
+        min(options.max_retry_backoff, options.retry_backoff * 2 ** (tries - 1)),
+    )
+    _log.info("Retrying batch in %.3fs after %d failed tries", wait, tries)
+    time.sleep(wait)
+    return wait
+
+
+class _DeferredBatches:
+    # Batches that still can't reach FOLIO after every retry are parked on
+    # disk instead of failing. Once everything else has been sent their users
+    # are regrouped into full batches for each file and sent again.
+    # The parked batches are read back one at a time so only about a batch
+    # of users is in memory no matter how many were parked.
+    def __init__(self, directory: Path) -> None:
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._parked = 0
+        self._files: dict[str, list[Path]] = {}
+
+    def park(self, batch: _PreparedBatch) -> None:
+        with self._lock:
+            part = self._directory / f"{self._parked:08d}.parquet"
+            self._parked += 1
+            self._files.setdefault(batch.file, []).append(part)
+
+        batch.users.write_parquet(part)
+        _log.warning(
+            "Deferring %d users from %s to the end of the import",
+            batch.total,
+            batch.file,
+        )
+
+    def batches(
+        self,
+        options: ImportOptions,
+        batch_size: Callable[[], int],
+    ) -> Iterator[_PreparedBatch]:
+        max_users_bytes = _max_users_bytes(options)
+        for file, parts in self._files.items():
+            parked = (pl.read_parquet(p) for p in parts)
+            users = next(parked)
+            while True:
+                rows = min(users.height, batch_size())
+                if max_users_bytes is not None:
+                    fits = (
+                        (users["json"].str.len_bytes() + 1)
+                        .cum_sum()
+                        .search_sorted(max_users_bytes, side="right")
+                    )
+                    rows = max(1, min(rows, fits))
+                if rows == users.height:
+                    # the next parked batch may fill the rest of this one
+                    more = next(parked, None)
+                    if more is not None:
+                        users = pl.concat([users, more])
+                        continue
+                if users.height == 0:
                     break
 
-            if last_err is not None:
-                import_results.failed_records += total
+                # The users don't come from a single range of rows
+                # so the batch starts at 0 and it isn't journaled.
+                yield _prepared_batch(options, file, 0, users.head(rows))
+                users = users.slice(rows)
+
+
+@dataclass(frozen=True)
+class _Feedback:
+    # Shared by every batch so how FOLIO responds to one batch
+    # changes how the batches after it are sent.
+    breaker: _CircuitBreaker
+    batch_size: _AdaptiveBatchSize | None = None
+    deferred: _DeferredBatches | None = None
+
+    def responded(self, users: int, latency: float) -> None:
+        self.breaker.succeeded()
+        if self.batch_size is not None:
+            self.batch_size.observe(users, latency, ok=True)
+
+    def unreachable(self, users: int, latency: float) -> None:
+        self.breaker.failed()
+        if self.batch_size is not None:
+            self.batch_size.observe(users, latency, ok=False)
+
+
+def _rejected_users(
+    batch: _PreparedBatch,
+    failed_users: list[dict[str, typing.Any]],
+) -> pl.DataFrame:
+    # The users FOLIO failed matched back to the rows they were read from
+    return (
+        pl.DataFrame(
+            failed_users,
+            schema={
+                "username": pl.Utf8,
+                "externalSystemId": pl.Utf8,
+                "errorMessage": pl.Utf8,
+            },
+        )
+        .with_columns(pl.lit(batch.file).alias("source"))
+        .join(
+            batch.users.select("username", "row").unique(
+                "username",
+                keep="first",
+                maintain_order=True,
+            ),
+            on="username",
+            how="left",
+            maintain_order="left",
+        )
+    )
+
+
+# A rejected batch is split at most enough times to single out this many
+# users in it, a batch that is rejected as a whole doesn't cost a request
+# for every user in it.
+_BISECT_USERS = 2
+
+
+class _Bisections:
+    # The splits left for a rejected batch, shared by the halves it's split into
+    def __init__(self, users: int) -> None:
+        self._left = _BISECT_USERS * (users - 1).bit_length()
+
+    def take(self) -> bool:
+        if self._left == 0:
+            return False
+        self._left -= 1
+        return True
+
+
+def _import_batch(
+    folio: FolioClient,
+    options: ImportOptions,
+    batch: _PreparedBatch,
+    feedback: _Feedback,
+    bisections: _Bisections | None = None,
+) -> tuple[ImportResults, bool]:
+    # Also returns whether FOLIO responded for every user in the batch
+    import_results = ImportResults()
+
+    last_err: Exception | None = None
+    tries = 0
+    while tries < 1 + options.retry_count:
+        if tries > 0:
+            import_results.backoff_seconds += _backoff(options, tries)
+        import_results.backoff_seconds += feedback.breaker.wait()
+
+        last_err = None
+        start = time.perf_counter()
+        try:
+            res = folio.post_json(
+                "/user-import",
+                batch.payload,
+                content_encoding=batch.content_encoding,
+                users=batch.total,
+            )
+            feedback.responded(batch.total, time.perf_counter() - start)
+            if isinstance(res, int):
+                res_err = f"Expected json but got http code {res}"
+                raise TypeError(res_err)
+
+            import_results.created_records += int(res["createdRecords"])
+            import_results.updated_records += int(res["updatedRecords"])
+            import_results.failed_records += int(res["failedRecords"])
+            if any(res.get("failedUsers", [])):
                 import_results.failed_users.vstack(
-                    batch.select("username", "externalSystemId").with_columns(
-                        pl.lit(str(last_err)).alias("errorMessage"),
-                        pl.lit(file).alias("source"),
-                    ),
+                    _rejected_users(batch, res["failedUsers"]),
                     in_place=True,
                 )
 
+            break
+        except (
+            httpx.HTTPError,
+            ConnectionError,
+            TimeoutError,
+            RuntimeError,
+        ) as e:
+            feedback.unreachable(batch.total, time.perf_counter() - start)
+            last_err = e
+            tries = tries + 1
+        except (BadRequestError, UnprocessableContentError) as e:
+            feedback.breaker.succeeded()
+            if options.bisect_rejected_batches and batch.total > 1:
+                bisections = bisections or _Bisections(batch.total)
+                if bisections.take():
+                    return _bisect_batch(folio, options, batch, feedback, bisections)
+            last_err = e
+            break
+
+    acknowledged = last_err is None or isinstance(
+        last_err,
+        (BadRequestError, UnprocessableContentError),
+    )
+    if not acknowledged and feedback.deferred is not None:
+        feedback.deferred.park(batch)
+        import_results.deferred_records += batch.total
+    elif last_err is not None:
+        import_results.failed_records += batch.total
+        import_results.failed_users.vstack(
+            batch.users.select(
+                "username",
+                "externalSystemId",
+                pl.lit(_error_message(last_err)).alias("errorMessage"),
+                pl.lit(batch.file).alias("source"),
+                "row",
+            ),
+            in_place=True,
+        )
+
+    return (import_results, acknowledged)
+
+
+def _bisect_batch(
+    folio: FolioClient,
+    options: ImportOptions,
+    batch: _PreparedBatch,
+    feedback: _Feedback,
+    bisections: _Bisections,
+) -> tuple[ImportResults, bool]:
+    # A rejected batch is split in half and each half is imported by itself.
+    # The halves that are rejected again keep being split until only the
+    # offending users are left, each failing with their own error message.
+    # Once the splits run out the rejected halves fail as a whole.
+    half = batch.total // 2
+    import_results = ImportResults()
+    acknowledged = True
+    for start, users in [
+        (batch.start, batch.users.head(half)),
+        (batch.start + half, batch.users.slice(half)),
+    ]:
+        (half_results, half_acknowledged) = _import_batch(
+            folio,
+            options,
+            _prepared_batch(options, batch.file, start, users),
+            feedback,
+            bisections,
+        )
+        import_results += half_results
+        acknowledged = acknowledged and half_acknowledged
+    return (import_results, acknowledged)
+
+
+class _Journal:
+    # An append only tsv of the batches FOLIO has responded to.
+    # Batches are identified by the file, the rows they cover, and a hash of
+    # the request so a batch is only skipped when resuming if it is exactly
+    # the same as what was sent before.
+    _header = ("file", "start", "end", "hash")
+
+    def __init__(self, options: ImportOptions) -> None:
+        self._completed: set[tuple[str, ...]] = set()
+        if options.resume is not None:
+            with options.resume.open(newline="") as f:
+                self._completed = {
+                    tuple(r) for r in csv.reader(f, dialect=csv.excel_tab)
+                } - {self._header}
+
+        self._writer = None
+        self._stack = ExitStack()
+        if options.journal is not None:
+            new = not options.journal.exists()
+            f = self._stack.enter_context(
+                options.journal.open("a", newline="", buffering=1),
+            )
+            self._writer = csv.writer(f, dialect=csv.excel_tab)
+            if new:
+                self._writer.writerow(self._header)
+
+    @staticmethod
+    def _entry(batch: _PreparedBatch) -> tuple[str, ...]:
+        return (
+            batch.file,
+            str(batch.start),
+            str(batch.start + batch.total),
+            batch.digest,
+        )
+
+    def completed(self, batch: _PreparedBatch) -> bool:
+        if self._entry(batch) not in self._completed:
+            return False
+
+        # the new journal is complete by itself and can be resumed from
+        self.record(batch)
+        return True
+
+    def record(self, batch: _PreparedBatch) -> None:
+        if self._writer is not None:
+            self._writer.writerow(self._entry(batch))
+
+    def close(self) -> None:
+        self._stack.close()
+
+
+def _max_users_bytes(options: ImportOptions) -> int | None:
+    # The space left for users once the rest of the request body is accounted for
+    if options.max_batch_bytes is None:
+        return None
+    return max(
+        1,
+        options.max_batch_bytes
+        - sum(
+            len(e)
+            for e in _envelope(
+                options,
+                max(options.batch_size, options.max_batch_size)
+                if options.adaptive_batch_size
+                else options.batch_size,
+            )
+        ),
+    )
+
+
+def _drop_noops(
+    folio: FolioClient,
+    options: ImportOptions,
+    refs: _user_diff.References,
+    batch: _PreparedBatch,
+) -> tuple[_PreparedBatch, int]:
+    # Drops the users that are already the same in FOLIO
+    # and returns how many were dropped.
+    current = _user_diff.fetch_users(
+        folio,
+        batch.users["externalSystemId"].drop_nulls(),
+        options.source_type,
+    )
+    noop = pl.Series(
+        [
+            e is not None
+            and _user_diff.is_noop(
+                json.loads(j),
+                current.get(e),
+                refs,
+                update_all_fields=options.update_all_fields,
+            )
+            for (e, j) in batch.users.select("externalSystemId", "json").iter_rows()
+        ],
+        dtype=pl.Boolean,
+    )
+    if not noop.any():
+        return (batch, 0)
+
+    return (
+        _prepared_batch(
+            options,
+            batch.file,
+            batch.start,
+            batch.users.filter(~noop),
+            batch.unchanged,
+        ),
+        int(noop.sum()),
+    )
+
+
+# Comparing users to FOLIO is only an optimization,
+# when it fails the users are sent without being compared.
+_COMPARE_ERRORS = (
+    httpx.HTTPError,
+    ConnectionError,
+    TimeoutError,
+    RuntimeError,
+    BadRequestError,
+    UnprocessableContentError,
+)
+
+
+def _references(folio: FolioClient) -> _user_diff.References | None:
+    try:
+        return _user_diff.References.fetch(folio)
+    except _COMPARE_ERRORS as e:
+        _log.warning("Could not compare users to FOLIO: %s", e)
+        return None
+
+
+def _send_batch(
+    folio: FolioClient,
+    options: ImportOptions,
+    refs: _user_diff.References | None,
+    batch: _PreparedBatch,
+    feedback: _Feedback,
+) -> tuple[ImportResults, bool]:
+    noops = 0
+    if refs is not None:
+        try:
+            (batch, noops) = _drop_noops(folio, options, refs, batch)
+        except _COMPARE_ERRORS as e:
+            # The users are still sent, they just might not need to be
+            _log.warning("Could not compare users to FOLIO: %s", e)
+
+    (import_results, acknowledged) = (
+        _import_batch(folio, options, batch, feedback)
+        if batch.total > 0
+        else (ImportResults(), True)
+    )
+    import_results.unchanged_records += noops
+    return (import_results, acknowledged)
+
+
+def _skip_batch(
+    batch: _PreparedBatch,
+    journal: _Journal,
+    delta: _DeltaState | None,
+    import_results: ImportResults,
+) -> bool:
+    skipped = ImportResults()
+    if batch.unchanged is not None:
+        skipped.unchanged_records += batch.unchanged.height
+
+    if batch.total == 0:
+        if delta is not None:
+            delta.record(batch, ImportResults())
+    elif journal.completed(batch):
+        skipped.skipped_records += batch.total
+
+    import_results += _of_file(batch.file, skipped)
+    return batch.total == 0 or skipped.skipped_records > 0
+
+
+# How many failed users are kept in the results when they are written to a file
+_FAILED_USERS_SAMPLE = 10
+
+
+class _FailedUsers:
+    # Failed users are written out as each batch finishes so they are never
+    # all held in memory and aren't lost if the import crashes.
+    # The format is based on the suffix: .parquet, .ndjson, or csv otherwise.
+    # Parquet files can't be appended to, each batch is written to its own
+    # file in a directory next to it and they're combined once it's closed.
+    _columns: typing.ClassVar = [
+        "source",
+        "username",
+        "externalSystemId",
+        "errorMessage",
+        "row",
+    ]
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._stack = ExitStack()
+        self._parts = path.with_name(path.name + ".parts")
+        self._written = 0
+        if path.suffix == ".parquet":
+            self._parts.mkdir(parents=True, exist_ok=True)
+            return
+
+        self._file = self._stack.enter_context(path.open("wb"))
+        if path.suffix != ".ndjson":
+            ImportResults().failed_users.select(self._columns).write_csv(self._file)
+            self._file.flush()
+
+    def write(self, failed_users: pl.DataFrame) -> None:
+        if failed_users.is_empty():
+            return
+
+        failed_users = failed_users.select(self._columns)
+        if self._path.suffix == ".parquet":
+            failed_users.write_parquet(self._parts / f"{self._written:08d}.parquet")
+        elif self._path.suffix == ".ndjson":
+            failed_users.write_ndjson(self._file)
+        else:
+            failed_users.write_csv(self._file, include_header=False)
+
+        if self._path.suffix != ".parquet":
+            self._file.flush()
+        self._written += 1
+
+    def scan(self) -> pl.LazyFrame:
+        if self._written == 0:
+            return ImportResults().failed_users.lazy()
+        if self._path.suffix == ".parquet":
+            return pl.scan_parquet(self._path)
+        # The types aren't guessed, a file named 2024.csv has the source "2024"
+        schema = ImportResults().failed_users.select(self._columns).schema
+        if self._path.suffix == ".ndjson":
+            return pl.scan_ndjson(self._path, schema=schema)
+        return pl.scan_csv(self._path, schema=schema)
+
+    def close(self) -> None:
+        self._stack.close()
+        if self._path.suffix == ".parquet":
+            parts = sorted(self._parts.glob("*.parquet"))
+            (
+                pl.scan_parquet(parts)
+                if len(parts) > 0
+                else ImportResults().failed_users.select(self._columns).lazy()
+            ).sink_parquet(self._path)
+            shutil.rmtree(self._parts)
+
+
+def _write_rejects(
+    options: ImportOptions,
+    rejects: Path,
+    failed_users: pl.LazyFrame,
+) -> None:
+    # The rows of failed users as they were read with the reason they failed.
+    # Each file's rejects can be imported again in place of the original.
+    failed_users = (
+        failed_users.filter(pl.col("row").is_not_null())
+        .select("source", pl.col("row").cast(pl.Int64), ERROR_MESSAGE)
+        .unique(["source", "row"], keep="first")
+    )
+    data = InputData(options)
+    for (source,) in (
+        failed_users.select("source").unique(maintain_order=True).collect().iter_rows()
+    ):
+        rejects.mkdir(parents=True, exist_ok=True)
+        data.scan_raw(source).with_columns(pl.col("row").cast(pl.Int64)).join(
+            failed_users.filter(pl.col("source") == source).drop("source"),
+            on="row",
+        ).sort("row").drop("row").collect().write_csv(rejects / f"{source}.csv")
+
+
+class _InFlight:
+    # Batches that have been sent to FOLIO but not accounted for yet.
+    # Only options.concurrency batches are in flight at a time and results
+    # are added together in the order the batches were sent.
+    def __init__(
+        self,
+        options: ImportOptions,
+        journal: _Journal | None,
+        delta: _DeltaState | None,
+        failed_users: _FailedUsers | None,
+        import_results: ImportResults,
+    ) -> None:
+        self._concurrency = options.concurrency
+        self._journal = journal
+        self._delta = delta
+        self._failed_users = failed_users
+        self._import_results = import_results
+        self._in_flight: deque[
+            tuple[_PreparedBatch, Future[tuple[ImportResults, bool]]]
+        ] = deque()
+
+    def _done(self) -> None:
+        (batch, future) = self._in_flight.popleft()
+        (batch_results, acknowledged) = future.result()
+        if acknowledged:
+            if self._journal is not None:
+                self._journal.record(batch)
+            if self._delta is not None:
+                self._delta.record(batch, batch_results)
+
+        if self._failed_users is not None:
+            self._failed_users.write(batch_results.failed_users)
+            batch_results.failed_users = batch_results.failed_users.head(
+                max(
+                    0,
+                    _FAILED_USERS_SAMPLE - self._import_results.failed_users.height,
+                ),
+            )
+        self._import_results += _of_file(batch.file, batch_results)
+
+    def send(
+        self,
+        batch: _PreparedBatch,
+        future: Future[tuple[ImportResults, bool]],
+    ) -> None:
+        if len(self._in_flight) >= self._concurrency:
+            self._done()
+        self._in_flight.append((batch, future))
+
+    def wait(self) -> None:
+        while len(self._in_flight) > 0:
+            self._done()
+
+
+def run(options: ImportOptions) -> ImportResults:
+    """Import users into FOLIO.
+
+    Reading, transforming, and sending the data happen in separate stages.
+    Upcoming batches are read and prepared on background threads while
+    up to options.concurrency batches are sent to FOLIO at the same time.
+    Each stage only buffers a few batches so memory use stays bounded.
+    Results are added together in the order the batches were read.
+    Up to options.file_concurrency files are read at the same time,
+    starting with the largest, their batches are sent in the order they're
+    ready. Results are also kept for each file.
+
+    With options.adaptive_batch_size the batch size starts at
+    options.batch_size and is adjusted between options.min_batch_size and
+    options.max_batch_size based on how quickly FOLIO responds.
+
+    Batches FOLIO responds to are recorded in options.journal.
+    Batches recorded in the options.resume journal are skipped as long as
+    the batch and its contents are the same, which requires the same
+    input files and batch settings as the import being resumed.
+
+    Failed users are written to options.failed_users as batches finish,
+    when it is set the results only keep a sample of them.
+    Each file with failed users gets a file in options.rejects with the
+    rows of the failed users as they were read and an errorMessage column.
+    Rejects files can be imported again, errorMessage is ignored when reading.
+
+    With options.delta_state only users that are new or have changed since
+    the last import using the same delta_state are sent to FOLIO. Every user
+    is sent when options.source_type or options.update_all_fields change.
+    With options.diff_against_folio the users in each batch are fetched from
+    FOLIO first and only users with differences are sent.
+
+    Batches that fail to reach FOLIO are retried up to options.retry_count
+    times, waiting a random amount of time up to options.retry_backoff
+    seconds, doubling with each try, up to options.max_retry_backoff.
+    Once options.circuit_breaker_threshold batches in a row fail to reach
+    FOLIO all batches wait options.circuit_breaker_cooldown seconds.
+    With options.defer_failed_batches batches that still fail are regrouped
+    and sent again once all the other batches have been sent. The regrouped
+    batches are retried as usual and their users fail if they still can't
+    be sent. They aren't recorded in the journal.
+    """
+    batch_size = _AdaptiveBatchSize(options) if options.adaptive_batch_size else None
+    failed_users = (
+        None if options.failed_users is None else _FailedUsers(options.failed_users)
+    )
+    delta = (
+        None
+        if options.delta_state is None
+        else _DeltaState(options, options.delta_state)
+    )
+    import_results = ImportResults()
+
+    with (
+        Folio(options).connect() as folio,
+        ThreadPoolExecutor(max_workers=options.concurrency) as executor,
+        closing(_Journal(options)) as journal,
+        ExitStack() as stack,
+    ):
+        in_flight = _InFlight(
+            options,
+            journal,
+            delta,
+            None
+            if failed_users is None
+            else stack.enter_context(closing(failed_users)),
+            import_results,
+        )
+        feedback = _Feedback(
+            _CircuitBreaker(options),
+            batch_size,
+            _DeferredBatches(Path(stack.enter_context(tempfile.TemporaryDirectory())))
+            if options.defer_failed_batches
+            else None,
+        )
+        refs = _references(folio) if options.diff_against_folio else None
+        batches = _pipeline.merge(
+            (
+                _pipeline.stage(
+                    _pipeline.prefetch(
+                        _with_starts(
+                            data.batch(
+                                options.batch_size
+                                if batch_size is None
+                                else batch_size,
+                                _max_users_bytes(options),
+                            ),
+                        ),
+                        options.concurrency,
+                    ),
+                    lambda b: _prepare_batch(options, delta, *b),
+                    options.concurrency,
+                )
+                for data in InputData(options).files()
+            ),
+            options.file_concurrency,
+            options.concurrency,
+        )
+        with closing(batches):
+            for batch in batches:
+                if _skip_batch(batch, journal, delta, import_results):
+                    continue
+                in_flight.send(
+                    batch,
+                    executor.submit(
+                        _send_batch,
+                        folio,
+                        options,
+                        refs,
+                        batch,
+                        feedback,
+                    ),
+                )
+        in_flight.wait()
+
+        if feedback.deferred is not None:
+            # Batches that fail this time aren't deferred again
+            retry = replace(feedback, deferred=None)
+            # Resuming sends the users of deferred batches again
+            in_flight = _InFlight(
+                options,
+                None,
+                delta,
+                failed_users,
+                import_results,
+            )
+            for batch in feedback.deferred.batches(
+                options,
+                (lambda: options.batch_size) if batch_size is None else batch_size,
+            ):
+                in_flight.send(
+                    batch,
+                    executor.submit(_import_batch, folio, options, batch, retry),
+                )
+            in_flight.wait()
+
+    if delta is not None:
+        delta.save()
+
+    if options.rejects is not None:
+        _write_rejects(
+            options,
+            options.rejects,
+            import_results.failed_users.lazy()
+            if failed_users is None
+            else failed_users.scan(),
+        )
+
     import_results.failed_users = import_results.failed_users.select(
         "source",
         "username",
         "externalSystemId",
         "errorMessage",
+        "row",
     ).rechunk()
     return import_results
@@ -1,14 +1,214 @@
 """Input data related utils for managing users."""
 
-from collections.abc import Iterator
+import gzip
+import io
+import itertools
+import math
+import random
+import typing
+from collections.abc import Callable, Iterable, Iterator
 from dataclasses import dataclass
 from pathlib import Path
 
 import pandera.polars as pla
 import polars as pl
+from pandera.constants import CHECK_OUTPUT_KEY
 
+from . import _fused_validation
 from .schemas import UserImportSchema
 
+# Rejects files are the original data with the reason each user failed,
+# the reason is dropped when they are read back in.
+ERROR_MESSAGE = "errorMessage"
+
+# Files are read based on their suffix, anything else is read as a csv
+_COMPRESSED = frozenset([".csv.gz", ".csv.zst"])
+SUFFIXES = frozenset([".csv", ".parquet", ".arrow", ".ipc", ".ndjson", *_COMPRESSED])
+_IPC = frozenset([".arrow", ".ipc"])
+
+# Dates in json are strings, csvs have their dates parsed while being read
+_DATES = ["enrollmentDate", "expirationDate", "personal_dateOfBirth"]
+
+# Parquet row groups are decoded whole even when only a few of their rows
+# are read. Files are read at least this many rows at a time, the default
+# row group size of polars, so each group is only decoded about once.
+_PARQUET_WINDOW = 512**2
+
+# Data is checked this many rows at a time
+_CHECK_CHUNK_SIZE = 100_000
+
+# Columns that have to be unique across every chunk of a file
+_UNIQUE = [n for n, c in UserImportSchema.to_schema().columns.items() if c.unique]
+
+# Rows being checked keep the row of the file they were read from
+_ROW = "__ube_row"
+
+
+def suffix(path: Path) -> str:
+    """The suffix of an input file, including the compression if there is one."""
+    compressed = "".join(path.suffixes[-2:])
+    return compressed if compressed in _COMPRESSED else path.suffix
+
+
+def stem(path: Path) -> str:
+    """The name of an input file without its suffix or compression."""
+    return path.name.removesuffix(suffix(path))
+
+
+@dataclass(frozen=True)
+class Sample:
+    """A sample of the rows of every input file to check.
+
+    A number of rows is a reservoir sample of the whole file, a fraction is a
+    stratified sample of that fraction of the rows of every chunk.
+    The same seed always samples the same rows, a random one is used if None.
+    """
+
+    rows: int | None = None
+    fraction: float | None = None
+    seed: int | None = None
+
+
+class _Sampler:
+    # Numbers the rows of a file's chunks and picks the ones to check.
+    # Rows are sampled by the hash of their row number, the rows with the
+    # smallest hashes are a uniformly random sample without keeping them all.
+    def __init__(self, sample: Sample | None) -> None:
+        self._sample = sample
+        self._seed = (
+            sample.seed
+            if sample is not None and sample.seed is not None
+            else random.getrandbits(32)
+        )
+        self.read = 0
+
+    def _smallest(self, rows: pl.DataFrame, n: int) -> pl.DataFrame:
+        return rows.bottom_k(n, by=pl.col(_ROW).hash(self._seed)).sort(_ROW)
+
+    def sample(self, chunks: Iterable[pl.DataFrame]) -> Iterator[pl.DataFrame]:
+        reservoir: pl.DataFrame | None = None
+        for chunk in chunks:
+            rows = chunk.with_row_index(_ROW, self.read)
+            self.read += chunk.height
+            if self._sample is None:
+                yield rows
+            elif self._sample.rows is None:
+                yield self._smallest(
+                    rows,
+                    math.ceil(chunk.height * (self._sample.fraction or 1)),
+                )
+            else:
+                reservoir = self._smallest(
+                    rows
+                    if reservoir is None
+                    else pl.concat([reservoir, rows], how="vertical_relaxed"),
+                    self._sample.rows,
+                )
+
+        if reservoir is not None:
+            yield reservoir
+
+
+class _Validation:
+    # Validates a file a chunk at a time. Only the unique values seen so far
+    # and the errors found are kept between chunks.
+    def __init__(self, engine: str, max_errors: int | None = None) -> None:
+        self._engine = engine
+        self._max_errors = max_errors
+        self._schema = UserImportSchema.to_schema()
+        self._seen: dict[str, set[typing.Any]] = {c: set() for c in _UNIQUE}
+        self._reported: set[tuple[typing.Any, ...]] = set()
+        self._errors: list[pla.errors.SchemaError] = []
+        self._failure_cases: list[pl.DataFrame] = []
+        self.rows = 0
+        self.failures = 0
+        self._empty: pl.LazyFrame | None = None
+
+    @property
+    def empty(self) -> bool:
+        return self._empty is None
+
+    @property
+    def stopped(self) -> bool:
+        return self._max_errors is not None and self.failures >= self._max_errors
+
+    def _duplicates(self, chunk: pl.DataFrame) -> Iterator[pla.errors.SchemaError]:
+        # Values already seen in an earlier chunk,
+        # duplicates within the chunk are found by the schema.
+        for c in (c for c in _UNIQUE if c in chunk.columns):
+            values = chunk[c].to_list()
+            duplicated = pl.Series(
+                CHECK_OUTPUT_KEY,
+                [v is not None and v in self._seen[c] for v in values],
+                dtype=pl.Boolean,
+            )
+            self._seen[c].update(v for v in values if v is not None)
+            if not duplicated.any():
+                continue
+
+            failure_cases = chunk.filter(duplicated).select(c)
+            yield pla.errors.SchemaError(  # type: ignore[no-untyped-call]
+                self._schema.columns[c],
+                None,
+                f"column '{c}' not unique:\n{failure_cases}",
+                failure_cases=failure_cases,
+                check="field_uniqueness",
+                check_output=duplicated.not_().to_frame(),
+                reason_code=pla.errors.SchemaErrorReason.SERIES_CONTAINS_DUPLICATES,
+            )
+
+    def _new(self, error: pla.errors.SchemaError) -> bool:
+        # Errors about the data as a whole rather than its rows
+        # are found in every chunk, they're only reported once.
+        if isinstance(error.failure_cases, pl.DataFrame):
+            return True
+        key = (error.reason_code, error.schema.name, str(error.check))
+        if key in self._reported:
+            return False
+        self._reported.add(key)
+        return True
+
+    def validate(self, rows: pl.DataFrame) -> None:
+        chunk = rows.drop(_ROW)
+        errors: list[pla.errors.SchemaError] = []
+        if self._engine == "polars":
+            errors = _fused_validation.validate(self._schema, chunk)
+        else:
+            try:
+                UserImportSchema.validate(chunk, lazy=True)
+            except pla.errors.SchemaError as se:
+                errors = [se]
+            except pla.errors.SchemaErrors as se:
+                errors = se.schema_errors
+
+        errors = [*filter(self._new, errors), *self._duplicates(chunk)]
+        if len(errors) > 0:
+            # The rows of failure cases are numbered from the start of the file
+            failure_cases = (
+                self._schema.get_backend(chunk.lazy())
+                .failure_cases_metadata(self._schema.name, errors)
+                .failure_cases.with_columns(
+                    pl.lit(rows[_ROW])
+                    .gather(pl.col("index"))
+                    .cast(pl.Int32)
+                    .alias("index"),
+                )
+            )
+            self._failure_cases.append(failure_cases)
+            self.failures += failure_cases.height
+            self._errors.extend(errors)
+
+        self.rows += chunk.height
+        self._empty = chunk.clear().lazy()
+
+    def errors(self) -> pla.errors.SchemaErrors | None:
+        if len(self._errors) == 0:
+            return None
+
+        errors = pla.errors.SchemaErrors(self._schema, self._errors, self._empty)
+        errors.failure_cases = pl.concat(self._failure_cases)
+        return errors
+
 
 @dataclass(frozen=True)
 class InputDataOptions:
@@ -26,80 +226,415 @@ class InputData:
 
     @classmethod
     def _scan_csv(cls, path: Path, ignore_errors: bool = False) -> pl.LazyFrame:
+        if suffix(path) in _COMPRESSED:
+            # polars can't scan compressed csvs, they're decompressed in memory
+            return (
+                pl.read_csv(
+                    path,
+                    comment_prefix="#",
+                    ignore_errors=ignore_errors,
+                    try_parse_dates=True,
+                    schema_overrides={"barcode": pl.Utf8},
+                )
+                .lazy()
+                .drop(ERROR_MESSAGE, strict=False)
+            )
+
         return pl.scan_csv(
             path,
             comment_prefix="#",
             ignore_errors=ignore_errors,
             try_parse_dates=True,
             schema_overrides={"barcode": pl.Utf8},
+        ).drop(ERROR_MESSAGE, strict=False)
+
+    @classmethod
+    def _parse_dates[T: (pl.DataFrame, pl.LazyFrame)](
+        cls,
+        data: T,
+        schema: pl.Schema,
+        ignore_errors: bool = False,
+    ) -> T:
+        return data.with_columns(
+            pl.col(c).str.to_date("%Y-%m-%d", strict=not ignore_errors)
+            for c in _DATES
+            if schema.get(c) == pl.Utf8
         )
 
-    def batch(
-        self,
+    @classmethod
+    def _scan(cls, path: Path, ignore_errors: bool = False) -> pl.LazyFrame:
+        if path.suffix == ".parquet":
+            data = pl.scan_parquet(path)
+        elif path.suffix in _IPC:
+            data = pl.scan_ipc(path, memory_map=True)
+        elif path.suffix == ".ndjson":
+            data = pl.scan_ndjson(
+                path,
+                infer_schema_length=None,
+                ignore_errors=ignore_errors,
+            )
+            data = cls._parse_dates(data, data.collect_schema(), ignore_errors)
+        else:
+            return cls._scan_csv(path, ignore_errors)
+
+        return data.drop(ERROR_MESSAGE, strict=False)
+
+    @classmethod
+    def _read_csv(
+        cls,
+        path: Path,
         batch_size: int,
-    ) -> Iterator[tuple[str, int, pl.LazyFrame]]:
-        """Streams input data in batches up to batch_size."""
-        for f, p in (
+        ignore_errors: bool = False,
+    ) -> Iterator[pl.DataFrame]:
+        reader = pl.read_csv_batched(
+            path,
+            comment_prefix="#",
+            ignore_errors=ignore_errors,
+            try_parse_dates=True,
+            schema_overrides={"barcode": pl.Utf8},
+            batch_size=batch_size,
+        )
+        while (chunks := reader.next_batches(1)) is not None:
+            yield from (c.drop(ERROR_MESSAGE, strict=False) for c in chunks)
+
+    @classmethod
+    def _open(cls, path: Path) -> typing.BinaryIO:
+        if path.suffix == ".gz":
+            return typing.cast("typing.BinaryIO", gzip.open(path, "rb"))
+
+        try:
+            import zstandard
+        except ImportError as e:
+            zstd = (
+                f"Reading {path} requires zstandard, "
+                "install folio-user-bulk-edit[zstd] to read .zst files"
+            )
+            raise ImportError(zstd) from e
+
+        return io.BufferedReader(
+            typing.cast(
+                "io.RawIOBase",
+                zstandard.ZstdDecompressor().stream_reader(
+                    path.open("rb"),
+                    closefd=True,
+                ),
+            ),
+        )
+
+    @classmethod
+    def _read_compressed(
+        cls,
+        path: Path,
+        batch_size: int,
+        ignore_errors: bool = False,
+    ) -> Iterator[pl.DataFrame]:
+        # The file is decompressed as it is read and parsed batch_size lines at
+        # a time, the header is repeated for every chunk. Every chunk after
+        # the first is read with the first one's schema, the same as the
+        # batched csv reader.
+        with cls._open(path) as f:
+            lines = itertools.dropwhile(lambda line: line.startswith(b"#"), f)
+            if (header := next(lines, None)) is None:
+                return
+
+            schema: pl.Schema | None = None
+            while len(chunk := list(itertools.islice(lines, batch_size))) > 0:
+                # Quoted values can span lines,
+                # the chunk is extended until every quote is closed.
+                quotes = sum(line.count(b'"') for line in chunk)
+                while quotes % 2 == 1 and (line := next(lines, None)) is not None:
+                    chunk.append(line)
+                    quotes += line.count(b'"')
+
+                data = pl.read_csv(
+                    io.BytesIO(header + b"".join(chunk)),
+                    comment_prefix="#",
+                    ignore_errors=ignore_errors,
+                    try_parse_dates=schema is None,
+                    schema_overrides={"barcode": pl.Utf8} if schema is None else None,
+                    schema=schema,
+                )
+                schema = data.schema
+                yield data.drop(ERROR_MESSAGE, strict=False)
+
+    @classmethod
+    def _read_ndjson(
+        cls,
+        path: Path,
+        batch_size: int,
+        ignore_errors: bool = False,
+    ) -> Iterator[pl.DataFrame]:
+        # Every chunk is read with the schema of the whole file
+        # so a column that is null in one chunk has the same type as the rest.
+        # Unlike a csv header the first chunk doesn't have every column,
+        # any line can leave out keys, so the file is parsed once up front
+        # to infer the schema and once more for the chunks.
+        schema = pl.scan_ndjson(path, infer_schema_length=None).collect_schema()
+        with path.open("rb") as f:
+            while len(lines := list(itertools.islice(f, batch_size))) > 0:
+                yield cls._parse_dates(
+                    pl.read_ndjson(
+                        io.BytesIO(b"".join(lines)),
+                        schema=schema,
+                        ignore_errors=ignore_errors,
+                    ),
+                    schema,
+                    ignore_errors,
+                ).drop(ERROR_MESSAGE, strict=False)
+
+    @classmethod
+    def _read_parquet(cls, path: Path, batch_size: int) -> Iterator[pl.DataFrame]:
+        data = cls._scan(path)
+        window_size = max(batch_size, _PARQUET_WINDOW)
+        offset = 0
+        while (window := data.slice(offset, window_size).collect()).height > 0:
+            for o in range(0, window.height, batch_size):
+                yield window.slice(o, batch_size)
+            if window.height < window_size:
+                return
+            offset += window_size
+
+    @classmethod
+    def _read(
+        cls,
+        path: Path,
+        batch_size: int,
+        ignore_errors: bool = False,
+    ) -> Iterator[pl.DataFrame]:
+        if suffix(path) in _COMPRESSED:
+            yield from cls._read_compressed(path, batch_size, ignore_errors)
+        elif path.suffix == ".ndjson":
+            yield from cls._read_ndjson(path, batch_size, ignore_errors)
+        elif path.suffix == ".parquet":
+            yield from cls._read_parquet(path, batch_size)
+        elif path.suffix in _IPC:
+            # The file is memory mapped once and the batches are zero copy slices
+            data = pl.read_ipc(path, memory_map=True, rechunk=False).drop(
+                ERROR_MESSAGE,
+                strict=False,
+            )
+            for offset in range(0, data.height, batch_size):
+                yield data.slice(offset, batch_size)
+        else:
+            yield from cls._read_csv(path, batch_size, ignore_errors)
+
+    def _paths(self) -> dict[str, Path]:
+        return (
             {"data": self._options.data_location}
             if isinstance(self._options.data_location, Path)
             else self._options.data_location
-        ).items():
-            data = self._scan_csv(p).with_row_index()
-
-            batch_num = 0
-            rows_batched = batch_size
-            while rows_batched == batch_size:
-                batch = data.filter(
-                    pl.Expr.and_(
-                        pl.col("index").ge(pl.lit(batch_size * batch_num)),
-                        pl.col("index").lt(pl.lit(batch_size * (batch_num + 1))),
-                    ),
+        )
+
+    def files(self) -> list["InputData"]:
+        """Splits the input data into one for each file, largest file first."""
+        return [
+            InputData(InputDataOptions({n: p}))
+            for n, p in sorted(
+                self._paths().items(),
+                key=lambda f: f[1].stat().st_size,
+                reverse=True,
+            )
+        ]
+
+    def scan_raw(self, name: str) -> pl.LazyFrame:
+        """Scans a file with every value as it was written.
+
+        Csvs are read without parsing any values, other formats are typed.
+        Rows are numbered from 0 in a row column, skipping comments,
+        in the same order batch reads them in.
+        """
+        path = self._paths()[name]
+        if suffix(path) in _COMPRESSED:
+            return (
+                pl.read_csv(path, comment_prefix="#", infer_schema=False)
+                .lazy()
+                .drop(ERROR_MESSAGE, strict=False)
+                .with_row_index("row")
+            )
+        if path.suffix in SUFFIXES - {".csv"}:
+            return self._scan(path).with_row_index("row")
+
+        return (
+            pl.scan_csv(
+                path,
+                comment_prefix="#",
+                infer_schema=False,
+            )
+            .drop(ERROR_MESSAGE, strict=False)
+            .with_row_index("row")
+        )
+
+    @classmethod
+    def _estimate_bytes(cls, chunk: pl.DataFrame) -> pl.Series:
+        # An overestimate of each row's size once it is encoded as json.
+        # The column name is longer than the json key and stands in for the
+        # quotes, colon, comma, and nested objects the row will end up with.
+        return chunk.select(
+            pl.sum_horizontal(
+                pl.col(c).cast(pl.Utf8).str.len_bytes().add(len(c) + 6).fill_null(0)
+                for c in chunk.columns
+            ).add(2),
+        ).to_series()
+
+    @classmethod
+    def _full_batch(
+        cls,
+        pending_bytes: list[pl.Series],
+        batch_size: int,
+        max_batch_bytes: int | None,
+    ) -> int | None:
+        # The number of rows in the next full batch
+        # or None if there isn't enough pending data to fill a batch yet.
+        rows = sum(len(b) for b in pending_bytes)
+        if rows > 0 and max_batch_bytes is not None:
+            fits = (
+                pl.concat(pending_bytes)
+                .cum_sum()
+                .search_sorted(
+                    max_batch_bytes,
+                    side="right",
                 )
+            )
+            if fits < min(rows, batch_size):
+                # A single row bigger than max_batch_bytes is batched by itself
+                return max(1, fits)
+
+        return batch_size if rows >= batch_size else None
 
-                batch_num += 1
-                rows_batched = int(batch.select(pl.len()).collect().item())
-                yield (f, rows_batched, batch.drop("index"))
+    def batch(
+        self,
+        batch_size: int | Callable[[], int],
+        max_batch_bytes: int | None = None,
+    ) -> Iterator[tuple[str, int, pl.LazyFrame]]:
+        """Streams input data in batches up to batch_size.
+
+        Each file is read exactly once, the chunks coming out of the reader
+        are sliced and stitched together into batches of exactly batch_size.
+        Ndjson files are also read once beforehand to infer their schema.
+        When max_batch_bytes is set batches are cut short as soon as the
+        estimated size of the batch as json would go over it.
+        batch_size can also be a callable which is asked for the size of
+        each batch as it is cut, allowing the size to change while streaming.
+        Files ending in .parquet, .arrow or .ipc (memory mapped), and .ndjson
+        are read in their own formats, anything else is read as a csv.
+        Csvs ending in .csv.gz and .csv.zst are decompressed as they are read.
+        """
+        current_size = batch_size if callable(batch_size) else lambda: batch_size
+        for f, p in self._paths().items():
+            pending: list[pl.DataFrame] = []
+            pending_bytes: list[pl.Series] = []
+            for chunk in self._read(p, current_size()):
+                pending.append(chunk)
+                if max_batch_bytes is None:
+                    pending_bytes.append(pl.zeros(chunk.height, pl.UInt32, eager=True))
+                else:
+                    pending_bytes.append(self._estimate_bytes(chunk))
+
+                while (
+                    rows := self._full_batch(
+                        pending_bytes,
+                        current_size(),
+                        max_batch_bytes,
+                    )
+                ) is not None:
+                    data = pl.concat(pending, how="vertical")
+                    yield (f, rows, data.head(rows).lazy())
+
+                    pending = [data.slice(rows)]
+                    pending_bytes = [pl.concat(pending_bytes).slice(rows)]
+
+            if (rows := sum(d.height for d in pending)) > 0:
+                yield (f, rows, pl.concat(pending, how="vertical").lazy())
+
+    def _validate(
+        self,
+        path: Path,
+        chunks: Iterable[pl.DataFrame],
+        validation: _Validation,
+        sampler: _Sampler,
+    ) -> pla.errors.SchemaErrors | None:
+        for rows in sampler.sample(chunks):
+            validation.validate(rows)
+            if validation.stopped:
+                break
+        if validation.empty:
+            # Files without any rows still need their columns checked
+            validation.validate(self._scan(path).clear().collect().with_row_index(_ROW))
+
+        return validation.errors()
 
     def test(
         self,
+        chunk_size: int = _CHECK_CHUNK_SIZE,
+        engine: str = "pandera",
+        sample: Sample | None = None,
+        max_errors: int | None = None,
     ) -> tuple[
         dict[str, pla.errors.SchemaErrors] | None,
         dict[str, pl.exceptions.PolarsError] | None,
+        dict[str, str] | None,
     ]:
-        """Test that connection to FOLIO is ok."""
+        """Test that the input data can be read and is valid.
+
+        Each file is read and validated chunk_size rows at a time
+        so only a chunk is held in memory. Ndjson files are also read
+        once beforehand to infer their schema. Files are only read a second time,
+        ignoring the rows that can't be read, when they have read errors.
+        The polars engine runs every check of a chunk in a single query
+        instead of validating with pandera, the errors are the same.
+
+        Only a sample of every file is validated when there is one and a file
+        stops being read once max_errors failure cases are found in it.
+        Files that weren't completely checked are returned with how much was.
+        """
         schema_errors: dict[str, pla.errors.SchemaErrors] = {}
         read_errors: dict[str, pl.exceptions.PolarsError] = {}
+        partial: dict[str, str] = {}
 
-        for n, p in (
-            {"data": self._options.data_location}
-            if isinstance(self._options.data_location, Path)
-            else self._options.data_location
-        ).items():
+        for n, p in self._paths().items():
+            errors: pla.errors.SchemaErrors | None
+            validation = _Validation(engine, max_errors)
+            sampler = _Sampler(sample)
             try:
-                self._scan_csv(p).collect()
+                errors = self._validate(
+                    p,
+                    self._read(p, chunk_size),
+                    validation,
+                    sampler,
+                )
             except pl.exceptions.PolarsError as e:
                 read_errors[n] = e
+                validation = _Validation(engine, max_errors)
+                sampler = _Sampler(sample)
+                try:
+                    errors = self._validate(
+                        p,
+                        self._read(p, chunk_size, ignore_errors=True),
+                        validation,
+                        sampler,
+                    )
+                except pl.exceptions.PolarsError:
+                    continue
 
-            data: pl.DataFrame | None
-            try:
-                data = self._scan_csv(p, ignore_errors=True).collect()
-            except pl.exceptions.PolarsError as e:
-                if n not in read_errors:
-                    read_errors[n] = e
-                continue
+            if errors is not None:
+                schema_errors[n] = errors
 
-            try:
-                UserImportSchema.validate(data, lazy=True)
-            except pla.errors.SchemaError as se:
-                schema_errors[n] = pla.errors.SchemaErrors(
-                    UserImportSchema.to_schema(),
-                    [se],
-                    data,
+            checked = []
+            if sample is not None:
+                checked.append(
+                    f"only a sample of {validation.rows} of {sampler.read} rows "
+                    "was checked",
                 )
-            except pla.errors.SchemaErrors as se:
-                schema_errors[n] = se
+            if validation.stopped:
+                checked.append(
+                    f"stopped after {validation.failures} failure cases "
+                    f"in the first {sampler.read} rows",
+                )
+            if len(checked) > 0:
+                partial[n] = ", ".join(checked)
 
         return (
             schema_errors if len(schema_errors) > 0 else None,
             read_errors if len(read_errors) > 0 else None,
+            partial if len(partial) > 0 else None,
         )
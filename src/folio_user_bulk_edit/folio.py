@@ -1,11 +1,17 @@
 """FOLIO connection related utils for managing users."""
 
+import threading
+import time
+import typing
 from collections.abc import Iterator
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
 
 import httpx
 import pyfolioclient as pfc
+from pyfolioclient._decorators import exception_handler
 
 
 @dataclass(frozen=True)
@@ -17,6 +23,200 @@ class FolioOptions:
     folio_username: str
     folio_password: str
 
+    requests_per_second: float | None = field(kw_only=True, default=None)
+    users_per_second: float | None = field(kw_only=True, default=None)
+
+
+class _TokenBucket:
+    # Allows rate tokens a second with bursts of up to a second's worth.
+    # Tokens are reserved before waiting so callers are served in order
+    # and a request for more than a second's worth just waits longer.
+    def __init__(self, rate: float) -> None:
+        self._rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._rate,
+                self._tokens + (now - self._last) * self._rate,
+            )
+            self._last = now
+            self._tokens -= tokens
+            wait = -self._tokens / self._rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _Governor:
+    # Shared by every request made through a FolioClient
+    def __init__(
+        self,
+        requests_per_second: float | None,
+        users_per_second: float | None,
+    ) -> None:
+        self._requests = (
+            None if requests_per_second is None else _TokenBucket(requests_per_second)
+        )
+        self._users = (
+            None if users_per_second is None else _TokenBucket(users_per_second)
+        )
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def request(self) -> None:
+        with self._lock:
+            paused = self._paused_until - time.monotonic()
+        if paused > 0:
+            time.sleep(paused)
+        if self._requests is not None:
+            self._requests.acquire()
+
+    def users(self, users: int) -> None:
+        if self._users is not None:
+            self._users.acquire(users)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(
+                self._paused_until,
+                time.monotonic() + seconds,
+            )
+
+
+def _retry_after(response: httpx.Response, attempt: int) -> float:
+    # Retry-After is either a number of seconds or a date
+    retry_after: str = response.headers.get("Retry-After", "")
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(
+            0.0,
+            (parsedate_to_datetime(retry_after) - datetime.now(tz=UTC)).total_seconds(),
+        )
+    except (TypeError, ValueError):
+        return float(2**attempt)
+
+
+class _GovernedTransport(httpx.BaseTransport):
+    # Waits for the governor before every request
+    # and retries requests that FOLIO says were made too quickly.
+    def __init__(
+        self,
+        transport: httpx.BaseTransport,
+        governor: _Governor,
+        max_throttled_retries: int,
+    ) -> None:
+        self._transport = transport
+        self._governor = governor
+        self._max_throttled_retries = max_throttled_retries
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            self._governor.request()
+            response = self._transport.handle_request(request)
+            if (
+                response.status_code != httpx.codes.TOO_MANY_REQUESTS
+                or attempt >= self._max_throttled_retries
+            ):
+                return response
+
+            response.read()
+            response.close()
+            self._governor.pause(_retry_after(response, attempt))
+            attempt += 1
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class FolioClient(pfc.FolioBaseClient):
+    """A pyfolioclient which can also send already encoded json.
+
+    Requests can be limited to requests_per_second and the users sent to
+    users_per_second. Requests FOLIO responds to with a 429 are retried after
+    waiting for its Retry-After, all other requests wait as well.
+    The token is refreshed by one thread at a time so the client can be shared.
+    """
+
+    def __init__(
+        self,
+        *args: typing.Any,
+        requests_per_second: float | None = None,
+        users_per_second: float | None = None,
+        max_throttled_retries: int = 5,
+        **kwargs: typing.Any,
+    ) -> None:
+        """Initializes a new instance of FolioClient."""
+        self._token_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+        self._governor = _Governor(requests_per_second, users_per_second)
+
+        # pyfolioclient doesn't allow passing in a transport
+        # so the client it logged in with is swapped for a governed one
+        logged_in = self.client
+        self.client = httpx.Client(
+            headers=logged_in.headers,
+            cookies=logged_in.cookies,
+            transport=_GovernedTransport(
+                httpx.HTTPTransport(),
+                self._governor,
+                max_throttled_retries,
+            ),
+        )
+        logged_in.close()
+
+    def __enter__(self) -> typing.Self:
+        return self
+
+    def _manage_token(self) -> None:
+        # Every worker shares this client and a refresh token can only be used
+        # once, so only one of them refreshes it. The others wait and then see
+        # the token no longer needs refreshing.
+        if datetime.now(tz=UTC) < self._token_expiration_with_buffer:
+            return
+        with self._token_lock:
+            super()._manage_token()  # type: ignore[no-untyped-call]
+
+    @exception_handler  # type: ignore[misc]
+    def post_json(
+        self,
+        endpoint: str,
+        content: bytes,
+        content_encoding: str | None = None,
+        users: int = 0,
+    ) -> dict[str, typing.Any] | int:
+        """Posts an already encoded json body to a FOLIO endpoint.
+
+        This behaves the same as post_data but skips encoding the payload.
+        The content_encoding header is set when the body is compressed.
+        The number of users in the body counts towards users_per_second.
+        """
+        self._governor.users(users)
+        headers = {"Content-Type": "application/json"}
+        if content_encoding is not None:
+            headers["Content-Encoding"] = content_encoding
+
+        self._manage_token()
+        response = self.client.post(
+            f"{self._base_url}{endpoint}",
+            content=content,
+            headers=headers,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        try:
+            return typing.cast("dict[str, typing.Any]", response.json())
+        except ValueError:
+            return int(response.status_code)
+
 
 class Folio:
     """The FOLIO connection factory."""
@@ -26,13 +226,15 @@ class Folio:
         self._options = options
 
     @contextmanager
-    def connect(self) -> Iterator[pfc.FolioBaseClient]:
+    def connect(self) -> Iterator[FolioClient]:
         """Connects to FOLIO and returns a pyfolioclient."""
-        with pfc.FolioBaseClient(
+        with FolioClient(
             self._options.folio_url,
             self._options.folio_tenant,
             self._options.folio_username,
             self._options.folio_password,
+            requests_per_second=self._options.requests_per_second,
+            users_per_second=self._options.users_per_second,
         ) as c:
             yield c
 
@@ -1,12 +1,13 @@
 """Panderas Schemas for FOLIO user data."""
 
 import json
+import threading
+import typing
+import weakref
 from datetime import UTC, datetime
-from urllib.parse import urlparse
 
 import pandera.polars as pla
 import polars as pl
-import polars.selectors as cs
 
 # https://dev.folio.org/guides/uuids/
 _FOLIO_UUID = (
@@ -18,41 +19,81 @@ _FOLIO_UUID = (
     r"[a-fA-F0-9]{12}$"
 )
 
+# The urls urlparse finds both a scheme and a netloc in
+_URL = r"^[\x00-\x20]*[a-zA-Z][a-zA-Z0-9+.\-]*://[^/?#]"
+
+_EMAIL_PREFERENCES = ["Support", "Programs", "Services"]
+
+
+def _split_unique(data: pla.PolarsData) -> pl.Expr:
+    # Whether every value in a comma separated list is different
+    values = pl.col(data.key or "*").str.split(",")
+    return values.list.n_unique() == values.list.len()
+
+
+def _is_json(data: str) -> bool:
+    try:
+        json.loads(data)
+    except ValueError:
+        return False
+
+    return True
+
+
+def _valid_json(values: pl.Series) -> pl.Series:
+    # polars doesn't parse everything json does, like NaN or a bare null,
+    # only the values it can't parse are checked one at a time.
+    valid = values.str.json_path_match("$").is_not_null() | values.is_null()
+    unparsed = valid.not_().arg_true()
+    return valid.scatter(unparsed, [_is_json(v) for v in values.gather(unparsed)])
+
 
 class _SubSchema:
+    # Every sub-schema's required columns are checked for nulls in one query
+    # the first time any of them looks at a frame, the rest reuse the result.
+    _required: typing.ClassVar[set[str]] = set()
+    _nulls: typing.ClassVar[tuple[weakref.ref[pl.LazyFrame], dict[str, bool]]] = (
+        weakref.ref(pl.LazyFrame()),
+        {},
+    )
+    _lock = threading.Lock()
+
     def __init__(self, prefix: str, req_cols: list[str]) -> None:
         self._prefix = prefix
         self._req_cols = {f"{prefix}_{col}" for col in req_cols}
-        self._cs_required = cs.by_name(
-            self._req_cols,
-            require_all=False,
-        )
-        self._cs_prefix = cs.starts_with(self._prefix)
+        _SubSchema._required |= self._req_cols
 
-    def _agg(self, data: pla.PolarsData) -> pl.LazyFrame:
-        noerr = f"{self._prefix}_atleastonekey"
-        return (
-            data.lazyframe.with_columns(
-                pl.lit(1).alias(noerr),
-            )
-            .group_by(self._cs_prefix - self._cs_required)
-            .agg(self._cs_required.has_nulls().not_())
-            .select(self._cs_prefix - cs.by_name(noerr))
-        )
+    @classmethod
+    def _has_nulls(cls, data: pla.PolarsData) -> dict[str, bool]:
+        with cls._lock:
+            (frame, nulls) = cls._nulls
+            if frame() is not data.lazyframe:
+                names = data.lazyframe.collect_schema().names()
+                nulls = (
+                    data.lazyframe.select(
+                        pl.col(c).has_nulls() for c in names if c in cls._required
+                    )
+                    .collect()
+                    .row(0, named=True)
+                    if len(cls._required & set(names)) > 0
+                    else {}
+                )
+                cls._nulls = (weakref.ref(data.lazyframe), nulls)
+
+            return nulls
 
     def required(self, data: pla.PolarsData) -> bool:
-        pref_cols = set(self._agg(data).collect_schema().names())
-        if len(pref_cols) == 0:
-            # there are no no requestPreference columns
+        names = set(data.lazyframe.collect_schema().names())
+        if not any(n.startswith(self._prefix) for n in names):
+            # there are no columns for the sub-schema
             return True
-        return len(self._req_cols - pref_cols) == 0
+        return len(self._req_cols - names) == 0
 
     def not_nullable(self, data: pla.PolarsData) -> bool:
-        pref_cols = self._agg(data).collect().to_dict(as_series=False)
-        if len(pref_cols) == 0:
-            # there are no no requestPreference columns
-            return True
-        return all(all(v) for (k, v) in pref_cols.items() if k in self._req_cols)
+        # Grouping by the other columns of the sub-schema doesn't change
+        # whether any of the required columns have a null in them.
+        nulls = self._has_nulls(data)
+        return not any(nulls.get(c, False) for c in self._req_cols)
 
 
 class _RequiredUserImportSchema(pla.DataFrameModel):
@@ -71,21 +112,21 @@ class _BaseUserImportSchema(pla.DataFrameModel):
     expirationDate: pl.Date | None = pla.Field(nullable=True)
     preferredEmailCommunication: str | None = pla.Field(nullable=True)
 
-    @pla.check("departments", element_wise=True)
+    @pla.check("departments")
     @classmethod
-    def unique_departments(cls, depts: str) -> bool:
-        all_vals = depts.split(",")
-        unique_vals = set(all_vals)
-        return len(unique_vals) == len(all_vals)
+    def unique_departments(cls, data: pla.PolarsData) -> pl.LazyFrame:
+        return data.lazyframe.select(_split_unique(data))
 
-    @pla.check("preferredEmailCommunication", element_wise=True)
+    @pla.check("preferredEmailCommunication")
     @classmethod
-    def valid_preferences(cls, prefs: str) -> bool:
-        all_vals = prefs.split(",")
-        unique_vals = set(all_vals)
-        return (
-            len(unique_vals) == len(all_vals)
-            and len(unique_vals - {"Support", "Programs", "Services"}) == 0
+    def valid_preferences(cls, data: pla.PolarsData) -> pl.LazyFrame:
+        return data.lazyframe.select(
+            _split_unique(data).and_(
+                pl.col(data.key or "*")
+                .str.split(",")
+                .list.eval(pl.element().is_in(_EMAIL_PREFERENCES))
+                .list.all(),
+            ),
         )
 
     @pla.dataframe_check
@@ -156,11 +197,13 @@ class _PersonalSchema(pla.DataFrameModel):
     )
     personal_profilePictureLink: str | None = pla.Field(nullable=True)
 
-    @pla.check("personal_profilePictureLink", element_wise=True)
+    @pla.check("personal_profilePictureLink")
     @classmethod
-    def valid_url(cls, data: str) -> bool:
-        (scheme, netloc, *_) = urlparse(data)
-        return all([scheme, netloc])
+    def valid_url(cls, data: pla.PolarsData) -> pl.LazyFrame:
+        # urlparse removes tabs and newlines before parsing
+        return data.lazyframe.select(
+            pl.col(data.key or "*").str.replace_all(r"[\t\r\n]", "").str.contains(_URL),
+        )
 
     _personal_ss = _SubSchema("personal", ["lastName"])
 
@@ -215,15 +258,12 @@ class UserImportSchema(
     tags: str | None = pla.Field(nullable=True)
     customFields: str | None = pla.Field(nullable=True)
 
-    @pla.check("customFields", element_wise=True)
+    @pla.check("customFields")
     @classmethod
-    def _valid_json(cls, data: str) -> bool:
-        try:
-            json.loads(data)
-        except ValueError:
-            return False
-
-        return True
+    def _valid_json(cls, data: pla.PolarsData) -> pl.LazyFrame:
+        return data.lazyframe.select(
+            pl.col(data.key or "*").map_batches(_valid_json, return_dtype=pl.Boolean),
+        )
 
     class Config:
         """Define DataFrameSchema-wide options."""
@@ -1,15 +1,17 @@
 import shlex
 import typing
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
 from unittest import mock
 
 import pytest
-from pytest_cases import parametrize_with_cases
+from pytest_cases import parametrize, parametrize_with_cases
 
 from folio_user_bulk_edit.commands.check import CheckOptions
+from folio_user_bulk_edit.commands.user_export import ExportOptions
 from folio_user_bulk_edit.commands.user_import import ImportOptions
+from folio_user_bulk_edit.data import Sample
 
 
 @dataclass
@@ -18,7 +20,7 @@ class CliArgCase:
     envs: dict[str, str]
     _getpass: str
     expected_exception: type[Exception] | type[SystemExit] | None = None
-    expected_options: CheckOptions | ImportOptions | None = None
+    expected_options: CheckOptions | ImportOptions | ExportOptions | None = None
 
     @contextmanager
     def setup(self) -> typing.Any:
@@ -140,6 +142,394 @@ class CliArgCases:
             ),
         )
 
+    def case_import_concurrency(self) -> CliArgCase:
+        return CliArgCase(
+            "--concurrency 4 import decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__CONCURRENCY": "2",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                concurrency=4,
+            ),
+        )
+
+    @parametrize(command=["import", "export"])
+    def case_concurrency_zero(self, command: str) -> CliArgCase:
+        return CliArgCase(
+            f"--concurrency 0 {command} decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+            },
+            "",
+            expected_exception=ValueError,
+        )
+
+    @parametrize(
+        "args,env",
+        [
+            ("--file-concurrency 0", {}),
+            ("", {"UBE__BATCHSETTINGS__FILECONCURRENCY": "0"}),
+        ],
+    )
+    def case_import_file_concurrency_zero(
+        self,
+        args: str,
+        env: dict[str, str],
+    ) -> CliArgCase:
+        return CliArgCase(
+            f"{args} import decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                **env,
+            },
+            "",
+            expected_exception=ValueError,
+        )
+
+    def case_import_file_concurrency(self) -> CliArgCase:
+        return CliArgCase(
+            "--file-concurrency 3 import decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__FILECONCURRENCY": "2",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                file_concurrency=3,
+            ),
+        )
+
+    def case_import_max_batch_bytes(self) -> CliArgCase:
+        return CliArgCase(
+            "--max-batch-bytes 2048 import decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__MAXBATCHBYTES": "1024",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                max_batch_bytes=2048,
+            ),
+        )
+
+    def case_import_compress_requests(self) -> CliArgCase:
+        return CliArgCase(
+            "import decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__COMPRESSREQUESTS": "1",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                compress_requests=True,
+            ),
+        )
+
+    def case_import_adaptive_batch_size(self) -> CliArgCase:
+        return CliArgCase(
+            "--min-batch-size 50 --target-latency 2.5 "
+            "import --adaptive-batch-size decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__MINBATCHSIZE": "20",
+                "UBE__BATCHSETTINGS__MAXBATCHSIZE": "2000",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                adaptive_batch_size=True,
+                min_batch_size=50,
+                max_batch_size=2000,
+                target_latency=2.5,
+            ),
+        )
+
+    def case_import_bisect_rejected_batches(self) -> CliArgCase:
+        return CliArgCase(
+            "import decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__BISECTREJECTEDBATCHES": "1",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                bisect_rejected_batches=True,
+            ),
+        )
+
+    def case_import_retry_backoff(self) -> CliArgCase:
+        return CliArgCase(
+            "--retry-backoff 0.5 --circuit-breaker-threshold 3 import decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__MAXRETRYBACKOFF": "10",
+                "UBE__BATCHSETTINGS__CIRCUITBREAKERCOOLDOWN": "5",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                retry_backoff=0.5,
+                max_retry_backoff=10,
+                circuit_breaker_threshold=3,
+                circuit_breaker_cooldown=5,
+            ),
+        )
+
+    def case_import_defer_failed_batches(self) -> CliArgCase:
+        return CliArgCase(
+            "import --defer-failed-batches decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                defer_failed_batches=True,
+            ),
+        )
+
+    def case_import_resume(self) -> CliArgCase:
+        return CliArgCase(
+            "import --resume logs/journal.tsv decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                resume=Path("logs/journal.tsv"),
+            ),
+        )
+
+    def case_import_delta_state(self) -> CliArgCase:
+        return CliArgCase(
+            "import --delta-state state.parquet decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__DELTASTATE": "other.parquet",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                delta_state=Path("state.parquet"),
+            ),
+        )
+
+    def case_import_delta_state_deactivate(self) -> CliArgCase:
+        return CliArgCase(
+            "import --delta-state state.parquet --deactivate-missing-users decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+            },
+            "",
+            expected_exception=ValueError,
+        )
+
+    def case_import_diff_against_folio(self) -> CliArgCase:
+        return CliArgCase(
+            "import --diff-against-folio decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__BATCHSETTINGS__DIFFAGAINSTFOLIO": "0",
+            },
+            "",
+            expected_options=ImportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                1000,
+                1,
+                False,
+                False,
+                None,
+                diff_against_folio=True,
+            ),
+        )
+
+    def case_export(self) -> CliArgCase:
+        return CliArgCase(
+            "--batch-size 500 --concurrency 8 export users.parquet",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+            },
+            "",
+            expected_options=ExportOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                Path("users.parquet"),
+                500,
+                8,
+            ),
+        )
+
+    def case_rate_limits(self) -> CliArgCase:
+        return CliArgCase(
+            "--requests-per-second 2.5 check decoy.csv",
+            {
+                "UBE__FOLIO__ENDPOINT": "http://folio.org",
+                "UBE__FOLIO__TENANT": "tenant",
+                "UBE__FOLIO__USERNAME": "user",
+                "UBE__FOLIO__PASSWORD": "pass",
+                "UBE__FOLIO__USERSPERSECOND": "100",
+            },
+            "",
+            expected_options=CheckOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                requests_per_second=2.5,
+                users_per_second=100,
+            ),
+        )
+
     def case_default_scheme(self) -> CliArgCase:
         return CliArgCase(
             "-e folio.org -t tenant -u user -p check decoy.csv",
@@ -154,13 +544,51 @@ class CliArgCases:
             ),
         )
 
+    def case_check_engine(self) -> CliArgCase:
+        return CliArgCase(
+            "-e http://folio.org -t tenant -u user -p check --engine polars decoy.csv",
+            {},
+            "pass",
+            expected_options=CheckOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                "polars",
+            ),
+        )
 
+    @parametrize(
+        "sample,expected",
+        [("250", Sample(rows=250)), ("2.5%", Sample(fraction=0.025))],
+    )
+    def case_check_sample(self, sample: str, expected: Sample) -> CliArgCase:
+        return CliArgCase(
+            f"-e http://folio.org -t tenant -u user -p check --sample {sample} "
+            "--max-errors 10 decoy.csv",
+            {},
+            "pass",
+            expected_options=CheckOptions(
+                "http://folio.org",
+                "tenant",
+                "user",
+                "pass",
+                _decoy_csv,
+                sample=expected,
+                max_errors=10,
+            ),
+        )
+
+
+@mock.patch("folio_user_bulk_edit.commands.user_export.run")
 @mock.patch("folio_user_bulk_edit.commands.user_import.run")
 @mock.patch("folio_user_bulk_edit.commands.check.run")
 @parametrize_with_cases("tc", cases=CliArgCases)
 def test_cli_args(
     check_mock: mock.Mock,
     import_mock: mock.Mock,
+    export_mock: mock.Mock,
     tc: CliArgCase,
 ) -> None:
     import folio_user_bulk_edit.cli as uut
@@ -175,11 +603,60 @@ def test_cli_args(
     if tc.expected_options is None:
         check_mock.assert_not_called()
         import_mock.assert_not_called()
+        export_mock.assert_not_called()
         return
 
     if isinstance(tc.expected_options, CheckOptions):
         check_mock.assert_called_with(tc.expected_options)
     elif isinstance(tc.expected_options, ImportOptions):
-        import_mock.assert_called_with(tc.expected_options)
+        import_mock.assert_called_once()
+        options: ImportOptions = import_mock.call_args.args[0]
+        # The log files are named after when the import started
+        for path, name in [
+            (options.journal, "journal.tsv"),
+            (options.failed_users, "failedUsers.csv"),
+            (options.rejects, "rejects"),
+        ]:
+            assert path is not None
+            assert path.name.endswith(f"-{name}")
+        assert (
+            replace(options, journal=None, failed_users=None, rejects=None)
+            == tc.expected_options
+        )
+    elif isinstance(tc.expected_options, ExportOptions):
+        export_mock.assert_called_with(tc.expected_options)
     else:
         pytest.fail(f"Unknown result type {tc.expected_options}")
+
+
+@parametrize(
+    "args,failed_users",
+    [
+        ("import decoy.csv", "failedUsers.csv"),
+        ("import --failed-users-format parquet decoy.csv", "failedUsers.parquet"),
+        ("import --failed-users-format ndjson decoy.csv", "failedUsers.ndjson"),
+    ],
+)
+@mock.patch("folio_user_bulk_edit.commands.user_import.run")
+def test_cli_failed_users_format(
+    import_mock: mock.Mock,
+    args: str,
+    failed_users: str,
+) -> None:
+    import folio_user_bulk_edit.cli as uut
+
+    with CliArgCase(
+        args,
+        {
+            "UBE__FOLIO__ENDPOINT": "http://folio.org",
+            "UBE__FOLIO__TENANT": "tenant",
+            "UBE__FOLIO__USERNAME": "user",
+            "UBE__FOLIO__PASSWORD": "pass",
+        },
+        "",
+    ).setup():
+        uut.main(shlex.split(args))
+
+    options: ImportOptions = import_mock.call_args.args[0]
+    assert options.failed_users is not None
+    assert options.failed_users.name.endswith(f"-{failed_users}")
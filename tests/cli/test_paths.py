@@ -19,6 +19,7 @@ class CliPathCase:
     def setup(self) -> typing.Any:
         (self._temp / "d0_f0.csv").touch()
         (self._temp / "d0_f1.csv").touch()
+        (self._temp / "d0_f0.csv.gz").touch()
 
         (self._temp / "d0_d0").mkdir()
         (self._temp / "d0_d0" / "d0_d0_f0.csv").touch()
@@ -33,6 +34,12 @@ class CliPathCase:
 
         (self._temp / "d0_d1").mkdir()
 
+        (self._temp / "d0_d2").mkdir()
+        (self._temp / "d0_d2" / "d0_d2_f0.csv.gz").touch()
+        (self._temp / "d0_d2" / "d0_d2_f1.csv.zst").touch()
+        (self._temp / "d0_d2" / "d0_d2_f2.parquet").touch()
+        (self._temp / "d0_d2" / "d0_d2_f3.txt.gz").touch()
+
         with mock.patch.dict(
             "os.environ",
             {
@@ -91,6 +98,45 @@ class CliPathCases:
             },
         )
 
+    def case_formats(self, tmpdir: str) -> CliPathCase:
+        temp = Path(tmpdir)
+        return CliPathCase(
+            temp,
+            [temp / "d0_d2", temp / "d0_f0.csv.gz"],
+            expected_paths={
+                "d0_d2_f0": temp / "d0_d2" / "d0_d2_f0.csv.gz",
+                "d0_d2_f1": temp / "d0_d2" / "d0_d2_f1.csv.zst",
+                "d0_d2_f2": temp / "d0_d2" / "d0_d2_f2.parquet",
+                "d0_f0": temp / "d0_f0.csv.gz",
+            },
+        )
+
+    def case_same_file_twice(self, tmpdir: str) -> CliPathCase:
+        temp = Path(tmpdir)
+        return CliPathCase(
+            temp,
+            [
+                temp / "d0_d0" / "d0_d0_d1" / "d0_d0_d1_f0.csv",
+                temp / "d0_d0" / "d0_d0_d1",
+            ],
+            expected_paths={
+                "d0_d0_d1_f0": temp / "d0_d0" / "d0_d0_d1" / "d0_d0_d1_f0.csv",
+            },
+        )
+
+    def case_same_stem(self, tmpdir: str) -> CliPathCase:
+        # d0_f0.csv and d0_f0.csv.gz would both be d0_f0
+        temp = Path(tmpdir)
+        return CliPathCase(temp, [temp], expected_exception=ValueError)
+
+    def case_same_stem_files(self, tmpdir: str) -> CliPathCase:
+        temp = Path(tmpdir)
+        return CliPathCase(
+            temp,
+            [temp / "d0_f0.csv", temp / "d0_f0.csv.gz"],
+            expected_exception=ValueError,
+        )
+
     def case_no_arg(self, tmpdir: str) -> CliPathCase:
         temp = Path(tmpdir)
         return CliPathCase(temp, [], expected_exception=SystemExit)
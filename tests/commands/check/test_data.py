@@ -1,6 +1,9 @@
+import io
+import typing
 from dataclasses import dataclass
 from pathlib import Path
 
+import polars as pl
 from pandera.polars import errors as ple
 from pytest_cases import parametrize, parametrize_with_cases
 
@@ -19,6 +22,29 @@ class DataErrorCases:
     def case_ok(self, csv: Path) -> tuple[Path, bool, None]:
         return (csv, True, None)
 
+    @parametrize(csv=[s for s in _samples if "ok" in str(s)])
+    @parametrize(suffix=[".parquet", ".arrow", ".ndjson"])
+    def case_ok_formats(
+        self,
+        csv: Path,
+        suffix: str,
+        tmpdir: str,
+    ) -> tuple[Path, bool, None]:
+        path = Path(tmpdir) / f"{csv.stem}{suffix}"
+        data = pl.read_csv(
+            csv,
+            comment_prefix="#",
+            try_parse_dates=True,
+            schema_overrides={"barcode": pl.Utf8},
+        )
+        writers: dict[str, typing.Callable[[Path], object]] = {
+            ".parquet": data.write_parquet,
+            ".arrow": data.write_ipc,
+            ".ndjson": data.write_ndjson,
+        }
+        writers[suffix](path)
+        return (path, True, None)
+
     @parametrize(csv=[s for s in _samples if "read" in str(s)])
     def case_bad_read(self, csv: Path) -> tuple[Path, bool, None]:
         return (csv, False, None)
@@ -69,3 +95,200 @@ def test_check_data(
 
         if schema_expected.check_name:
             assert err.check.name == schema_expected.check_name
+
+
+@parametrize(path=_samples)
+def test_check_data_chunked(path: Path) -> None:
+    from folio_user_bulk_edit.data import InputData, InputDataOptions
+
+    data = InputData(InputDataOptions(path))
+    (schema_errors, read_errors, _) = data.test()
+    (chunked_schema_errors, chunked_read_errors, _) = data.test(chunk_size=1)
+
+    assert (chunked_read_errors is None) == (read_errors is None)
+    assert (chunked_schema_errors is None) == (schema_errors is None)
+    if schema_errors and chunked_schema_errors:
+        assert set(
+            chunked_schema_errors["data"]
+            .failure_cases.select("column", "check")
+            .iter_rows(),
+        ) == set(
+            schema_errors["data"].failure_cases.select("column", "check").iter_rows()
+        )
+
+
+@parametrize(chunk_size=[1, 2, 3, 100])
+def test_check_data_unique_across_chunks(chunk_size: int, tmpdir: str) -> None:
+    from folio_user_bulk_edit.data import InputData, InputDataOptions
+
+    path = Path(tmpdir) / "data.csv"
+    pl.DataFrame(
+        {
+            "username": ["u0", "u1", "u2", "u0", "u3", "u1"],
+            "externalSystemId": ["e0", "e1", "e2", "e3", "e4", "e5"],
+        },
+    ).write_csv(path)
+
+    (schema_errors, read_errors, _) = InputData(InputDataOptions(path)).test(
+        chunk_size=chunk_size,
+    )
+
+    assert read_errors is None
+    assert schema_errors is not None
+    failure_cases = schema_errors["data"].failure_cases
+    assert set(failure_cases["column"]) == {"username"}
+    # rows already seen in an earlier chunk or duplicated in the same one
+    assert set(failure_cases["index"]) <= {0, 1, 3, 5}
+    assert {3, 5} <= set(failure_cases["index"])
+
+
+def _failure_cases(
+    schema_errors: dict[str, ple.SchemaErrors] | None,
+) -> tuple[dict[str, int], set[tuple[typing.Any, ...]]] | None:
+    if schema_errors is None:
+        return None
+    errors = schema_errors["data"]
+    return (
+        dict(errors.error_counts),
+        set(
+            errors.failure_cases.select(
+                "failure_case",
+                "schema_context",
+                "column",
+                "check",
+                "index",
+            ).iter_rows(),
+        ),
+    )
+
+
+@parametrize(path=_samples)
+@parametrize(chunk_size=[1, 100_000])
+def test_check_data_polars_engine(path: Path, chunk_size: int) -> None:
+    from folio_user_bulk_edit.data import InputData, InputDataOptions
+
+    data = InputData(InputDataOptions(path))
+    (schema_errors, read_errors, _) = data.test(chunk_size=chunk_size)
+    (polars_schema_errors, polars_read_errors, _) = data.test(
+        chunk_size=chunk_size,
+        engine="polars",
+    )
+
+    assert (polars_read_errors is None) == (read_errors is None)
+    assert _failure_cases(polars_schema_errors) == _failure_cases(schema_errors)
+
+
+@parametrize(
+    "data",
+    [
+        {"departments": [1, 2]},
+        {"active": ["yes", "no"]},
+        {"active": [True, True], "expirationDate": ["2000-01-01", None]},
+        {"type": ["Patron", None], "unknown": ["a", "b"]},
+        {"personal_firstName": ["f0", "f1"]},
+    ],
+)
+def test_check_data_polars_engine_errors(
+    data: dict[str, list[typing.Any]], tmpdir: str
+) -> None:
+    from folio_user_bulk_edit.data import InputData, InputDataOptions
+
+    path = Path(tmpdir) / "data.ndjson"
+    pl.DataFrame(
+        {"username": ["u0", "u1"], "externalSystemId": ["e0", "e1"]} | data,
+    ).write_ndjson(path)
+
+    input_data = InputData(InputDataOptions(path))
+    (schema_errors, _, _) = input_data.test()
+    (polars_schema_errors, _, _) = input_data.test(engine="polars")
+
+    assert schema_errors is not None
+    assert _failure_cases(polars_schema_errors) == _failure_cases(schema_errors)
+
+
+def _every_seventh_invalid(tmpdir: str) -> Path:
+    path = Path(tmpdir) / "data.ndjson"
+    pl.DataFrame(
+        {
+            "username": [f"u{i}" for i in range(1000)],
+            "externalSystemId": [f"e{i}" for i in range(1000)],
+            "departments": ["a,a" if i % 7 == 0 else "a" for i in range(1000)],
+        },
+    ).write_ndjson(path)
+    return path
+
+
+@parametrize(
+    "sample,checked",
+    [
+        ({"rows": 50}, 50),
+        ({"rows": 5000}, 1000),
+        ({"fraction": 0.1}, 100),
+        ({"fraction": 0.001}, 10),
+    ],
+)
+def test_check_data_sample(
+    sample: dict[str, typing.Any], checked: int, tmpdir: str
+) -> None:
+    from folio_user_bulk_edit.data import InputData, InputDataOptions, Sample
+
+    input_data = InputData(InputDataOptions(_every_seventh_invalid(tmpdir)))
+    (schema_errors, read_errors, partial) = input_data.test(
+        chunk_size=100,
+        sample=Sample(**sample, seed=1),
+    )
+
+    assert read_errors is None
+    assert partial == {"data": f"only a sample of {checked} of 1000 rows was checked"}
+    assert schema_errors is not None
+    failure_cases = schema_errors["data"].failure_cases
+    # failure cases are numbered by the row of the file they were read from
+    assert all(i % 7 == 0 for i in failure_cases["index"])
+    assert 0 < failure_cases.height <= checked
+
+    (same_schema_errors, _, _) = input_data.test(
+        chunk_size=100,
+        sample=Sample(**sample, seed=1),
+    )
+    assert same_schema_errors is not None
+    assert failure_cases.equals(same_schema_errors["data"].failure_cases)
+
+
+@parametrize(
+    "max_errors,expected",
+    [
+        (1, "stopped after 15 failure cases in the first 100 rows"),
+        (20, "stopped after 29 failure cases in the first 200 rows"),
+        (1000, None),
+    ],
+)
+def test_check_data_max_errors(
+    max_errors: int, expected: str | None, tmpdir: str
+) -> None:
+    from folio_user_bulk_edit.data import InputData, InputDataOptions
+
+    (schema_errors, read_errors, partial) = InputData(
+        InputDataOptions(_every_seventh_invalid(tmpdir)),
+    ).test(chunk_size=100, max_errors=max_errors)
+
+    assert read_errors is None
+    assert schema_errors is not None
+    assert partial == (None if expected is None else {"data": expected})
+    assert schema_errors["data"].failure_cases.height == (
+        143 if expected is None else int(expected.split()[2])
+    )
+
+
+def test_check_results_partial() -> None:
+    from folio_user_bulk_edit.commands.check import CheckResults
+
+    stream = io.StringIO()
+    CheckResults(
+        partial_checks={"data": "only a sample of 50 of 1000 rows was checked"},
+    ).write_results(stream)
+
+    assert stream.getvalue().splitlines()[1:] == [
+        "✅ Checked data is good!",
+        "⚠️ Data was only partly checked:",
+        "\tdata: only a sample of 50 of 1000 rows was checked",
+    ]
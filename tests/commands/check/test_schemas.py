@@ -0,0 +1,221 @@
+import json
+import os
+import time
+import typing
+from unittest import mock
+from urllib.parse import urlparse
+
+import pandera.polars as pla
+import polars as pl
+import pytest
+from pytest_cases import parametrize
+
+
+# The element-wise checks the vectorized ones replaced
+def _unique_departments(depts: str) -> bool:
+    all_vals = depts.split(",")
+    return len(set(all_vals)) == len(all_vals)
+
+
+def _valid_preferences(prefs: str) -> bool:
+    all_vals = prefs.split(",")
+    unique_vals = set(all_vals)
+    return (
+        len(unique_vals) == len(all_vals)
+        and len(unique_vals - {"Support", "Programs", "Services"}) == 0
+    )
+
+
+def _valid_url(data: str) -> bool:
+    (scheme, netloc, *_) = urlparse(data)
+    return all([scheme, netloc])
+
+
+def _valid_json(data: str) -> bool:
+    try:
+        json.loads(data)
+    except ValueError:
+        return False
+    return True
+
+
+_CHECKS: dict[str, tuple[str, typing.Callable[[str], bool], list[str | None]]] = {
+    "departments": (
+        "unique_departments",
+        _unique_departments,
+        ["a", "a,b", "a,a", "", ",", "a,,b", "a,b,A", "a , a", None],
+    ),
+    "preferredEmailCommunication": (
+        "valid_preferences",
+        _valid_preferences,
+        [
+            "Support",
+            "Support,Programs,Services",
+            "Support,Support",
+            "support",
+            "Support,",
+            "",
+            "Support, Programs",
+            None,
+        ],
+    ),
+    "personal_profilePictureLink": (
+        "valid_url",
+        _valid_url,
+        [
+            "https://folio.org/picture.png",
+            "http://folio.org",
+            "  https://folio.org",
+            "ht\ttps://fo\nlio.org",
+            "h+t.t-p://folio.org",
+            "1http://folio.org",
+            "https:/folio.org",
+            "https:///picture.png",
+            "https://?a=1",
+            "//folio.org/picture.png",
+            "folio.org/picture.png",
+            "mailto:user@folio.org",
+            "http://user@folio.org:80/",
+            "https://fölio.org",
+            "",
+            None,
+        ],
+    ),
+    "customFields": (
+        "_valid_json",
+        _valid_json,
+        [
+            '{"a": 1}',
+            '{"a": [1, "b"]}',
+            '{"b": {"c": null}}',
+            "[1, 2]",
+            "1",
+            "null",
+            '{"a": "\\ud800"}',
+            "{'a': 1}",
+            '{"a": 1',
+            "NaN",
+            "",
+            None,
+        ],
+    ),
+}
+
+
+def _failures(column: str, check: str, values: list[str | None]) -> set[int]:
+    from folio_user_bulk_edit.schemas import UserImportSchema
+
+    data = pl.DataFrame(
+        {
+            "username": [f"u{i}" for i in range(len(values))],
+            "externalSystemId": [f"e{i}" for i in range(len(values))],
+            "personal_lastName": [f"l{i}" for i in range(len(values))],
+            column: pl.Series(values, dtype=pl.Utf8),
+        },
+    )
+    try:
+        UserImportSchema.validate(data, lazy=True)
+    except pla.errors.SchemaErrors as se:
+        return set(
+            se.failure_cases.filter(
+                (pl.col("column") == column) & (pl.col("check") == check),
+            )["index"],
+        )
+    return set()
+
+
+@parametrize("column", list(_CHECKS.keys()))
+def test_vectorized_checks(column: str) -> None:
+    (check, element_wise, values) = _CHECKS[column]
+    valid = [v is None or element_wise(v) for v in values]
+
+    assert _failures(column, check, values) == {i for i, v in enumerate(valid) if not v}
+    assert (
+        _failures(column, check, [v for v, ok in zip(values, valid, strict=True) if ok])
+        == set()
+    )
+
+
+@pytest.mark.skipif(
+    "UBE_BENCHMARK" not in os.environ,
+    reason="Set UBE_BENCHMARK to compare the checks, run with -s to see the timings",
+)
+@parametrize("column", list(_CHECKS.keys()))
+def test_vectorized_checks_benchmark(column: str) -> None:
+    from folio_user_bulk_edit.schemas import UserImportSchema
+
+    (check, element_wise, values) = _CHECKS[column]
+    valid = [v for v in values if v is not None and element_wise(v)]
+    rows = 400_000
+    data = pl.LazyFrame({column: (valid * (rows // len(valid) + 1))[:rows]})
+
+    start = time.perf_counter()
+    data.select(
+        pl.col(column).map_elements(element_wise, return_dtype=pl.Boolean),
+    ).collect()
+    element_wise_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    getattr(UserImportSchema, check)(pla.PolarsData(data, column)).collect()
+    vectorized_seconds = time.perf_counter() - start
+
+    print(  # noqa: T201
+        f"{check}: {element_wise_seconds:.3f}s element-wise, "
+        f"{vectorized_seconds:.3f}s vectorized",
+    )
+
+
+@parametrize(
+    "data,nullable_ok",
+    [
+        (
+            {
+                "personal_lastName": ["l0", "l1"],
+                "personal_firstName": ["f0", None],
+                "requestPreference_holdShelf": [True, True],
+                "requestPreference_delivery": [False, False],
+            },
+            True,
+        ),
+        (
+            {
+                "personal_lastName": ["l0", None],
+                "requestPreference_holdShelf": [True, True],
+                "requestPreference_delivery": [False, False],
+            },
+            False,
+        ),
+        (
+            {
+                "personal_lastName": ["l0", "l1"],
+                "requestPreference_holdShelf": [True, None],
+                "requestPreference_delivery": [False, False],
+            },
+            False,
+        ),
+    ],
+)
+def test_sub_schemas_single_pass(
+    data: dict[str, list[typing.Any]], nullable_ok: bool
+) -> None:
+    from folio_user_bulk_edit.schemas import UserImportSchema
+
+    frame = pl.DataFrame(
+        {"username": ["u0", "u1"], "externalSystemId": ["e0", "e1"]} | data,
+    )
+    with mock.patch.object(
+        pl.Expr,
+        "has_nulls",
+        autospec=True,
+        side_effect=pl.Expr.has_nulls,
+    ) as has_nulls:
+        checks: set[str] = set()
+        try:
+            UserImportSchema.validate(frame, lazy=True)
+        except pla.errors.SchemaErrors as se:
+            checks = {e.check.name for e in se.schema_errors}
+
+    # each required column is only checked once for both sub-schemas
+    assert has_nulls.call_count == 3
+    assert checks <= {"personal_not_nullable_columns", "request_not_nullable_columns"}
+    assert (len(checks) == 0) == nullable_ok
@@ -0,0 +1,157 @@
+import typing
+import uuid
+from datetime import date
+from pathlib import Path
+from unittest import mock
+
+import polars as pl
+from pytest_cases import parametrize
+
+from folio_user_bulk_edit.data import InputData, InputDataOptions
+
+
+def _folio_users() -> list[dict[str, typing.Any]]:
+    users: list[dict[str, typing.Any]] = [
+        {
+            "id": str(uuid.UUID(int=i * (2**128 // 50), version=4)),
+            "username": f"u{i}",
+            "externalSystemId": f"e{i}",
+            "active": True,
+            "patronGroup": "staff-id",
+            "metadata": {"createdDate": "2025-01-01T00:00:00.000+00:00"},
+            "personal": {"lastName": f"last{i}"},
+        }
+        for i in range(50)
+    ]
+    users[7] |= {
+        "barcode": "0007",
+        "departments": ["d1-id", "d2-id"],
+        "enrollmentDate": "2025-04-08T00:00:00.000+00:00",
+        "customFields": {"field": "value"},
+        "tags": {"tagList": ["a", "b"]},
+        "personal": {
+            "lastName": "last7",
+            "email": "u7@example.com",
+            "dateOfBirth": "1999-01-01T00:00:00.000+00:00",
+            "preferredContactTypeId": "002",
+            "addresses": [
+                {"city": "second", "addressTypeId": "work-id"},
+                {"city": "first", "addressTypeId": "home-id", "primaryAddress": True},
+            ],
+        },
+    }
+    return users
+
+
+def _client(users: list[dict[str, typing.Any]]) -> mock.Mock:
+    def iter_data(
+        _: str,
+        __: str,
+        cql_query: str,
+        limit: int,
+    ) -> typing.Iterator[dict[str, typing.Any]]:
+        assert limit == 10
+        bounds = [b.split("<")[-1].split("=")[-1] for b in cql_query.split(" and ")]
+        yield from sorted(
+            (
+                u
+                for u in users
+                if u["id"] >= bounds[0] and (len(bounds) == 1 or u["id"] < bounds[1])
+            ),
+            key=lambda u: u["id"],
+        )
+
+    def get_data(endpoint: str, **kwargs: typing.Any) -> typing.Any:
+        if endpoint == "/request-preference-storage/request-preference":
+            return [
+                {
+                    "id": str(uuid.UUID(int=i + 1, version=4)),
+                    "userId": u["id"],
+                    "holdShelf": True,
+                    "delivery": i != 7,
+                }
+                | ({"defaultDeliveryAddressTypeId": "home-id"} if i == 7 else {})
+                for i, u in enumerate(users)
+                if u["id"] in kwargs["cql_query"]
+            ]
+        return {
+            "/groups": [{"id": "staff-id", "group": "staff"}],
+            "/departments": [
+                {"id": "d1-id", "name": "d1"},
+                {"id": "d2-id", "name": "d2"},
+            ],
+            "/addresstypes": [
+                {"id": "home-id", "addressType": "home"},
+                {"id": "work-id", "addressType": "work"},
+            ],
+        }[endpoint]
+
+    client = mock.Mock()
+    client.iter_data = iter_data
+    client.get_data = get_data
+    return client
+
+
+@parametrize(output=["users.parquet", "users.csv"])
+def test_export(output: str, tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_export as uut
+
+    users = _folio_users()
+    with mock.patch("folio_user_bulk_edit.folio.FolioClient") as client_mock:
+        client_mock.return_value.__enter__.return_value = _client(users)
+        res = uut.run(
+            uut.ExportOptions(
+                "",
+                "",
+                "",
+                "",
+                Path(tmpdir) / output,
+                10,
+                4,
+            ),
+        )
+
+    assert res.exported_records == 50
+
+    exported = (
+        pl.read_csv(
+            res.output,
+            try_parse_dates=True,
+            schema_overrides={"barcode": pl.Utf8},
+        )
+        if output.endswith(".csv")
+        else pl.read_parquet(res.output)
+    )
+    assert exported.columns[:2] == ["username", "externalSystemId"]
+    assert exported["id"].to_list() == sorted(u["id"] for u in users)
+
+    u7 = exported.filter(pl.col("username") == "u7").row(0, named=True)
+    assert {k: v for k, v in u7.items() if v is not None} == {
+        "id": users[7]["id"],
+        "username": "u7",
+        "externalSystemId": "e7",
+        "barcode": "0007",
+        "active": True,
+        "patronGroup": "staff",
+        "departments": "d1,d2",
+        "enrollmentDate": date(2025, 4, 8),
+        "tags": "a,b",
+        "customFields": '{"field": "value"}',
+        "personal_lastName": "last7",
+        "personal_email": "u7@example.com",
+        "personal_dateOfBirth": date(1999, 1, 1),
+        "personal_preferredContactTypeId": "email",
+        "personal_address_primary_city": "first",
+        "personal_address_primary_addressTypeId": "home",
+        "personal_address_primary_primaryAddress": True,
+        "personal_address_secondary_city": "second",
+        "personal_address_secondary_addressTypeId": "work",
+        "requestPreference_id": str(uuid.UUID(int=8, version=4)),
+        "requestPreference_holdShelf": True,
+        "requestPreference_delivery": False,
+        "requestPreference_defaultDeliveryAddressTypeId": "home",
+    }
+
+    if output.endswith(".csv"):
+        # the export can be imported again
+        assert InputData(InputDataOptions(res.output)).test() == (None, None, None)
@@ -1,12 +1,19 @@
+import gzip
+import itertools
+import json
+import threading
+import time
 import typing
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from datetime import date
 from pathlib import Path
 from unittest import mock
 
 import httpx
 import polars as pl
 import pyfolioclient as pfc
+import pytest
 from pytest_cases import parametrize, parametrize_with_cases
 
 
@@ -86,14 +93,14 @@ class RetryCases:
         )
 
 
-@mock.patch("pyfolioclient.FolioBaseClient")
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
 @parametrize_with_cases("tc", RetryCases)
 def test_retry(base_client_mock: mock.Mock, tc: RetryCase) -> None:
     import folio_user_bulk_edit.commands.user_import as uut
 
     # I couldn't figure this out better
     post_data_mock: mock.MagicMock = (
-        base_client_mock.return_value.__enter__.return_value.post_data
+        base_client_mock.return_value.__enter__.return_value.post_json
     )
     post_data_mock.side_effect = [*tc.side_effect, mock.DEFAULT]
     post_data_mock.return_value = {
@@ -123,7 +130,534 @@ def test_retry(base_client_mock: mock.Mock, tc: RetryCase) -> None:
     assert res.failed_records == tc.failed_records
 
 
-@mock.patch("pyfolioclient.FolioBaseClient")
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+def test_retry_backoff(base_client_mock: mock.Mock, tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    tc = BehaviorCase(Path(tmpdir) / "data.csv")
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.side_effect = [*[httpx.HTTPError("")] * 3, mock.DEFAULT]
+    post_data_mock.return_value = {
+        "createdRecords": 100,
+        "updatedRecords": 0,
+        "failedRecords": 0,
+    }
+
+    with tc.setup():
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                100,
+                3,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                retry_backoff=0.01,
+                max_retry_backoff=0.02,
+            ),
+        )
+
+    assert post_data_mock.call_count == 4
+    assert res.created_records == 100
+    assert 0 < res.backoff_seconds <= 0.05
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+def test_circuit_breaker(
+    base_client_mock: mock.Mock,
+    tmpdir: str,
+    caplog: typing.Any,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    tc = BehaviorCase(Path(tmpdir) / "data.csv")
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.side_effect = [*[httpx.HTTPError("")] * 3, *[mock.DEFAULT] * 7]
+    post_data_mock.return_value = {
+        "createdRecords": 10,
+        "updatedRecords": 0,
+        "failedRecords": 0,
+    }
+
+    with tc.setup():
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                10,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                circuit_breaker_threshold=2,
+                circuit_breaker_cooldown=0.05,
+            ),
+        )
+
+    assert res.created_records == 70
+    assert res.failed_records == 30
+    # The third failure came right after a cooldown and opened it again
+    assert caplog.text.count("pausing for") == 2
+    assert res.backoff_seconds > 0.05
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize("recovers", [True, False])
+def test_defer_failed_batches(
+    base_client_mock: mock.Mock,
+    recovers: bool,
+    tmpdir: str,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    tc = BehaviorCase(Path(tmpdir) / "data.csv")
+    journal = Path(tmpdir) / "journal.tsv"
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, int]:
+        users = len(json.loads(payload)["users"])
+        # The second and fourth batches fail the first time they are sent
+        if post_data_mock.call_count in (2, 4) or (
+            not recovers and post_data_mock.call_count > 5
+        ):
+            unreachable = "FOLIO is restarting"
+            raise httpx.ConnectError(unreachable)
+        return {"createdRecords": users, "updatedRecords": 0, "failedRecords": 0}
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.side_effect = post_json
+
+    with (
+        tc.setup(),
+        mock.patch("polars.read_parquet", side_effect=pl.read_parquet) as read,
+    ):
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                20,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                defer_failed_batches=True,
+                journal=journal,
+            ),
+        )
+
+    sizes = [len(json.loads(c.args[1])["users"]) for c in post_data_mock.call_args_list]
+    # The two deferred batches are regrouped into two full batches
+    assert sizes == [20] * 7
+    assert res.deferred_records == 40
+    # and read back one at a time
+    assert read.call_count == 2
+    # Only the batches that weren't deferred cover a range of rows
+    assert pl.read_csv(journal, separator="\t").select("start", "end").rows() == [
+        (0, 20),
+        (40, 60),
+        (80, 100),
+    ]
+    if recovers:
+        assert res.created_records == 100
+        assert res.failed_records == 0
+    else:
+        assert res.created_records == 60
+        assert res.failed_records == 40
+        assert res.failed_users.height == 40
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize("suffix", [".csv", ".parquet", ".ndjson"])
+def test_failed_users_file(
+    base_client_mock: mock.Mock,
+    suffix: str,
+    tmpdir: str,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    tc = BehaviorCase(Path(tmpdir) / "data.csv")
+    failed_users = Path(tmpdir) / f"failedUsers{suffix}"
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.side_effect = [
+        pfc.BadRequestError(""),
+        {
+            "createdRecords": 15,
+            "updatedRecords": 0,
+            "failedRecords": 5,
+            "failedUsers": [
+                {"username": "u", "externalSystemId": "e", "errorMessage": "bad"},
+            ]
+            * 5,
+        },
+        pfc.BadRequestError(""),
+        pfc.BadRequestError(""),
+        pfc.BadRequestError(""),
+    ]
+
+    with tc.setup():
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                20,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                failed_users=failed_users,
+            ),
+        )
+
+    readers: dict[str, typing.Callable[[Path], pl.DataFrame]] = {
+        ".csv": pl.read_csv,
+        ".parquet": pl.read_parquet,
+        ".ndjson": pl.read_ndjson,
+    }
+    written = readers[suffix](failed_users)
+    assert written.columns == [
+        "source",
+        "username",
+        "externalSystemId",
+        "errorMessage",
+        "row",
+    ]
+    assert written.height == 85
+    assert written["errorMessage"].to_list()[20:25] == ["bad"] * 5
+    assert res.failed_records == 85
+    assert res.failed_users.height == uut._FAILED_USERS_SAMPLE  # noqa: SLF001
+    assert not failed_users.with_name(failed_users.name + ".parts").exists()
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize("suffix", [None, ".csv", ".ndjson"])
+@parametrize("name", ["data", "2024"])
+def test_rejects(
+    base_client_mock: mock.Mock,
+    suffix: str | None,
+    name: str,
+    tmpdir: str,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    data = Path(tmpdir) / f"{name}.csv"
+    rejects = Path(tmpdir) / "rejects"
+    data.write_text(
+        "# a comment that isn't a row\n"
+        + pl.DataFrame(
+            {
+                "username": [f"u{i}" for i in range(30)],
+                "externalSystemId": [f"e{i}" for i in range(30)],
+                "enrollmentDate": ["2025-01-02"] * 30,
+                "barcode": [f"{i:03d}" for i in range(30)],
+            },
+        ).write_csv(),
+    )
+    posted: list[list[dict[str, typing.Any]]] = []
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, typing.Any]:
+        users = json.loads(payload)["users"]
+        posted.append(users)
+        if any(u["username"] == "u10" for u in users):
+            bad = "Bad request"
+            raise pfc.BadRequestError(bad)
+        failed = [
+            {"username": u["username"], "errorMessage": f"bad {u['username']}"}
+            for u in users
+            if u["username"] in ("u3", "u27")
+        ]
+        return {
+            "createdRecords": len(users) - len(failed),
+            "updatedRecords": 0,
+            "failedRecords": len(failed),
+            "failedUsers": failed,
+        }
+
+    base_client_mock.return_value.__enter__.return_value.post_json = post_json
+
+    def run(location: Path) -> typing.Any:
+        return uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                {name: location},
+                10,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                failed_users=None if suffix is None else Path(tmpdir) / f"f{suffix}",
+                rejects=rejects,
+            ),
+        )
+
+    res = run(data)
+    assert res.failed_records == 12
+
+    rejected = pl.read_csv(rejects / f"{name}.csv", infer_schema=False)
+    assert rejected.columns == [
+        "username",
+        "externalSystemId",
+        "enrollmentDate",
+        "barcode",
+        "errorMessage",
+    ]
+    assert rejected["username"].to_list() == [
+        "u3",
+        *[f"u{i}" for i in range(10, 20)],
+        "u27",
+    ]
+    assert rejected["barcode"].to_list()[:2] == ["003", "010"]
+    assert rejected["errorMessage"].to_list()[0] == "bad u3"
+
+    # u19 is no longer in a batch with u10
+    posted.clear()
+    res = run(rejects / f"{name}.csv")
+    assert res.failed_records == 11
+    assert "errorMessage" not in posted[0][0]
+    assert posted[0][0]["enrollmentDate"] == "2025-01-02"
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize("file_concurrency", [1, 3])
+def test_file_concurrency(
+    base_client_mock: mock.Mock,
+    file_concurrency: int,
+    tmpdir: str,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+    from folio_user_bulk_edit.data import InputData
+
+    sizes = {"small": 5, "large": 50, "medium": 20}
+    data = {f: Path(tmpdir) / f"{f}.csv" for f in sizes}
+    for f, n in sizes.items():
+        pl.DataFrame(
+            {
+                "username": [f"{f}{i}" for i in range(n)],
+                "externalSystemId": [f"{f}{i}" for i in range(n)],
+            },
+        ).write_csv(data[f])
+
+    # Every file has to be being read before any of them can be
+    reading = threading.Barrier(file_concurrency, timeout=5)
+    batch = InputData.batch
+
+    def batch_spy(self: InputData, *args: typing.Any) -> typing.Any:
+        reading.wait()
+        yield from batch(self, *args)
+
+    posted: list[str] = []
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, typing.Any]:
+        users = [u["username"] for u in json.loads(payload)["users"]]
+        posted.extend(users)
+        failed = [u for u in users if u.endswith("3")]
+        return {
+            "createdRecords": len(users) - len(failed),
+            "updatedRecords": 0,
+            "failedRecords": len(failed),
+            "failedUsers": [
+                {"username": u, "externalSystemId": u, "errorMessage": "bad"}
+                for u in failed
+            ],
+        }
+
+    base_client_mock.return_value.__enter__.return_value.post_json = post_json
+
+    with mock.patch.object(InputData, "batch", batch_spy):
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                data,
+                10,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                file_concurrency=file_concurrency,
+            ),
+        )
+
+    if file_concurrency == 1:
+        # One file after the other, largest first
+        assert [p.rstrip("0123456789") for p in posted] == [
+            *["large"] * 50,
+            *["medium"] * 20,
+            *["small"] * 5,
+        ]
+    assert res.created_records == 75 - 8
+    assert {f: (r.created_records, r.failed_records) for f, r in res.files.items()} == {
+        "large": (45, 5),
+        "medium": (18, 2),
+        "small": (4, 1),
+    }
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize(
+    "suffix",
+    [".parquet", ".arrow", ".ipc", ".ndjson", ".csv.gz", ".csv.zst"],
+)
+def test_input_formats(base_client_mock: mock.Mock, suffix: str, tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    if suffix == ".csv.zst":
+        zstandard = pytest.importorskip("zstandard")
+
+    users = pl.DataFrame(
+        {
+            "username": [f"u{i}" for i in range(100)],
+            "externalSystemId": [f"e{i}" for i in range(100)],
+            "barcode": [None if i % 7 == 0 else f"{i:05d}" for i in range(100)],
+            "enrollmentDate": [date(2025, 1, 1 + i % 28) for i in range(100)],
+            "departments": ["a,b"] * 100,
+            # quoted values spanning lines around the edges of batches
+            "personal_lastName": [
+                f'"L"\n{i}' if i % 29 < 2 else f"L{i}" for i in range(100)
+            ],
+        },
+    )
+    data = {
+        ".csv": Path(tmpdir) / "data.csv",
+        suffix: Path(tmpdir) / f"data{suffix}",
+    }
+    users.write_csv(data[".csv"])
+    writers: dict[str, typing.Callable[[Path], object]] = {
+        ".parquet": users.write_parquet,
+        ".arrow": users.write_ipc,
+        ".ipc": users.write_ipc,
+        ".ndjson": users.write_ndjson,
+        ".csv.gz": lambda p: p.write_bytes(gzip.compress(data[".csv"].read_bytes())),
+        ".csv.zst": lambda p: p.write_bytes(
+            zstandard.ZstdCompressor().compress(data[".csv"].read_bytes()),
+        ),
+    }
+    writers[suffix](data[suffix])
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.return_value = {
+        "createdRecords": 0,
+        "updatedRecords": 0,
+        "failedRecords": 0,
+    }
+
+    payloads = {}
+    for s, p in data.items():
+        post_data_mock.reset_mock()
+        uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                p,
+                30,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+            ),
+        )
+        payloads[s] = [c.args[1] for c in post_data_mock.call_args_list]
+
+    assert len(payloads[suffix]) == 4
+    assert payloads[suffix] == payloads[".csv"]
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize(
+    "suffix,read_ipc_calls,window_calls", [(".parquet", 0, 1), (".arrow", 1, 0)]
+)
+def test_input_formats_read_once(
+    base_client_mock: mock.Mock,
+    suffix: str,
+    read_ipc_calls: int,
+    window_calls: int,
+    tmpdir: str,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    data = Path(tmpdir) / f"data{suffix}"
+    users = pl.DataFrame(
+        {
+            "username": [f"u{i}" for i in range(100)],
+            "externalSystemId": [f"e{i}" for i in range(100)],
+        },
+    )
+    if suffix == ".parquet":
+        users.write_parquet(data)
+    else:
+        users.write_ipc(data)
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.return_value = {
+        "createdRecords": 0,
+        "updatedRecords": 0,
+        "failedRecords": 0,
+    }
+
+    with (
+        mock.patch("polars.read_ipc", side_effect=pl.read_ipc) as read_ipc,
+        mock.patch.object(
+            pl.LazyFrame,
+            "slice",
+            autospec=True,
+            side_effect=pl.LazyFrame.slice,
+        ) as window,
+    ):
+        uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                data,
+                7,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+            ),
+        )
+
+    # the file is read once and not once per batch
+    assert read_ipc.call_count == read_ipc_calls
+    assert window.call_count == window_calls
+    assert post_data_mock.call_count == 15
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
 def test_batch(base_client_mock: mock.Mock, tmpdir: str) -> None:
     import folio_user_bulk_edit.commands.user_import as uut
 
@@ -131,7 +665,7 @@ def test_batch(base_client_mock: mock.Mock, tmpdir: str) -> None:
 
     # I couldn't figure this out better
     post_data_mock: mock.MagicMock = (
-        base_client_mock.return_value.__enter__.return_value.post_data
+        base_client_mock.return_value.__enter__.return_value.post_json
     )
     post_data_mock.side_effect = [
         {
@@ -165,3 +699,1021 @@ def test_batch(base_client_mock: mock.Mock, tmpdir: str) -> None:
         assert res.created_records == 25
         assert res.updated_records == 15
         assert res.failed_records == 35
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+def test_batch_single_pass(base_client_mock: mock.Mock, tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    tc = BehaviorCase(Path(tmpdir) / "data.csv")
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.return_value = {
+        "createdRecords": 0,
+        "updatedRecords": 0,
+        "failedRecords": 0,
+    }
+
+    parsed_rows: list[int] = []
+    read_csv_batched = pl.read_csv_batched
+
+    def spy(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        reader = read_csv_batched(*args, **kwargs)
+        next_batches = reader.next_batches
+
+        def spy_next(n: int) -> list[pl.DataFrame] | None:
+            chunks = next_batches(n)
+            parsed_rows.extend(c.height for c in chunks or [])
+            return chunks
+
+        reader.next_batches = spy_next  # type: ignore[method-assign]
+        return reader
+
+    with (
+        tc.setup(),
+        mock.patch("polars.read_csv_batched", side_effect=spy) as read_mock,
+        mock.patch("polars.scan_csv") as scan_mock,
+    ):
+        uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                7,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+            ),
+        )
+
+    read_mock.assert_called_once()
+    scan_mock.assert_not_called()
+    assert sum(parsed_rows) == 100
+    assert [
+        len(json.loads(c.args[1])["users"]) for c in post_data_mock.call_args_list
+    ] == [
+        *([7] * 14),
+        2,
+    ]
+
+
+@dataclass
+class ConcurrencyCase(BehaviorCase):
+    concurrency: int
+    side_effect: list[Exception | None]
+    created_records: int
+    failed_records: int
+
+
+class ConcurrencyCases:
+    @parametrize(concurrency=[1, 3, 10])
+    def case_concurrency_ok(self, concurrency: int, tmpdir: str) -> ConcurrencyCase:
+        return ConcurrencyCase(
+            Path(tmpdir) / "data.csv",
+            concurrency,
+            [None] * 10,
+            100,
+            0,
+        )
+
+    @parametrize(concurrency=[1, 3, 10])
+    def case_concurrency_errors(
+        self,
+        concurrency: int,
+        tmpdir: str,
+    ) -> ConcurrencyCase:
+        return ConcurrencyCase(
+            Path(tmpdir) / "data.csv",
+            concurrency,
+            [
+                None,
+                pfc.BadRequestError(),
+                None,
+                pfc.UnprocessableContentError(),
+                None,
+                None,
+                httpx.HTTPError(""),
+                None,
+                None,
+                None,
+                None,
+            ],
+            80,
+            20,
+        )
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize_with_cases("tc", ConcurrencyCases)
+def test_concurrency(base_client_mock: mock.Mock, tc: ConcurrencyCase) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    lock = threading.Lock()
+    side_effect = iter(tc.side_effect)
+    in_flight = 0
+    max_in_flight = 0
+
+    def post_data(_: str, content: bytes, **__: typing.Any) -> dict[str, int]:
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            err = next(side_effect)
+        time.sleep(0.05)
+        with lock:
+            in_flight -= 1
+        if err is not None:
+            raise err
+        return {
+            "createdRecords": len(json.loads(content)["users"]),
+            "updatedRecords": 0,
+            "failedRecords": 0,
+        }
+
+    base_client_mock.return_value.__enter__.return_value.post_json = post_data
+
+    with tc.setup():
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                10,
+                1,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                concurrency=tc.concurrency,
+            ),
+        )
+
+    assert max_in_flight == tc.concurrency
+    assert res.created_records == tc.created_records
+    assert res.failed_records == tc.failed_records
+    assert res.failed_users.height == tc.failed_records
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+def test_pipeline(base_client_mock: mock.Mock, tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    tc = BehaviorCase(Path(tmpdir) / "data.csv")
+
+    prepared = 0
+    posted = 0
+    max_ahead = 0
+    overlapped = threading.Event()
+    prepare_batch = uut._prepare_batch  # noqa: SLF001
+
+    def prepare_spy(*args: typing.Any) -> typing.Any:
+        nonlocal prepared
+        res = prepare_batch(*args)
+        prepared += 1
+        if prepared - posted > 1:
+            overlapped.set()
+        return res
+
+    def post_data(*_: typing.Any, **__: typing.Any) -> dict[str, int]:
+        nonlocal posted, max_ahead
+        # the next batches are prepared while this one is "on the wire"
+        overlapped.wait(timeout=5)
+        max_ahead = max(max_ahead, prepared - posted)
+        posted += 1
+        return {"createdRecords": 10, "updatedRecords": 0, "failedRecords": 0}
+
+    base_client_mock.return_value.__enter__.return_value.post_json = post_data
+
+    with (
+        tc.setup(),
+        mock.patch.object(uut, "_prepare_batch", side_effect=prepare_spy),
+    ):
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                10,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+            ),
+        )
+
+    assert overlapped.is_set()
+    # one batch being sent, one buffered, and one being prepared
+    assert max_ahead <= 3
+    assert res.created_records == 100
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+def test_compress_requests(base_client_mock: mock.Mock, tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    tc = BehaviorCase(Path(tmpdir) / "data.csv")
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.return_value = {
+        "createdRecords": 100,
+        "updatedRecords": 0,
+        "failedRecords": 0,
+    }
+
+    payloads: dict[bool, bytes] = {}
+    with tc.setup():
+        for compress in [False, True]:
+            uut.run(
+                uut.ImportOptions(
+                    "",
+                    "",
+                    "",
+                    "",
+                    tc.data_location,
+                    1000,
+                    0,
+                    deactivate_missing_users=False,
+                    update_all_fields=False,
+                    source_type=None,
+                    compress_requests=compress,
+                ),
+            )
+            post_data_mock.assert_called_once()
+            payloads[compress] = post_data_mock.call_args.args[1]
+            assert post_data_mock.call_args.kwargs["content_encoding"] == (
+                "gzip" if compress else None
+            )
+            post_data_mock.reset_mock()
+
+    assert gzip.decompress(payloads[True]) == payloads[False]
+    assert len(payloads[True]) < len(payloads[False])
+
+
+@dataclass
+class MaxBatchBytesCase:
+    data_location: Path
+    batch_size: int
+    max_batch_bytes: int | None
+    batch_users: list[int]
+
+    @contextmanager
+    def setup(self) -> typing.Any:
+        # every 10th user has a large customField
+        pl.DataFrame(
+            {
+                "username": [f"u{i}" for i in range(100)],
+                "externalSystemId": [f"e{i}" for i in range(100)],
+                "customFields": [
+                    json.dumps({"field": "x" * (1000 if i % 10 == 9 else 10)})
+                    for i in range(100)
+                ],
+            },
+        ).write_csv(self.data_location)
+        yield
+
+
+class MaxBatchBytesCases:
+    def case_rows_only(self, tmpdir: str) -> MaxBatchBytesCase:
+        return MaxBatchBytesCase(
+            Path(tmpdir) / "data.csv",
+            30,
+            None,
+            [30, 30, 30, 10],
+        )
+
+    def case_bytes(self, tmpdir: str) -> MaxBatchBytesCase:
+        return MaxBatchBytesCase(
+            Path(tmpdir) / "data.csv",
+            30,
+            2000,
+            [11, *([10] * 8), 9],
+        )
+
+    def case_rows_before_bytes(self, tmpdir: str) -> MaxBatchBytesCase:
+        return MaxBatchBytesCase(
+            Path(tmpdir) / "data.csv",
+            5,
+            2000,
+            [5] * 20,
+        )
+
+    def case_oversized_rows(self, tmpdir: str) -> MaxBatchBytesCase:
+        return MaxBatchBytesCase(
+            Path(tmpdir) / "data.csv",
+            30,
+            500,
+            [4, 4, 1, 1] * 10,
+        )
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize_with_cases("tc", MaxBatchBytesCases)
+def test_max_batch_bytes(base_client_mock: mock.Mock, tc: MaxBatchBytesCase) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.return_value = {
+        "createdRecords": 0,
+        "updatedRecords": 0,
+        "failedRecords": 0,
+    }
+
+    with tc.setup():
+        uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                tc.batch_size,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                max_batch_bytes=tc.max_batch_bytes,
+            ),
+        )
+
+    payloads = [c.args[1] for c in post_data_mock.call_args_list]
+    assert [len(json.loads(p)["users"]) for p in payloads] == tc.batch_users
+    if tc.max_batch_bytes is not None:
+        for p in payloads:
+            assert len(json.loads(p)["users"]) == 1 or len(p) <= tc.max_batch_bytes
+
+
+@dataclass
+class AdaptiveBatchSizeCase:
+    data_location: Path
+    target_latency: float
+    fail_over: int | None
+    check_sizes: typing.Callable[[list[int]], bool]
+
+    @contextmanager
+    def setup(self) -> typing.Any:
+        pl.DataFrame(
+            {
+                "username": [f"u{i}" for i in range(1000)],
+                "externalSystemId": [f"e{i}" for i in range(1000)],
+            },
+        ).write_csv(self.data_location)
+        yield
+
+
+class AdaptiveBatchSizeCases:
+    def case_grows(self, tmpdir: str) -> AdaptiveBatchSizeCase:
+        return AdaptiveBatchSizeCase(
+            Path(tmpdir) / "data.csv",
+            60,
+            None,
+            # the last batch is whatever is left over
+            lambda s: s[:-1] == sorted(s[:-1]) and s[-2] > 10,
+        )
+
+    def case_shrinks_when_slow(self, tmpdir: str) -> AdaptiveBatchSizeCase:
+        return AdaptiveBatchSizeCase(
+            Path(tmpdir) / "data.csv",
+            0,
+            None,
+            lambda s: s == sorted(s, reverse=True) and s[-1] == 5,
+        )
+
+    def case_shrinks_on_errors(self, tmpdir: str) -> AdaptiveBatchSizeCase:
+        return AdaptiveBatchSizeCase(
+            Path(tmpdir) / "data.csv",
+            60,
+            40,
+            lambda s: any(a > 40 and b <= 40 for (a, b) in itertools.pairwise(s)),
+        )
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize_with_cases("tc", AdaptiveBatchSizeCases)
+def test_adaptive_batch_size(
+    base_client_mock: mock.Mock,
+    tc: AdaptiveBatchSizeCase,
+    caplog: typing.Any,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, int]:
+        users = len(json.loads(payload)["users"])
+        if tc.fail_over is not None and users > tc.fail_over:
+            timeout = "too many users"
+            raise httpx.TimeoutException(timeout)
+        return {"createdRecords": users, "updatedRecords": 0, "failedRecords": 0}
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.side_effect = post_json
+
+    caplog.set_level("INFO")
+    with tc.setup():
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                10,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                adaptive_batch_size=True,
+                min_batch_size=5,
+                max_batch_size=100,
+                target_latency=tc.target_latency,
+            ),
+        )
+
+    sizes = [len(json.loads(c.args[1])["users"]) for c in post_data_mock.call_args_list]
+    assert sum(sizes) == 1000
+    assert max(sizes) <= 100
+    assert min(sizes[:-1]) >= 5
+    assert tc.check_sizes(sizes)
+    assert res.created_records + res.failed_records == 1000
+    assert "batch size is now" in caplog.text
+
+
+@parametrize("min_batch_size,max_batch_size", [(0, 100), (-1, 100), (101, 100)])
+def test_adaptive_batch_size_bounds(
+    min_batch_size: int,
+    max_batch_size: int,
+    tmpdir: str,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    with pytest.raises(ValueError, match="min_batch_size"):
+        uut.ImportOptions(
+            "",
+            "",
+            "",
+            "",
+            Path(tmpdir) / "data.csv",
+            10,
+            0,
+            deactivate_missing_users=False,
+            update_all_fields=False,
+            source_type=None,
+            adaptive_batch_size=True,
+            min_batch_size=min_batch_size,
+            max_batch_size=max_batch_size,
+        )
+
+
+def _bad_request(message: str) -> Exception:
+    req = httpx.Request("POST", "http://folio.org/user-import")
+    err = pfc.BadRequestError("Bad request/CQL syntax error")
+    err.__cause__ = httpx.HTTPStatusError(
+        "",
+        request=req,
+        response=httpx.Response(400, text=message, request=req),
+    )
+    return err
+
+
+@dataclass
+class BisectCase:
+    data_location: Path
+    bisect: bool
+    rejection: typing.Callable[[str], Exception]
+    failed_users: dict[str, str]
+    max_calls: int
+    reject_all: bool = False
+
+    @contextmanager
+    def setup(self) -> typing.Any:
+        pl.DataFrame(
+            {
+                "username": [f"u{i}" for i in range(100)],
+                "externalSystemId": [f"e{i}" for i in range(100)],
+            },
+        ).write_csv(self.data_location)
+        yield
+
+
+class BisectCases:
+    def case_disabled(self, tmpdir: str) -> BisectCase:
+        return BisectCase(
+            Path(tmpdir) / "data.csv",
+            bisect=False,
+            rejection=pfc.UnprocessableContentError,
+            failed_users={f"u{i}": "bad u13" for i in range(100)},
+            max_calls=1,
+        )
+
+    def case_unprocessable(self, tmpdir: str) -> BisectCase:
+        return BisectCase(
+            Path(tmpdir) / "data.csv",
+            bisect=True,
+            rejection=pfc.UnprocessableContentError,
+            failed_users={"u13": "bad u13", "u77": "bad u77"},
+            # each poison user costs at most two requests per level
+            max_calls=1 + 2 * 2 * 7,
+        )
+
+    def case_bad_request(self, tmpdir: str) -> BisectCase:
+        return BisectCase(
+            Path(tmpdir) / "data.csv",
+            bisect=True,
+            rejection=_bad_request,
+            failed_users={
+                "u13": "Bad request/CQL syntax error: bad u13",
+                "u77": "Bad request/CQL syntax error: bad u77",
+            },
+            max_calls=1 + 2 * 2 * 7,
+        )
+
+    def case_rejected_as_a_whole(self, tmpdir: str) -> BisectCase:
+        return BisectCase(
+            Path(tmpdir) / "data.csv",
+            bisect=True,
+            rejection=pfc.UnprocessableContentError,
+            failed_users={f"u{i}": "bad batch" for i in range(100)},
+            # not a request for every user
+            max_calls=1 + 2 * 2 * 7,
+            reject_all=True,
+        )
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize_with_cases("tc", BisectCases)
+def test_bisect_rejected_batches(base_client_mock: mock.Mock, tc: BisectCase) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, int]:
+        users = [u["username"] for u in json.loads(payload)["users"]]
+        if tc.reject_all:
+            bad = "bad batch"
+            raise tc.rejection(bad)
+        for poison in ["u13", "u77"]:
+            if poison in users:
+                bad = f"bad {poison}"
+                raise tc.rejection(bad)
+        return {"createdRecords": len(users), "updatedRecords": 0, "failedRecords": 0}
+
+    post_data_mock: mock.MagicMock = (
+        base_client_mock.return_value.__enter__.return_value.post_json
+    )
+    post_data_mock.side_effect = post_json
+
+    with tc.setup():
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                100,
+                1,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                bisect_rejected_batches=tc.bisect,
+            ),
+        )
+
+    assert post_data_mock.call_count <= tc.max_calls
+    assert res.created_records == 100 - len(tc.failed_users)
+    assert res.failed_records == len(tc.failed_users)
+    assert (
+        dict(res.failed_users.select("username", "errorMessage").iter_rows())
+        == tc.failed_users
+    )
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+def test_resume(base_client_mock: mock.Mock, tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    data = {f: Path(tmpdir) / f"{f}.csv" for f in ["a", "b"]}
+    for f, p in data.items():
+        pl.DataFrame(
+            {
+                "username": [f"{f}{i}" for i in range(30)],
+                "externalSystemId": [f"{f}{i}" for i in range(30)],
+            },
+        ).write_csv(p)
+
+    posted: list[list[str]] = []
+    down = {"a15", "b25"}
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, int]:
+        users = [u["username"] for u in json.loads(payload)["users"]]
+        posted.append(users)
+        if any(u in down for u in users):
+            vpn = "vpn dropped"
+            raise httpx.ConnectError(vpn)
+        return {"createdRecords": len(users), "updatedRecords": 0, "failedRecords": 0}
+
+    base_client_mock.return_value.__enter__.return_value.post_json = post_json
+
+    def run(journal: str, resume: str | None) -> typing.Any:
+        posted.clear()
+        return uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                data,
+                10,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                concurrency=2,
+                journal=Path(tmpdir) / journal,
+                resume=None if resume is None else Path(tmpdir) / resume,
+            ),
+        )
+
+    res = run("first.tsv", None)
+    assert res.created_records == 40
+    assert res.failed_records == 20
+    assert len(posted) == 6
+
+    # only the batches that didn't make it to FOLIO are sent again
+    down.clear()
+    res = run("second.tsv", "first.tsv")
+    assert res.created_records == 20
+    assert res.skipped_records == 40
+    assert sorted(u[0] for u in posted) == ["a10", "b20"]
+
+    # the new journal can be resumed from by itself
+    res = run("third.tsv", "second.tsv")
+    assert res.skipped_records == 60
+    assert posted == []
+
+    # changed batches are sent again
+    pl.read_csv(data["a"]).with_columns(
+        pl.when(pl.col("username") == "a0")
+        .then(pl.lit("a0-changed"))
+        .otherwise(pl.col("username"))
+        .alias("username"),
+    ).write_csv(data["a"])
+    res = run("fourth.tsv", "third.tsv")
+    assert res.skipped_records == 50
+    assert [u[0] for u in posted] == ["a0-changed"]
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+def test_delta_state(base_client_mock: mock.Mock, tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    data = Path(tmpdir) / "data.csv"
+    state = Path(tmpdir) / "state.parquet"
+    posted: list[str] = []
+    failing: set[str] = set()
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, typing.Any]:
+        req = json.loads(payload)
+        users = [u["username"] for u in req["users"]]
+        assert req["totalRecords"] == len(users)
+        posted.extend(users)
+        failed = [
+            {"username": u, "externalSystemId": u, "errorMessage": "failed"}
+            for u in users
+            if u in failing
+        ]
+        return {
+            "createdRecords": len(users) - len(failed),
+            "updatedRecords": 0,
+            "failedRecords": len(failed),
+            "failedUsers": failed,
+        }
+
+    base_client_mock.return_value.__enter__.return_value.post_json = post_json
+
+    def run(
+        users: dict[str, str],
+        *,
+        update_all_fields: bool = False,
+        source_type: str | None = None,
+    ) -> typing.Any:
+        posted.clear()
+        pl.DataFrame(
+            {
+                "username": list(users.keys()),
+                "externalSystemId": list(users.keys()),
+                "personal_email": list(users.values()),
+            },
+        ).write_csv(data)
+        return uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                data,
+                10,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=update_all_fields,
+                source_type=source_type,
+                delta_state=state,
+            ),
+        )
+
+    users = {f"u{i}": f"u{i}@example.com" for i in range(30)}
+    res = run(users)
+    assert len(posted) == 30
+    assert res.unchanged_records == 0
+
+    # changed and new users are sent, removed users are forgotten
+    users["u3"] = "changed@example.com"
+    users["u30"] = "new@example.com"
+    del users["u29"]
+    failing.add("u30")
+    res = run(users)
+    assert sorted(posted) == ["u3", "u30"]
+    assert res.unchanged_records == 28
+
+    # users FOLIO failed to import are sent again
+    failing.clear()
+    users["u29"] = "u29@example.com"
+    res = run(users)
+    assert sorted(posted) == ["u29", "u30"]
+    assert res.unchanged_records == 29
+
+    res = run(users)
+    assert posted == []
+    assert res.unchanged_records == 31
+
+    # FOLIO imports the users differently with other settings
+    res = run(users, update_all_fields=True)
+    assert len(posted) == 31
+    res = run(users, update_all_fields=True)
+    assert posted == []
+    res = run(users, update_all_fields=True, source_type="src")
+    assert len(posted) == 31
+
+
+def test_delta_state_deactivate(tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    with pytest.raises(ValueError, match="deactivate_missing_users"):
+        uut.ImportOptions(
+            "",
+            "",
+            "",
+            "",
+            Path(tmpdir) / "data.csv",
+            10,
+            0,
+            deactivate_missing_users=True,
+            update_all_fields=False,
+            source_type=None,
+            delta_state=Path(tmpdir) / "state.parquet",
+        )
+
+
+def test_diff_against_folio_deactivate(tmpdir: str) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    with pytest.raises(ValueError, match="deactivate_missing_users"):
+        uut.ImportOptions(
+            "",
+            "",
+            "",
+            "",
+            Path(tmpdir) / "data.csv",
+            10,
+            0,
+            deactivate_missing_users=True,
+            update_all_fields=False,
+            source_type=None,
+            diff_against_folio=True,
+        )
+
+
+@dataclass
+class DiffAgainstFolioCase:
+    data_location: Path
+    source_type: str | None
+    update_all_fields: bool
+    posted: list[str]
+    addresses: int = 2
+    # Fields that are only in FOLIO, personal fields are prefixed with personal_
+    unimported: dict[int, dict[str, typing.Any]] = field(
+        default_factory=lambda: {
+            i: {"active": True, "personal_firstName": "first"} for i in range(5)
+        },
+    )
+
+    @contextmanager
+    def setup(self) -> typing.Any:
+        pl.DataFrame(
+            {
+                "username": [f"u{i}" for i in range(6)],
+                "externalSystemId": [f"e{i}" for i in range(6)],
+                "patronGroup": ["staff", "staff", "staff", "faculty", "staff", None],
+                "departments": ["d1,d2", "d2,d1", "d1", None, None, None],
+                "enrollmentDate": ["2025-04-08"] * 6,
+                "personal_lastName": ["last", "last", "last", "last", "new", "last"],
+                "personal_address_primary_city": ["city"] * 6,
+                "personal_address_primary_addressTypeId": ["home"] * 6,
+            },
+        ).write_csv(self.data_location)
+        yield
+
+    def folio_user(self, i: int) -> dict[str, typing.Any]:
+        unimported = self.unimported.get(i, {})
+        return {
+            "id": f"uuid-{i}",
+            "username": f"u{i}",
+            "externalSystemId": f"e{i}"
+            if self.source_type is None
+            else f"{self.source_type}_e{i}",
+            "patronGroup": "staff-id",
+            "departments": ["d1-id", "d2-id"] if i < 2 else ["d1-id"],
+            "enrollmentDate": "2025-04-08T00:00:00.000+00:00",
+            "personal": {
+                "lastName": "last",
+                "addresses": [
+                    {"id": "a", "city": "city", "addressTypeId": "home-id"},
+                    {"id": "b", "city": "other", "addressTypeId": "work-id"},
+                ][: self.addresses],
+            }
+            | {
+                k.removeprefix("personal_"): v
+                for k, v in unimported.items()
+                if k.startswith("personal_")
+            },
+        } | {k: v for k, v in unimported.items() if not k.startswith("personal_")}
+
+
+class DiffAgainstFolioCases:
+    def case_diff(self, tmpdir: str) -> DiffAgainstFolioCase:
+        # u3 has a different group, u4 a new name, u5 isn't in FOLIO yet
+        return DiffAgainstFolioCase(
+            Path(tmpdir) / "data.csv",
+            None,
+            update_all_fields=False,
+            posted=["u3", "u4", "u5"],
+        )
+
+    def case_diff_source_type(self, tmpdir: str) -> DiffAgainstFolioCase:
+        return DiffAgainstFolioCase(
+            Path(tmpdir) / "data.csv",
+            "src",
+            update_all_fields=False,
+            posted=["u3", "u4", "u5"],
+        )
+
+    def case_diff_update_all_fields(self, tmpdir: str) -> DiffAgainstFolioCase:
+        # the second address in FOLIO would be removed
+        return DiffAgainstFolioCase(
+            Path(tmpdir) / "data.csv",
+            None,
+            update_all_fields=True,
+            posted=[f"u{i}" for i in range(6)],
+        )
+
+    def case_diff_update_all_fields_unimported(
+        self,
+        tmpdir: str,
+    ) -> DiffAgainstFolioCase:
+        # u1's barcode and u2's email in FOLIO would be removed
+        return DiffAgainstFolioCase(
+            Path(tmpdir) / "data.csv",
+            None,
+            update_all_fields=True,
+            posted=["u1", "u2", "u3", "u4", "u5"],
+            addresses=1,
+            unimported={
+                0: {"customFields": {}, "tags": {"tagList": []}},
+                1: {"barcode": "b1"},
+                2: {"personal_email": "u2@example.com"},
+            },
+        )
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize_with_cases("tc", DiffAgainstFolioCases)
+def test_diff_against_folio(
+    base_client_mock: mock.Mock,
+    tc: DiffAgainstFolioCase,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    posted: list[str] = []
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, int]:
+        users = [u["username"] for u in json.loads(payload)["users"]]
+        posted.extend(users)
+        return {"createdRecords": len(users), "updatedRecords": 0, "failedRecords": 0}
+
+    def get_data(endpoint: str, **kwargs: typing.Any) -> typing.Any:
+        if endpoint == "/users":
+            return [
+                tc.folio_user(i)
+                for i in range(5)
+                if f'"{tc.folio_user(i)["externalSystemId"]}"' in kwargs["cql_query"]
+            ]
+        return {
+            "/groups": [
+                {"id": "staff-id", "group": "staff"},
+                {"id": "faculty-id", "group": "faculty"},
+            ],
+            "/departments": [
+                {"id": "d1-id", "name": "d1"},
+                {"id": "d2-id", "name": "d2"},
+            ],
+            "/addresstypes": [
+                {"id": "home-id", "addressType": "home"},
+                {"id": "work-id", "addressType": "work"},
+            ],
+        }[endpoint]
+
+    client = base_client_mock.return_value.__enter__.return_value
+    client.post_json = post_json
+    client.get_data = get_data
+
+    with tc.setup():
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                4,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=tc.update_all_fields,
+                source_type=tc.source_type,
+                diff_against_folio=True,
+            ),
+        )
+
+    assert sorted(posted) == tc.posted
+    assert res.unchanged_records == 6 - len(tc.posted)
+    assert res.created_records == len(tc.posted)
+
+
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
+@parametrize(error=[pfc.BadRequestError, pfc.UnprocessableContentError])
+@parametrize(failing=["/groups", "/users"])
+def test_diff_against_folio_unavailable(
+    base_client_mock: mock.Mock,
+    error: type[Exception],
+    failing: str,
+    tmpdir: str,
+) -> None:
+    import folio_user_bulk_edit.commands.user_import as uut
+
+    tc = DiffAgainstFolioCase(Path(tmpdir) / "data.csv", None, False, [])
+    posted: list[str] = []
+
+    def post_json(_: str, payload: bytes, **__: typing.Any) -> dict[str, int]:
+        users = [u["username"] for u in json.loads(payload)["users"]]
+        posted.extend(users)
+        return {"createdRecords": len(users), "updatedRecords": 0, "failedRecords": 0}
+
+    client = base_client_mock.return_value.__enter__.return_value
+
+    def get_data(endpoint: str, **_: typing.Any) -> list[dict[str, str]]:
+        if endpoint == failing:
+            raise error(endpoint)
+        return []
+
+    client.post_json = post_json
+    client.get_data = get_data
+
+    with tc.setup():
+        res = uut.run(
+            uut.ImportOptions(
+                "",
+                "",
+                "",
+                "",
+                tc.data_location,
+                4,
+                0,
+                deactivate_missing_users=False,
+                update_all_fields=False,
+                source_type=None,
+                diff_against_folio=True,
+            ),
+        )
+
+    # users that couldn't be compared are all sent
+    assert sorted(posted) == [f"u{i}" for i in range(6)]
+    assert res.unchanged_records == 0
@@ -0,0 +1,109 @@
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
+from unittest import mock
+
+import httpx
+import pyfolioclient as pfc
+from pytest_cases import parametrize
+
+
+def _client(
+    handler: typing.Callable[[httpx.Request], httpx.Response],
+    requests_per_second: float | None = None,
+    max_throttled_retries: int = 5,
+) -> httpx.Client:
+    from folio_user_bulk_edit.folio import _GovernedTransport, _Governor
+
+    return httpx.Client(
+        transport=_GovernedTransport(
+            httpx.MockTransport(handler),
+            _Governor(requests_per_second, None),
+            max_throttled_retries,
+        ),
+    )
+
+
+def test_requests_per_second() -> None:
+    with _client(lambda _: httpx.Response(200), requests_per_second=100) as client:
+        start = time.monotonic()
+        for _ in range(150):
+            client.get("http://folio.org/users")
+
+        # the first second's worth is a burst
+        assert time.monotonic() - start >= 0.45
+
+
+def test_users_per_second() -> None:
+    from folio_user_bulk_edit.folio import _Governor
+
+    governor = _Governor(None, 1000)
+    start = time.monotonic()
+    governor.users(1000)
+    governor.users(500)
+    assert time.monotonic() - start >= 0.45
+
+
+@parametrize(
+    "throttled,max_throttled_retries,status_code,calls",
+    [
+        (0, 5, 200, 1),
+        (3, 5, 200, 4),
+        (10, 5, 429, 6),
+    ],
+)
+@parametrize("retry_after", ["0", "Wed, 21 Oct 2015 07:28:00 GMT"])
+def test_too_many_requests(
+    throttled: int,
+    max_throttled_retries: int,
+    status_code: int,
+    calls: int,
+    retry_after: str,
+) -> None:
+    count = 0
+
+    def handler(_: httpx.Request) -> httpx.Response:
+        nonlocal count
+        count += 1
+        if count <= throttled:
+            return httpx.Response(429, headers={"Retry-After": retry_after})
+        return httpx.Response(200)
+
+    with _client(handler, max_throttled_retries=max_throttled_retries) as client:
+        assert client.get("http://folio.org/users").status_code == status_code
+
+    assert count == calls
+
+
+def test_token_refreshed_once() -> None:
+    from folio_user_bulk_edit.folio import FolioClient
+
+    refreshes = 0
+
+    def retrieve_token(client: FolioClient, refresh: bool = False) -> None:
+        nonlocal refreshes
+        if refresh:
+            refreshes += 1
+            time.sleep(0.1)
+        expiration = datetime.now(tz=UTC) + timedelta(hours=1)
+        client._token_expiration = expiration  # noqa: SLF001
+        client._token_expiration_with_buffer = expiration - timedelta(seconds=10)  # noqa: SLF001
+
+    with mock.patch.object(
+        pfc.FolioBaseClient,
+        "_retrieve_token",
+        autospec=True,
+        side_effect=retrieve_token,
+    ):
+        client = FolioClient("http://folio.org", "tenant", "user", "pass")
+        # the token is about to expire
+        now = datetime.now(tz=UTC)
+        client._token_expiration = now + timedelta(seconds=5)  # noqa: SLF001
+        client._token_expiration_with_buffer = now - timedelta(seconds=5)  # noqa: SLF001
+
+        with ThreadPoolExecutor(8) as pool:
+            for f in [pool.submit(client._manage_token) for _ in range(8)]:  # noqa: SLF001
+                f.result()
+
+    assert refreshes == 1
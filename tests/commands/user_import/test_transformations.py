@@ -1,4 +1,5 @@
 import json
+import re
 import typing
 from dataclasses import dataclass
 from pathlib import Path
@@ -24,7 +25,7 @@ class TransformationCases:
         return TransformationTestCase({"data": csv}, res)
 
 
-@mock.patch("pyfolioclient.FolioBaseClient")
+@mock.patch("folio_user_bulk_edit.folio.FolioClient")
 @parametrize_with_cases("tc", TransformationCases)
 def test_transform_data(
     base_client_mock: mock.Mock,
@@ -34,7 +35,7 @@ def test_transform_data(
 
     # I couldn't figure this out better
     post_data_mock: mock.MagicMock = (
-        base_client_mock.return_value.__enter__.return_value.post_data
+        base_client_mock.return_value.__enter__.return_value.post_json
     )
 
     uut.run(
@@ -52,4 +53,18 @@ def test_transform_data(
         ),
     )
 
-    post_data_mock.assert_called_with("/user-import", payload=tc.expected)
+    post_data_mock.assert_called_once()
+    (endpoint, content) = post_data_mock.call_args.args
+    assert endpoint == "/user-import"
+    assert json.loads(content) == tc.expected
+    # the payload should be the same as encoding the expected json with httpx
+    # except polars writes the exponents of floats without a + or leading 0
+    assert content == re.sub(
+        rb"(\d)e\+?(-?)0*(\d)",
+        rb"\1e\2\3",
+        json.dumps(
+            tc.expected,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode(),
+    )